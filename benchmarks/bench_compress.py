@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Throughput of the package gzip writer for an increasing number of
+# --compress_threads, on a synthetic half-compressible image.
+#
+#   python benchmarks/bench_compress.py [--size_mb 256] [--max_threads 8]
+
+import argparse
+import zlib
+
+from benchutil import nfvpt, MB, make_payload, NullSink, best_of, cpu_count
+
+# the payload is written in 64K pieces
+WRITE_SIZE = 64 * 1024
+
+
+def compress(payload, threads, level):
+    sink = NullSink()
+    writer = nfvpt.ParallelGzipWriter(sink, level=level, threads=threads)
+    view = memoryview(payload)
+    for pos in range(0, len(payload), WRITE_SIZE):
+        writer.write(view[pos:pos + WRITE_SIZE].tobytes())
+    writer.close()
+    return sink.count
+
+
+class Capture(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+
+def check_stream(threads):
+    payload = make_payload(3 * nfvpt.GZIP_BLOCK_SIZE + 12345, seed=7)
+    out = Capture()
+    writer = nfvpt.ParallelGzipWriter(out, threads=threads)
+    writer.write(payload)
+    writer.close()
+    assert zlib.decompress(b''.join(out.parts), 16 + zlib.MAX_WBITS) == payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gzip writer throughput per --compress_threads')
+    parser.add_argument('--size_mb', type=int, default=256)
+    parser.add_argument('--max_threads', type=int, default=max(4, cpu_count()))
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    payload = make_payload(args.size_mb * MB)
+    print('payload %d MB, level %d, %d cpus' % (args.size_mb, args.level, cpu_count()))
+    print('%8s %10s %10s %8s %8s' % ('threads', 'seconds', 'MB/s', 'speedup', 'ratio'))
+    base = None
+    threads = 1
+    while threads <= args.max_threads:
+        check_stream(threads)
+        out_size = compress(payload, threads, args.level)
+        elapsed = best_of(args.repeat, compress, payload, threads, args.level)
+        base = base or elapsed
+        print('%8d %10.3f %10.1f %8.2f %8.3f' % (threads, elapsed, args.size_mb / elapsed,
+                                                base / elapsed, float(out_size) / len(payload)))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main()
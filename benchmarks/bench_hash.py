@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Hashing on the archiving thread vs on --hash_workers threads while the
+# members are compressed and written, on a synthetic multi-disk package:
+# one root image, a few ephemeral disks and a handful of small bootstrap
+# files. Every file is read once either way.
+#
+#   python benchmarks/bench_hash.py [--disk_mb 256] [--disks 4] [--codec gzip]
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchutil import nfvpt, MB, write_file, best_of, cpu_count
+
+
+def make_package_files(workdir, disk_mb, disks, bootstraps):
+    files = [write_file(os.path.join(workdir, 'root.qcow2'), disk_mb * MB, seed=1)]
+    for n in range(1, disks):
+        files.append(write_file(os.path.join(workdir, 'ephemeral%d.qcow2' % n), disk_mb * MB, seed=n + 1))
+    for n in range(bootstraps):
+        files.append(write_file(os.path.join(workdir, 'day0_%d.cfg' % n), 4096, seed=100 + n))
+    return files
+
+
+def archive(path, files, args, workers):
+    archive = nfvpt.PackageArchive(path, codec=args.codec, threads=args.compress_threads,
+                                   hash_workers=workers)
+    checksums = [archive.add(name, digests=args.digests) for name in files]
+    archive.close()
+    return checksums
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hashing while archiving, inline vs on threads')
+    parser.add_argument('--disk_mb', type=int, default=256)
+    parser.add_argument('--disks', type=int, default=4)
+    parser.add_argument('--bootstraps', type=int, default=4)
+    parser.add_argument('--codec', default='gzip', choices=sorted(nfvpt.ARCHIVE_CODECS))
+    parser.add_argument('--compress_threads', type=int, default=cpu_count())
+    parser.add_argument('--digests', type=nfvpt.digests_arg_parse, default=['sha1', 'sha256'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        files = make_package_files(workdir, args.disk_mb, args.disks, args.bootstraps)
+        path = os.path.join(workdir, 'package.tar')
+        total_mb = sum(os.path.getsize(name) for name in files) / float(MB)
+        print('%d files, %.0f MB, %s, %s, %d compress threads (page cache warm after the first run)' %
+              (len(files), total_mb, args.codec, ','.join(args.digests), args.compress_threads))
+        print('%8s %10s %10s %8s' % ('workers', 'seconds', 'MB/s', 'speedup'))
+        expected = archive(path, files, args, 1)
+        base = None
+        for workers in (1, 2):
+            assert archive(path, files, args, workers) == expected
+            elapsed = best_of(args.repeat, archive, path, files, args, workers)
+            base = base or elapsed
+            print('%8d %10.3f %10.1f %8.2f' % (workers, elapsed, total_mb / elapsed, base / elapsed))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
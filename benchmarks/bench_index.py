@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Reading single members of a big package: streaming the .tar.gz up to the
+# member against seeking to it through the --index sidecar, plus what the
+# full flush at every member start costs in package size and write time.
+#
+#   python benchmarks/bench_index.py [--image_mb 512] [--compress_threads 1]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import nfvpt, MB, write_file, best_of
+
+
+def build(path, image, index, threads):
+    start = time.time()
+    archive = nfvpt.PackageArchive(path, threads=threads, index=index)
+    archive.addbytes('image_properties.xml', b'<image_properties/>\n' * 64)
+    archive.add(image)
+    archive.addbytes('package.mf', b'<PackageContents/>\n' * 64)
+    archive.close()
+    return time.time() - start
+
+
+def read_member(path, name):
+    return sum(len(block) for block in nfvpt.iter_package_member(path, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='member reads with and without --index')
+    parser.add_argument('--image_mb', type=int, default=512)
+    parser.add_argument('--compress_threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        image = write_file(os.path.join(workdir, 'root.qcow2'), args.image_mb * MB)
+        plain = os.path.join(workdir, 'plain.tar.gz')
+        indexed = os.path.join(workdir, 'indexed.tar.gz')
+        plain_write = build(plain, image, False, args.compress_threads)
+        indexed_write = build(indexed, image, True, args.compress_threads)
+        print('%-28s %8.3f s  %12d bytes' % ('write', plain_write, os.path.getsize(plain)))
+        print('%-28s %8.3f s  %12d bytes  (+%d)' % ('write --index', indexed_write, os.path.getsize(indexed),
+                                                    os.path.getsize(indexed) - os.path.getsize(plain)))
+        for name in ('image_properties.xml', 'package.mf'):
+            streamed = best_of(args.repeat, read_member, plain, name)
+            seeked = best_of(args.repeat, read_member, indexed, name)
+            assert read_member(plain, name) == read_member(indexed, name)
+            print('%-28s %8.4f s streamed  %8.4f s indexed  %8.0fx' %
+                  (name, streamed, seeked, streamed / seeked if seeked else 0))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Reading and rewriting a big package.mf, as convert and repackage do: the
+# old whole-document xmltodict parse/unparse against iter_manifest and the
+# buffered ManifestWriter. Every variant runs in a fresh interpreter so the
+# peak RSS of each can be compared.
+#
+#   python benchmarks/bench_manifest.py [--entries 100000]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchutil import ROOT_DIR
+
+RUN = '''
+import io, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+import nfvpt
+path, variant = sys.argv[2], sys.argv[3]
+start = time.time()
+with open(path, 'rb') as fd:
+    if variant == 'xmltodict':
+        import xmltodict
+        pkg_dict = xmltodict.parse(fd.read())
+        for pkg in pkg_dict['PackageContents']['File_Info']:
+            pkg['sha256_checksum'] = pkg['sha256_checksum'][::-1]
+        data = (nfvpt.manifest_comment(['sha256']) +
+                xmltodict.unparse(pkg_dict, pretty=True, full_document=False)).encode('utf-8')
+    else:
+        manifest = list(nfvpt.iter_manifest(fd))
+        file_info = nfvpt.manifest_file_info(manifest)
+        for pkg in file_info:
+            pkg['sha256_checksum'] = pkg['sha256_checksum'][::-1]
+        data = nfvpt.manifest_bytes(manifest, file_info, ['sha256'])
+elapsed = time.time() - start
+print('%.6f %d %d' % (elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(data)))
+'''
+
+
+def write_manifest(path, entries):
+    with open(path, 'w') as fd:
+        fd.write('<!-- sha256sum - for calculating checksum -->\n<PackageContents>\n')
+        fd.write('  <Packaging_Version>1.0</Packaging_Version>\n')
+        for n in range(entries):
+            fd.write('  <File_Info>\n    <name>day0_%d.cfg</name>\n    <type>bootstrap_file</type>\n'
+                     '    <sha256_checksum>%064x</sha256_checksum>\n  </File_Info>\n' % (n, n))
+        fd.write('</PackageContents>\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='package.mf read and rewrite')
+    parser.add_argument('--entries', type=int, default=100000, help='File_Info entries')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        path = os.path.join(workdir, 'package.mf')
+        write_manifest(path, args.entries)
+        print('package.mf of %d entries, %.1f MB' % (args.entries, os.path.getsize(path) / 1e6))
+        results = {}
+        for variant in ('xmltodict', 'streaming'):
+            out = subprocess.check_output([sys.executable, '-c', RUN, ROOT_DIR, path, variant])
+            elapsed, maxrss, size = out.split()
+            results[variant] = float(elapsed)
+            print('%-10s %8.3f s  peak RSS %8.1f MB  %d bytes written' %
+                  (variant, float(elapsed), int(maxrss) / 1024.0, int(size)))
+        print('speedup %.2fx' % (results['xmltodict'] / results['streaming']))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
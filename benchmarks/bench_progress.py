@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# What --progress costs on the hot read loops: archiving and hashing an
+# image without a Progress, with one whose callback does nothing and with
+# the JSON lines reporter, plus the number of events each produced. The
+# wall times of whole runs are dominated by the disk; the cost of one
+# Progress.advance call per block is timed on its own as well.
+#
+#   python benchmarks/bench_progress.py [--image_mb 1024] [--codec none]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchutil import nfvpt, MB, write_file, best_of
+
+
+class Counter(object):
+    def __init__(self):
+        self.events = 0
+
+    def __call__(self, event):
+        self.events += 1
+
+
+def archive(path, image, codec, callback):
+    progress = nfvpt.Progress(callback, 'bench') if callback else None
+    archive = nfvpt.PackageArchive(path, codec=codec, progress=progress)
+    archive.expect(os.path.getsize(image))
+    archive.add(image)
+    archive.close()
+
+
+def hash_image(image, callback):
+    progress = nfvpt.Progress(callback, 'bench') if callback else None
+    if progress is not None:
+        progress.start('hash', os.path.getsize(image))
+    nfvpt.file_checksums(image, drop_cache=False, progress=progress)
+
+
+def advance_cost(calls=100000):
+    progress = nfvpt.Progress(Counter(), 'bench')
+    progress.start('hash', calls * nfvpt.HASH_BLOCK_SIZE)
+    start = time.time()
+    for _ in range(calls):
+        progress.advance(nfvpt.HASH_BLOCK_SIZE)
+    return (time.time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='--progress overhead')
+    parser.add_argument('--image_mb', type=int, default=1024)
+    parser.add_argument('--codec', default='none', choices=sorted(nfvpt.ARCHIVE_CODECS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        image = write_file(os.path.join(workdir, 'root.qcow2'), args.image_mb * MB)
+        path = os.path.join(workdir, 'package.tar')
+        with open(os.devnull, 'w') as devnull:
+            for name, func in (('archive', lambda callback: archive(path, image, args.codec, callback)),
+                               ('hash', lambda callback: hash_image(image, callback))):
+                base = best_of(args.repeat, func, None)
+                print('%-8s %-12s %8.3f s' % (name, 'off', base))
+                for label, callback in (('callback', Counter()), ('json', nfvpt.JsonProgress(devnull))):
+                    elapsed = best_of(args.repeat, func, callback)
+                    events = ' %d events' % (callback.events // args.repeat) if label == 'callback' else ''
+                    print('%-8s %-12s %8.3f s  %+6.2f%%%s' % (name, label, elapsed,
+                                                             (elapsed / base - 1) * 100, events))
+    finally:
+        shutil.rmtree(workdir)
+    cost = advance_cost()
+    print('advance  %.2f us per %d byte block, %.2f ms per GiB' %
+          (cost * 1e6, nfvpt.HASH_BLOCK_SIZE, cost * 1024 * MB / nfvpt.HASH_BLOCK_SIZE * 1e3))
+
+
+if __name__ == '__main__':
+    main()
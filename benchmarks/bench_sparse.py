@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Hashing and archiving a mostly empty ephemeral disk: the old 64K read loop
+# against the SEEK_DATA/SEEK_HOLE aware path, which hashes the holes from a
+# zero block and stores them as a GNU sparse member.
+#
+#   python benchmarks/bench_sparse.py [--size_mb 2048] [--data_mb 16]
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchutil import nfvpt, MB, make_payload, best_of
+from bench_blocksize import legacy_sha256
+
+
+def make_sparse_image(path, size_mb, data_mb):
+    # data_mb of data spread in 1 MB extents over a size_mb file
+    step = size_mb // data_mb
+    with open(path, 'wb') as afile:
+        for n in range(data_mb):
+            afile.seek(n * step * MB)
+            afile.write(make_payload(MB, seed=n))
+        afile.truncate(size_mb * MB)
+    return path
+
+
+def archive(path, target):
+    package = nfvpt.PackageArchive(target, codec='gzip', level=1)
+    package.add(path)
+    package.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sparse image hashing and archiving')
+    parser.add_argument('--size_mb', type=int, default=2048)
+    parser.add_argument('--data_mb', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        path = make_sparse_image(os.path.join(workdir, 'ephemeral.qcow2'), args.size_mb, args.data_mb)
+        target = os.path.join(workdir, 'pkg.tar.gz')
+        expected = legacy_sha256(path)
+        assert nfvpt.file_checksums(path)['sha256'] == expected
+        print('%d MB image, %d MB of data in %d extents' %
+              (args.size_mb, args.data_mb, len(nfvpt.FileReader(path).extents())))
+        legacy = best_of(args.repeat, legacy_sha256, path)
+        sparse = best_of(args.repeat, nfvpt.file_checksums, path)
+        print('%-24s %10.3f s' % ('sha256, 64K read()', legacy))
+        print('%-24s %10.3f s  %6.2fx' % ('sha256, sparse aware', sparse, legacy / sparse))
+        elapsed = best_of(args.repeat, archive, path, target)
+        print('%-24s %10.3f s  %d bytes stored' % ('gzip -1 archive', elapsed, os.path.getsize(target)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Startup latency of the nfvpt command line. Short commands are run in a
+# fresh interpreter and the median wall time of --repeat runs is checked
+# against a budget, together with the modules a plain 'import nfvpt' loads:
+# the heavy ones (argparse, xmltodict, tarfile, multiprocessing, the HTTP
+# modules of serve) must only be imported by the commands that use them.
+# Python 2 has no -X importtime, the sys.modules check stands in for it.
+#
+#   python benchmarks/bench_startup.py [--repeat 10] [--budget_ms 150]
+#                                      [--nfvpt other/nfvpt.py]
+#
+# Exits with 1 when a command is over budget or a heavy module is imported
+# eagerly, so it can gate CI.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchutil import ROOT_DIR
+
+# modules 'import nfvpt' must not load
+LAZY_MODULES = ['argparse', 'xmltodict', 'tarfile', 'tempfile', 'multiprocessing', 'sqlite3',
+                'zstandard', 'inspect', 'subprocess', 'pprint', 'socket', 'httplib',
+                'BaseHTTPServer', 'SocketServer', 'Queue', 'urlparse']
+
+IMPORT_CHECK = '''
+import sys, time
+sys.path.insert(0, sys.argv[1])
+before = set(sys.modules)
+start = time.time()
+import nfvpt
+elapsed = time.time() - start
+loaded = set(name for name in set(sys.modules) - before if sys.modules[name] is not None)
+print('%.6f %s' % (elapsed, ','.join(sorted(set(sys.argv[2].split(',')) & loaded))))
+'''
+
+
+def run(cmd, cwd):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(cmd, cwd=cwd, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nfvpt command line startup time')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget_ms', type=float, default=150.0,
+                        help='median wall time allowed per command')
+    parser.add_argument('--nfvpt', default=os.path.join(ROOT_DIR, 'nfvpt.py'),
+                        help='nfvpt.py to measure, e.g. of a baseline checkout')
+    args = parser.parse_args()
+
+    script = os.path.abspath(args.nfvpt)
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    failed = False
+    try:
+        package = os.path.join(workdir, 'ISRV_vManage_scaf.tar.gz')
+        shutil.copy(os.path.join(ROOT_DIR, 'ISRV_vManage_scaf.tar.gz'), package)
+        commands = [
+            ('python -c pass', [sys.executable, '-c', 'pass']),
+            ('--help', [sys.executable, script, '--help']),
+            ('convert', [sys.executable, script, '--modify_package', 'convert',
+                         '--file_path', package, '--no_cache']),
+        ]
+        for name, cmd in commands:
+            elapsed = median([run(cmd, workdir) for _ in range(args.repeat)]) * 1000
+            over = name != 'python -c pass' and elapsed > args.budget_ms
+            failed = failed or over
+            print('%-16s %8.1f ms%s' % (name, elapsed, '  OVER BUDGET' if over else ''))
+
+        # twice, the first run may have to write nfvpt.pyc
+        for _ in range(2):
+            out = subprocess.check_output([sys.executable, '-c', IMPORT_CHECK,
+                                           os.path.dirname(script), ','.join(LAZY_MODULES)])
+        elapsed, eager = out.split(' ', 1)
+        eager = eager.strip()
+        print('%-16s %8.1f ms' % ('import nfvpt', float(elapsed) * 1000))
+        if eager:
+            failed = True
+            print('imported eagerly: %s' % eager.replace(',', ', '))
+        print('budget %.0f ms: %s' % (args.budget_ms, 'FAILED' if failed else 'ok'))
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# End to end benchmark suite on synthetic VNF packages. For every scaffold
+# of the repository (ISRV_vManage_scaf, PAN_vManage_scaf,
+# vedge_vmanage_scaf) it writes a --newjson spec with a dense root disk, a
+# sparse ephemeral disk and --bootstrap files modeled on the bootstrap
+# files of the scaffold, then times:
+#
+#   validate   the spec against the --newjson schema, --iterations times
+#   build      build_from_json + buildTargetFile (package_from_json)
+#   manifest   parsing the package.mf of the built package, --iterations times
+#   repackage  repackage_package of the scaffold with the synthetic disks
+#   convert    convert_package (convertTargetFile) of the built package
+#
+# The results are written as JSON (--output). Given the results of an
+# earlier run as --baseline, every case slower than the baseline by more
+# than --threshold percent is reported and the suite exits with 1, so it
+# can gate CI:
+#
+#   python benchmarks/bench_suite.py --output baseline.json
+#   ... change nfvpt.py ...
+#   python benchmarks/bench_suite.py --baseline baseline.json [--threshold 10]
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tarfile
+import tempfile
+from collections import OrderedDict
+
+from benchutil import ROOT_DIR, nfvpt, MB, write_disk_image, best_of
+
+SCAFFOLDS = OrderedDict([
+    ('ISRV', ('ISRV_vManage_scaf.tar.gz', 'ROUTER')),
+    ('PAN', ('PAN_vManage_scaf.tar.gz', 'FIREWALL')),
+    ('vedge', ('vedge_vmanage_scaf.tar.gz', 'ROUTER')),
+])
+CASES = ('validate', 'build', 'manifest', 'repackage', 'convert')
+# members of a scaffold that are not bootstrap files
+METADATA = ('image_properties.xml', 'system_generated_properties.xml', nfvpt.pkgmf_file)
+
+
+@contextlib.contextmanager
+def quiet():
+    # the packaging functions print as the command line does
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def bootstrap_files(scaffold, count, directory):
+    # count bootstrap files with the contents of those of the scaffold
+    with tarfile.open(os.path.join(ROOT_DIR, scaffold)) as tar:
+        sources = [(member.name, tar.extractfile(member).read()) for member in tar
+                   if member.isfile() and member.name not in METADATA]
+    names = []
+    for n in range(count):
+        name, data = sources[n % len(sources)]
+        if n >= len(sources):
+            name = '%d_%s' % (n // len(sources), name)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        names.append(name)
+    return names
+
+
+def make_fixture(workdir, key, args):
+    scaffold, vnf_type = SCAFFOLDS[key]
+    directory = os.path.join(workdir, key)
+    out_dir = os.path.join(directory, 'out')
+    os.makedirs(out_dir)
+    root = write_disk_image(os.path.join(directory, 'root.qcow2'), args.image_mb * MB, args.format)
+    ephemeral = write_disk_image(os.path.join(directory, 'ephemeral1.qcow2'), args.ephemeral_mb * MB,
+                                 args.format, sparse=True, data_size=args.sparse_data_mb * MB, seed=2)
+    spec = OrderedDict([
+        ('vnf_type', vnf_type), ('package_filename', key.lower() + '-bench'), ('vnf_version', '1.0'),
+        ('vnf_name', key.lower()), ('app_vendor', 'bench'), ('package_output_dir', out_dir),
+        ('image_properties', {'monitored': True, 'bootup_time': 600, 'privilege': False}),
+        ('resource_properties', {'vnic_max': 8, 'mgmt_vnic': 0, 'ha_capable': False}),
+        ('image_list', [{'image_name': 'root.qcow2', 'path': directory, 'disk': 'root'},
+                        {'image_name': 'ephemeral1.qcow2', 'path': directory, 'disk': 'ephemeral1'}]),
+        ('bootstrap', {'file_list': [{'name': name, 'path': directory, 'mnt_point': '/', 'parse': False,
+                                      'ha_mode': 'standalone'}
+                                     for name in bootstrap_files(scaffold, args.bootstrap, directory)]}),
+    ])
+    spec_file = os.path.join(directory, 'spec.json')
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f, indent=1)
+    metadata = os.path.join(directory, scaffold)
+    shutil.copy(os.path.join(ROOT_DIR, scaffold), metadata)
+    return OrderedDict([('spec', spec), ('spec_file', spec_file), ('out_dir', out_dir),
+                        ('metadata', metadata), ('images', [root, ephemeral])])
+
+
+def result(seconds, size=None, operations=None):
+    item = OrderedDict([('seconds', seconds)])
+    if size is not None:
+        item['bytes'] = size
+        item['bytes_per_second'] = size / seconds if seconds else 0.0
+    if operations is not None:
+        item['operations'] = operations
+        item['seconds_per_operation'] = seconds / operations
+    return item
+
+
+def run_suite(fixture, args, options):
+    results = OrderedDict()
+    cases = args.cases
+    image_bytes = sum(os.path.getsize(path) for path in fixture['images'])
+    if 'validate' in cases:
+        validator = nfvpt.spec_validator()
+        assert not validator.validate(fixture['spec'])
+        elapsed = best_of(args.repeat, lambda: [validator.validate(fixture['spec'])
+                                                for _ in range(args.iterations)])
+        results['validate'] = result(elapsed, operations=args.iterations)
+    with quiet():
+        package = nfvpt.package_from_json(fixture['spec_file'], dict(options))
+        if 'build' in cases:
+            elapsed = best_of(args.repeat, nfvpt.package_from_json, fixture['spec_file'], dict(options))
+            results['build'] = result(elapsed, image_bytes)
+    if 'manifest' in cases:
+        with tarfile.open(package) as tar:
+            data = tar.extractfile(nfvpt.pkgmf_file).read()
+        elapsed = best_of(args.repeat, lambda: [list(nfvpt.iter_manifest(io.BytesIO(data)))
+                                                for _ in range(args.iterations)])
+        results['manifest'] = result(elapsed, len(data) * args.iterations, args.iterations)
+    with quiet():
+        if 'repackage' in cases:
+            elapsed = best_of(args.repeat, nfvpt.repackage_package, dict(options), fixture['metadata'],
+                              fixture['images'], fixture['out_dir'])
+            results['repackage'] = result(elapsed, image_bytes)
+        if 'convert' in cases:
+            src_dir, pkg_name = os.path.split(package)
+            elapsed = best_of(args.repeat, nfvpt.convert_package, dict(options), src_dir, pkg_name,
+                              fixture['out_dir'])
+            results['convert'] = result(elapsed, os.path.getsize(package))
+    return results
+
+
+def compare(report, baseline, threshold):
+    # the cases slower than the baseline by more than threshold percent
+    if baseline.get('parameters') != report['parameters']:
+        print('warning: the baseline was run with other parameters: %s' % json.dumps(baseline.get('parameters')))
+    regressions = []
+    print('\n%-20s %10s %10s %9s' % ('case', 'baseline', 'current', 'change'))
+    for name, item in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            print('%-20s %10s %10.4f' % (name, '-', item['seconds']))
+            continue
+        change = (item['seconds'] / before['seconds'] - 1) * 100 if before['seconds'] else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('%-20s %10.4f %10.4f %+8.1f%%%s' % (name, before['seconds'], item['seconds'], change,
+                                                 '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nfvpt benchmark suite on synthetic VNF packages')
+    parser.add_argument('--scaffolds', default=','.join(SCAFFOLDS),
+                        help='scaffolds to model the packages on, of %s' % ', '.join(SCAFFOLDS))
+    parser.add_argument('--cases', default=','.join(CASES), help='cases to run, of %s' % ', '.join(CASES))
+    parser.add_argument('--image_mb', type=int, default=256, help='size of the dense root disk')
+    parser.add_argument('--ephemeral_mb', type=int, default=1024, help='size of the sparse ephemeral disk')
+    parser.add_argument('--sparse_data_mb', type=int, default=32, help='data in the sparse ephemeral disk')
+    parser.add_argument('--format', default='qcow2', choices=['qcow2', 'raw'], help='layout of the disks')
+    parser.add_argument('--bootstrap', type=int, default=8, help='bootstrap files per package')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='specs validated and manifests parsed per validate and manifest run')
+    parser.add_argument('--compress_threads', type=int, default=1)
+    parser.add_argument('--hash_workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slower than the baseline that fails the suite')
+    args = parser.parse_args()
+    args.scaffolds = [key for key in args.scaffolds.split(',') if key]
+    args.cases = [case for case in args.cases.split(',') if case]
+    for key in args.scaffolds:
+        if key not in SCAFFOLDS:
+            parser.error('unknown scaffold %s' % key)
+    for case in args.cases:
+        if case not in CASES:
+            parser.error('unknown case %s' % case)
+
+    nfvpt.logger.addHandler(logging.NullHandler())
+    options = {'no_cache': True, 'compress_threads': args.compress_threads, 'hash_workers': args.hash_workers}
+    # what the timings depend on; the results are named after the scaffold and case
+    parameters = OrderedDict((key, getattr(args, key)) for key in
+                             ('image_mb', 'ephemeral_mb', 'sparse_data_mb', 'format', 'bootstrap',
+                              'iterations', 'compress_threads', 'hash_workers', 'repeat'))
+    report = OrderedDict([('version', nfvpt.VERSION), ('python', platform.python_version()),
+                          ('parameters', parameters), ('results', OrderedDict())])
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        for key in args.scaffolds:
+            fixture = make_fixture(workdir, key, args)
+            for case, item in run_suite(fixture, args, options).items():
+                name = '%s.%s' % (key, case)
+                report['results'][name] = item
+                rate = ' %8.1f MB/s' % (item['bytes_per_second'] / MB) if 'bytes' in item else ''
+                print('%-20s %10.4f s%s' % (name, item['seconds'], rate))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print('%d regressions above %.1f%%: %s' % (len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+        print('no regression above %.1f%%' % args.threshold)
+
+
+if __name__ == '__main__':
+    main()
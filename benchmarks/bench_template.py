@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Rendering image_properties.xml for many packages sharing one template,
+# as --batch and the serve daemon do: parsing the template for every
+# package, parsing it once and deep copying it, and the TemplateCache
+# handing out copies that share all but image_properties with the cached
+# parse. Done for the built-in template and for a --prop_template file with
+# --custom_properties custom properties.
+#
+#   python benchmarks/bench_template.py [--packages 1000] [--custom_properties 50]
+
+import argparse
+import copy
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from benchutil import nfvpt, best_of
+
+
+def write_template(path, custom_properties):
+    with open(path, 'w') as f:
+        f.write(nfvpt.image_properties_template_contents.replace('</image_properties>', ''))
+        for n in range(custom_properties):
+            f.write('    <custom_property>\n        <name display="Property %d">PROP_%d</name>\n'
+                    '        <type>string</type>\n        <val>value %d</val>\n    </custom_property>\n'
+                    % (n, n, n))
+        f.write('</image_properties>')
+    return path
+
+
+def spec_options(workdir):
+    # the options build_from_json derives from a small --newjson spec
+    with open(os.path.join(workdir, 'root.qcow2'), 'wb') as f:
+        f.write(b'\0' * 4096)
+    with open(os.path.join(workdir, 'day0.cfg'), 'w') as f:
+        f.write('hostname ${HOSTNAME}\n')
+    spec = {
+        'vnf_type': 'ROUTER', 'package_filename': 'isrv', 'vnf_version': '1.0', 'vnf_name': 'isrv',
+        'app_vendor': 'bench', 'package_output_dir': workdir,
+        'image_properties': {'monitored': True, 'bootup_time': 600, 'privilege': False},
+        'resource_properties': {'vnic_max': 8, 'mgmt_vnic': 0, 'ha_capable': False},
+        'image_list': [{'image_name': 'root.qcow2', 'path': workdir, 'disk': 'root'}],
+        'bootstrap': {'file_list': [{'name': 'day0.cfg', 'path': workdir, 'mnt_point': '/', 'parse': True,
+                                     'ha_mode': 'standalone',
+                                     'userInput': [{'name': 'HOSTNAME', 'type': 'string',
+                                                    'display_str': 'Hostname'}]}]},
+    }
+    spec_file = os.path.join(workdir, 'spec.json')
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f)
+    return nfvpt.build_from_json(nfvpt.image_properties_template(), spec_file)
+
+
+def variants(path):
+    with open(path) as f:
+        contents = f.read()
+    parsed = nfvpt.xmltodict.parse(contents)
+    cache = nfvpt.TemplateCache()
+    return [('parse per package', lambda: nfvpt.xmltodict.parse(contents)),
+            ('parse once, deepcopy', lambda: copy.deepcopy(parsed)),
+            ('TemplateCache', lambda: cache.get(path))], cache
+
+
+def render(get_template, opts):
+    nfvpt.make_image_prop_xml(get_template(), opts)
+    with open(nfvpt.build_context(opts).image_prop_file) as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='image_properties template reuse')
+    parser.add_argument('--packages', type=int, default=1000, help='packages sharing the template')
+    parser.add_argument('--custom_properties', type=int, default=50,
+                        help='custom properties of the --prop_template file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    nfvpt.logger.addHandler(logging.NullHandler())
+    workdir = tempfile.mkdtemp(prefix='nfvpt-bench-')
+    try:
+        opts = spec_options(workdir)
+        builtin = write_template(os.path.join(workdir, 'builtin.xml'), 0)
+        custom = write_template(os.path.join(workdir, 'custom.xml'), args.custom_properties)
+        for label, path in (('built-in template', builtin),
+                            ('%d custom properties' % args.custom_properties, custom)):
+            print('%s, %d packages' % (label, args.packages))
+            cases, cache = variants(path)
+            expected = render(cases[0][1], opts)
+            for name, get_template in cases:
+                assert render(get_template, opts) == expected
+                copied = best_of(args.repeat, lambda: [get_template() for _ in range(args.packages)])
+                rendered = best_of(args.repeat, lambda: [render(get_template, opts)
+                                                         for _ in range(args.packages)])
+                print('  %-22s %8.1f us/package template  %8.1f us/package rendered' %
+                      (name, copied / args.packages * 1e6, rendered / args.packages * 1e6))
+            # the renders must not have changed the shared parse
+            assert render(lambda: cache.get(path), opts) == expected
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
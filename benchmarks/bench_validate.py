@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Validating a large batch of --newjson specs with the compiled schema and
+# the shared precompiled patterns and frozen tables, next to the old ad-hoc
+# checks (per call sets, uncompiled re.match, stop at the first error) and
+# optionally the schema of a baseline nfvpt.py. Also times is_image_type
+# over the File_Info entries of big manifests.
+#
+#   python benchmarks/bench_validate.py [--specs 10000] [--invalid 0.1]
+#                                       [--baseline other/nfvpt.py]
+
+import argparse
+import copy
+import imp
+import random
+import re
+
+from benchutil import nfvpt, best_of
+
+
+def legacy_validate(spec):
+    # the checks of validate_json & co. before the schema, raising at the
+    # first error like error_handler did
+    for key in ('vnf_type', 'package_filename', 'vnf_version'):
+        if key not in spec:
+            raise ValueError(key)
+    if 'monitored' not in spec['image_properties']:
+        raise ValueError('monitored')
+    for key in ('vnf_name', 'app_vendor'):
+        if key not in spec:
+            raise ValueError(key)
+    for image in spec['image_list']:
+        if len(image['image_name']) > 5 and image['image_name'][len(image['image_name'])-6:] != '.qcow2':
+            raise ValueError('image_name')
+    if 'bootstrap' in spec and 'file_list' in spec['bootstrap']:
+        if 'ha_capable' in spec['resource_properties']:
+            if spec['resource_properties']['ha_capable'] and len(spec['bootstrap']['file_list']) < 2:
+                raise ValueError('file_list')
+            if not spec['resource_properties']['ha_capable'] and len(spec['bootstrap']['file_list']) < 1:
+                raise ValueError('file_list')
+        for bfile in spec['bootstrap']['file_list']:
+            if 'parse' in bfile and bfile['parse'] != True and bfile['parse'] != False:
+                raise ValueError('parse')
+    allowed_vnf_types = set(['FIREWALL', 'ROUTER', 'LOADBALANCER', 'OTHER', 'vWAAS', 'vWLC', 'WLC'])
+    if spec['vnf_type'] not in allowed_vnf_types:
+        raise ValueError('vnf_type')
+    version = spec['vnf_version']
+    if not (version[0] != '.' and version[len(version)-1] != '.' and bool(re.match('^[0-9.]+$', version))):
+        raise ValueError('vnf_version')
+    for key in {'package_filename', 'vnf_name', 'vnf_type', 'vnf_version'}:
+        if not bool(re.match('^[a-zA-Z0-9.-]+$', spec[key])):
+            raise ValueError(key)
+    for flag in {'sriov', 'monitored', 'console_type_serial', 'privilege'}:
+        if flag in spec['image_properties'] and spec['image_properties'][flag] != True \
+                and spec['image_properties'][flag] != False:
+            raise ValueError(flag)
+    if 'bootup_time' in spec['image_properties'] and not (600 <= spec['image_properties']['bootup_time'] <= 3000):
+        raise ValueError('bootup_time')
+    resources = spec['resource_properties']
+    if 'vnic_max' in resources and not (8 <= resources['vnic_max'] <= 256):
+        raise ValueError('vnic_max')
+    if 'mgmt_vnic' in resources or 'ha_vnic' in resources:
+        if not (0 <= resources['mgmt_vnic'] <= resources['vnic_max']):
+            raise ValueError('mgmt_vnic')
+    if 'bootstrap' in spec:
+        if 'bootstrap_cloud_init_bus_type' in spec['bootstrap']:
+            bus_types = set(['virtio', 'scsi', 'ide'])
+            if spec['bootstrap']['bootstrap_cloud_init_bus_type'] not in bus_types:
+                raise ValueError('bootstrap_cloud_init_bus_type')
+    for volume in spec.get('volumes', []):
+        if volume.get('deviceType', 'disk') != 'disk' and volume['deviceType'] != 'cdrom':
+            raise ValueError('deviceType')
+        if 'format' in volume and volume['format'] not in ('qcow2', 'raw', 'vmdk'):
+            raise ValueError('format')
+
+
+BASE_SPEC = {
+    "vnf_type": "ROUTER", "package_filename": "isrv", "vnf_version": "17.3", "vnf_name": "isrv",
+    "app_vendor": "cisco", "package_output_dir": "/tmp",
+    "image_properties": {"monitored": True, "bootup_time": 600, "privilege": False, "sriov": True},
+    "resource_properties": {"vnic_max": 8, "mgmt_vnic": 0, "ha_capable": False},
+    "image_list": [{"image_name": "root.qcow2", "path": "/tmp", "disk": "root"},
+                   {"image_name": "eph1.qcow2", "path": "/tmp", "disk": "ephemeral1"}],
+    "bootstrap": {"bootstrap_cloud_init_bus_type": "virtio",
+                  "file_list": [{"name": "day0.cfg", "path": "/tmp", "mnt_point": "/", "parse": True,
+                                 "ha_mode": "standalone"}]},
+    "volumes": [{"size": "10", "sizeunit": "GiB", "deviceType": "disk", "format": "qcow2"}],
+}
+
+
+def make_specs(count, invalid, seed=1):
+    rnd = random.Random(seed)
+    specs = []
+    for n in range(count):
+        spec = copy.deepcopy(BASE_SPEC)
+        spec['package_filename'] = 'isrv-%d' % n
+        spec['vnf_version'] = '%d.%d.%d' % (rnd.randint(1, 20), rnd.randint(0, 9), n)
+        if rnd.random() < invalid:
+            spec['vnf_version'] += '.'
+        specs.append(spec)
+    return specs
+
+
+def run_legacy(specs):
+    errors = 0
+    for spec in specs:
+        try:
+            legacy_validate(spec)
+        except ValueError:
+            errors += 1
+    return errors
+
+
+def run_schema(specs, module=nfvpt):
+    validator = module.spec_validator()
+    return sum(1 for spec in specs if validator.validate(spec))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='--newjson spec validation throughput')
+    parser.add_argument('--specs', type=int, default=10000)
+    parser.add_argument('--invalid', type=float, default=0.1, help='share of invalid specs')
+    parser.add_argument('--file_info', type=int, default=100000,
+                        help='File_Info entries classified by is_image_type')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help='nfvpt.py whose schema to compare, e.g. of an older checkout')
+    args = parser.parse_args()
+
+    specs = make_specs(args.specs, args.invalid)
+    assert run_legacy(specs) == run_schema(specs)
+    legacy = best_of(args.repeat, run_legacy, specs)
+    schema = best_of(args.repeat, run_schema, specs)
+    print('%d specs, %d invalid' % (len(specs), run_schema(specs)))
+    print('%-28s %8.3f s  %8.1f us/spec' % ('ad-hoc checks', legacy, legacy / len(specs) * 1e6))
+    print('%-28s %8.3f s  %8.1f us/spec  %5.2fx  (all errors reported)' %
+          ('compiled schema', schema, schema / len(specs) * 1e6, legacy / schema))
+    if args.baseline:
+        baseline = imp.load_source('nfvpt_baseline', args.baseline)
+        assert run_schema(specs, baseline) == run_schema(specs)
+        before = best_of(args.repeat, run_schema, specs, baseline)
+        print('%-28s %8.3f s  %8.1f us/spec  (compiled schema %.2fx faster)' %
+              ('baseline schema', before, before / len(specs) * 1e6, before / schema))
+
+    types = ['root_image', 'bootstrap_file', 'image_properties', 'ephemeral_disk1_image', 'ephemeral_disk12_image']
+    entries = [types[n % len(types)] for n in range(args.file_info)]
+    legacy_type = lambda t: t == 'root_image' or re.match('^ephemeral_disk[0-9]+_image$', t) is not None
+    assert [legacy_type(t) for t in entries] == [nfvpt.is_image_type(t) for t in entries]
+    legacy = best_of(args.repeat, lambda: [legacy_type(t) for t in entries])
+    compiled = best_of(args.repeat, lambda: [nfvpt.is_image_type(t) for t in entries])
+    print('%-28s %8.3f s' % ('is_image_type, re.match', legacy))
+    print('%-28s %8.3f s  %5.2fx' % ('is_image_type, precompiled', compiled, legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
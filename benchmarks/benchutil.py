@@ -0,0 +1,104 @@
+# Helpers shared by the nfvpt benchmarks.
+#
+# The benchmarks import nfvpt.py from the repository root, generate their own
+# synthetic inputs and only measure the in-process code paths, so they can be
+# run from a plain checkout:  python benchmarks/bench_compress.py
+
+import os
+import sys
+import time
+import random
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import nfvpt
+
+MB = 1024 * 1024
+
+
+def make_payload(size, compressible=0.5, seed=1):
+    '''
+        make_payload : return size bytes of synthetic disk-image-like data,
+                       a mix of random (incompressible) chunks and
+                       repetitive text so gzip has something to do.
+    '''
+    rnd = random.Random(seed)
+    chunk = 64 * 1024
+    text = (b'interface GigabitEthernet%d\n ip address dhcp\n no shutdown\n' * 1200)[:chunk]
+    parts = []
+    total = 0
+    while total < size:
+        if rnd.random() < compressible:
+            parts.append(text)
+        else:
+            parts.append(os.urandom(chunk))
+        total += chunk
+    return b''.join(parts)[:size]
+
+
+def write_file(path, size, compressible=0.5, seed=1):
+    with open(path, 'wb') as f:
+        f.write(make_payload(size, compressible, seed))
+    return path
+
+
+def write_disk_image(path, size, image_format='qcow2', sparse=False, data_size=None, seed=1):
+    '''
+        write_disk_image : synthetic VM disk of size bytes. A qcow2 image
+                           starts with the QFI magic and holds mostly
+                           incompressible clusters, a raw one starts with an
+                           MBR and compresses better. A sparse image only
+                           has data_size bytes (default size / 16) of data,
+                           spread in 1 MB extents, the rest are holes.
+    '''
+    if image_format == 'qcow2':
+        header, compressible = b'QFI\xfb\x00\x00\x00\x03', 0.2
+    else:
+        header, compressible = b'\x00' * 510 + b'\x55\xaa', 0.6
+    with open(path, 'wb') as f:
+        if not sparse:
+            f.write(header + make_payload(size - len(header), compressible, seed))
+            return path
+        extents = max(1, min(size, data_size or size // 16) // MB)
+        step = size // extents
+        f.write(header)
+        for n in range(extents):
+            f.seek(max(n * step, len(header)))
+            f.write(make_payload(min(MB, size - f.tell()), compressible, seed + n))
+        f.truncate(size)
+    return path
+
+
+class NullSink(object):
+    '''
+        NullSink : file like object that only counts the bytes written.
+    '''
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+
+def best_of(repeat, func, *args, **kwargs):
+    '''
+        best_of : run func repeat times and return the fastest wall time.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
@@ -9,45 +9,172 @@
 
 import os
 import sys
-import argparse
 import re
 import hashlib
 import string
+import stat
+import struct
+import time
+import zlib
+import io
+import errno
+import random
+import threading
+import glob
+import shutil
+import copy
+import signal
+import contextlib
 
 import logging
-from pprint import pprint
-try:
-    import xmltodict
-except ImportError:
-    print('run pip install xmltodict')
 import json
 from itertools import islice
 from collections import OrderedDict
-import tempfile
-import inspect
-import subprocess
 import collections
-BLOCKSIZE = 65536
+try:
+    import pwd
+    import grp
+except ImportError:
+    pwd = grp = None
+
+class LazyModule(object):
+    '''
+        LazyModule : stand-in for a module that is imported the first time
+                     one of its attributes is used, and then replaces itself
+                     with the module in the globals of nfvpt. Every command
+                     so only pays for the imports it needs. An optional
+                     module that isn't installed is false and replaced
+                     with None:  if not zstandard: ...
+    '''
+    def __init__(self, name, optional=False, hint=None):
+        self._name = name
+        self._optional = optional
+        self._hint = hint
+
+    def _load(self):
+        try:
+            module = __import__(self._name)
+        except ImportError:
+            if self._optional:
+                globals()[self._name] = None
+                return None
+            if self._hint:
+                print(self._hint)
+            raise
+        globals()[self._name] = module
+        return module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        if module is None:
+            raise ImportError('No module named %s' % self._name)
+        return getattr(module, attr)
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+argparse = LazyModule('argparse')
+multiprocessing = LazyModule('multiprocessing')
+tarfile = LazyModule('tarfile')
+gzip = LazyModule('gzip')
+tempfile = LazyModule('tempfile')
+Queue = LazyModule('Queue')
+xmltodict = LazyModule('xmltodict', hint='run pip install xmltodict')
+sqlite3 = LazyModule('sqlite3', optional=True)
+zstandard = LazyModule('zstandard', optional=True)
+# read size of the hashing/archiving engine (--block_size) and how much is
+# read before the pages already consumed are dropped from the page cache
+HASH_BLOCK_SIZE = 1 << 20
+# blocks queued per hashing thread of --hash_workers
+HASH_QUEUE_DEPTH = 8
+DROP_BEHIND_SIZE = 64 << 20
+# progress is reported at most every PROGRESS_INTERVAL seconds; the read
+# loops only add up bytes and look at the clock every PROGRESS_STEP bytes
+PROGRESS_INTERVAL = 0.5
+PROGRESS_STEP = 16 << 20
+PROGRESS_MODES = ('auto', 'bar', 'json', 'none')
+PROGRESS_BAR_WIDTH = 30
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+# lseek whence values to find the holes of sparse images (linux values, the
+# python 2 os module doesn't define them)
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+# package members up to this size are converted in memory, bigger ones are
+# spilled to a temporary file
+CONVERT_SPOOL_SIZE = 16 << 20
+# uncompressed bytes per independently deflated block (--compress_threads)
+GZIP_BLOCK_SIZE = 1 << 20
 VERSION = '3.9.1'
 FIRST_DISK_IMAGE = True
-bootstrap_file_num = 1
-disk_file_num = 0
 ACCEPTED_IMG_EXTS = [".iso",".img",".qcow2",".vmdk"]
+# options describing how the package is written (command line, or prepared
+# by --batch); these are kept when the rest of the options come from a
+# --newjson file
+ARCHIVE_OPTIONS = ['no_compress', 'compress', 'compress_level', 'compress_threads', 'compress_report',
+                   'no_cache', 'hash_workers', 'digests', 'block_size', 'keep_page_cache',
+                   'shared_members', 'index', 'progress']
+# validation rules shared by the command line, the --newjson schema and
+# repackage: patterns compiled once and frozen lookup tables
+NAME_RE = re.compile(r'^[a-zA-Z0-9.-]+$')
+VERSION_RE = re.compile(r'^[0-9]([0-9.]*[0-9])?$')
+EPHEMERAL_IMAGE_RE = re.compile(r'^ephemeral_disk[0-9]+_image$')
+MANDATORY_INPUT_RE = re.compile(r'^[a-zA-Z0-9-.-_,]*$')
+PROMPT_STRIP_RE = re.compile(r'[^a-zA-Z0-9 \n.]')
+VNF_TYPES = frozenset(['FIREWALL', 'ROUTER', 'LOADBALANCER', 'OTHER', 'vWAAS', 'vWLC', 'WLC'])
+CLOUD_INIT_DRIVE_TYPES = frozenset(['cdrom', 'disk'])
+CLOUD_INIT_BUS_TYPES = frozenset(['virtio', 'scsi', 'ide'])
+VOLUME_DEVICE_TYPES = frozenset(['disk', 'cdrom'])
+VOLUME_FORMATS = frozenset(['qcow2', 'raw', 'vmdk'])
+NUMBER_TYPES = frozenset([int, long, float])
+# volumes are limited to VOLUME_MAX_GIB; sizes in other units are converted
+# in integers as the tool always did, so up to 256999 MiB pass
+VOLUME_MAX_GIB = 256
+VOLUME_SIZE_GIB = {'MiB': lambda size: size // 1000, 'GiB': lambda size: size,
+                   'TiB': lambda size: size * 1000}
+# bootstrap file ha_mode -> vm attribute
+HA_MODE_VM = {'primary': '1', 'secondary': '2', 'standalone': '0'}
+# stages of a --newjson build, in the order they run
+PACKAGE_STAGES = ('build_from_json', 'make_image_prop_xml', 'buildTargetFile')
+# stages of a package build in a --profile_report
+PROFILE_STAGES = ('parse', 'validate', 'render', 'hash', 'archive', 'cleanup')
+# serve: jobs waiting at most and finished jobs kept
+SERVE_QUEUE_SIZE = 64
+SERVE_MAX_JOBS = 1000
+# checksum cache (--no_cache disables it): entries kept and max age in days
+CHECKSUM_CACHE_MAX_ENTRIES = 4096
+CHECKSUM_CACHE_MAX_AGE = 30
+# files smaller than this are cheaper to hash than to look up
+CHECKSUM_CACHE_MIN_SIZE = 1 << 20
+# bytes rehashed at the start, middle and end of a file before a cached
+# checksum is used, and the version of the cache database layout
+CHECKSUM_PROBE_SIZE = 64 * 1024
+CHECKSUM_CACHE_SCHEMA = 2
+# checksums package.mf can carry, in the order they are written per File_Info
+SUPPORTED_DIGESTS = ['sha1', 'sha256']
+DEFAULT_DIGESTS = ['sha256']
+# codec: (package extension, default level)
+ARCHIVE_CODECS = OrderedDict([('none', ('.tar', None)),
+                              ('gzip', ('.tar.gz', 6)),
+                              ('zstd', ('.tar.zst', 3))])
+# --index: sidecar of the package, <package>.idx, with where every member starts
+PACKAGE_INDEX_SUFFIX = '.idx'
 INTERNAL_ERROR = "InternalServerError"
 VALIDATION_ERROR = "ValidationError"
 PACKAGE_CONTENTS_TAG = "PackageContents"
 FILE_INFO_TAG = "File_Info"
+PACKAGING_VERSION_TAG = "Packaging_Version"
 FILE_INFO_TYPE_TAG = "type"
 BOOTSTRAP_FILE_TYPE_PREFIX = "bootstrap_file"
 FILE_INFO_NAME_TAG = "name"
 ASCII_CHARSET = "ascii"
 
 logger = logging.getLogger(__name__)
+# warnings are logged outside of --log_dir runs too, keep python 2 quiet about it
+logger.addHandler(logging.NullHandler())
 image_prop_file = "image_properties.xml"
 sys_gen_prop = "system_generated_properties.xml"
 pkgmf_file = "package.mf"
-bsfile_list=[]
-bootstrap_sources = []
 image_properties_template_contents = """<?xml version="1.0" encoding="UTF-8"?>
 <image_properties>
     <vnf_type></vnf_type>
@@ -106,12 +233,353 @@ error_messages = {
     "bootup_time":"Invalid bootup_time. Can only be between 600 and 3000"
 }
 
-def createPackageMF(outdir,version):
-    global pkgmf_file
-    pkgmf_file = os.path.join(outdir, pkgmf_file)
-    pkg_mf_file  = open(pkgmf_file, "w")
+class PackagingError(Exception):
+    '''
+        PackagingError : a packaging failure. Errors found in the input carry
+                         the errorCode (line), errorType and key fields of
+                         the JSON error the tool prints; the others only a
+                         message, with errorCode None.
+    '''
+    def __init__(self, message, code=None, etype=INTERNAL_ERROR, key=None):
+        Exception.__init__(self, message)
+        self.errorMessage = message
+        self.errorCode = None if code is None else str(code)
+        self.errorType = etype
+        self.key = key
+
+    def to_json(self):
+        return ('{"errorCode":"' + str(self.errorCode) + '", "errorType":"' + self.errorType +
+                '", "errorMessage":"' + self.errorMessage + '", "key":"' + str(self.key) + '"}')
+
+    def to_dict(self):
+        return OrderedDict([('errorCode', self.errorCode), ('errorType', self.errorType),
+                            ('errorMessage', self.errorMessage), ('key', self.key)])
+
+class PackageValidationError(PackagingError):
+    '''
+        PackageValidationError : invalid spec or options (ValidationError).
+    '''
+    def __init__(self, message, code=None, key=None):
+        PackagingError.__init__(self, message, code, VALIDATION_ERROR, key)
+
+class PackageInternalError(PackagingError):
+    '''
+        PackageInternalError : missing files or directories and other
+                               failures not caused by the spec itself
+                               (InternalServerError).
+    '''
+    def __init__(self, message, code=None, key=None):
+        PackagingError.__init__(self, message, code, INTERNAL_ERROR, key)
+
+class BuildContext(object):
+    '''
+        BuildContext : state of one package build - the bootstrap files
+                       collected from the options, where the generated files
+                       are written and the disk/bootstrap counters used to
+                       type the package.mf entries. Every build gets its own,
+                       so several packages can be built in one process.
+    '''
+    def __init__(self):
+        self.bootstrap_sources = []
+        self.bsfile_list = []
+        self.image_prop_file = image_prop_file
+        self.sys_gen_prop = sys_gen_prop
+        self.pkgmf_file = pkgmf_file
+        self.disk_file_num = 0
+        self.bootstrap_file_num = 1
+        # BuildProfile of a --profile_report build
+        self.profile = None
+        # Progress of the package being hashed and archived
+        self.progress = None
+
+def build_context(opts):
+    '''
+        build_context : the BuildContext of the build opts describe, created
+                        with the first use.
+    '''
+    if 'ctx' not in opts:
+        opts['ctx'] = BuildContext()
+    return opts['ctx']
+
+class BuildProfile(object):
+    '''
+        BuildProfile : where the time of one package build went, for
+                       --profile_report: the seconds per PROFILE_STAGES
+                       stage, the throughput of every file hashed and the
+                       bytes in and out of the archive. Set it as the
+                       profile of the BuildContext to record a build.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict((stage, 0.0) for stage in PROFILE_STAGES)
+        # (name, bytes, seconds) of every member hashed
+        self.hashed = []
+        self.archive = None
+
+    def add_archive(self, archive):
+        '''
+            add_archive : account a closed PackageArchive: the time its
+                          members spent hashing goes to the hash stage, the
+                          rest to the archive stage. Members hashed on
+                          --hash_workers threads were hashed while they were
+                          written, that time counts for both stages.
+        '''
+        members = archive.report or []
+        hash_seconds = sum(item['hash_seconds'] for item in members)
+        inline_seconds = sum(item['hash_seconds'] for item in members if not item['hash_threaded'])
+        seconds = sum(item['seconds'] for item in members) + archive.close_seconds - inline_seconds
+        self.stages['hash'] += hash_seconds
+        self.stages['archive'] += seconds
+        for item in members:
+            if item['hash_seconds']:
+                self.hashed.append((item['name'], item['size'], item['hash_seconds']))
+        bytes_in = sum(item['size'] for item in members)
+        bytes_out = os.path.getsize(archive.filename)
+        self.archive = OrderedDict([
+            ('package', os.path.basename(archive.filename)), ('codec', archive.codec),
+            ('level', archive.level), ('bytes_in', bytes_in), ('bytes_out', bytes_out),
+            ('ratio', float(bytes_out) / bytes_in if bytes_in else 0.0), ('seconds', seconds),
+            ('bytes_per_second', bytes_in / seconds if seconds else 0.0),
+            ('members', [OrderedDict([('name', item['name']), ('bytes', item['size']),
+                                      ('stored', item['stored']),
+                                      ('seconds', item['seconds'] -
+                                                  (0.0 if item['hash_threaded'] else item['hash_seconds']))])
+                         for item in members])])
+
+    def to_dict(self):
+        hashed = [OrderedDict([('name', name), ('bytes', size), ('seconds', seconds),
+                               ('bytes_per_second', size / seconds if seconds else 0.0)])
+                  for name, size, seconds in self.hashed]
+        return OrderedDict([
+            ('version', VERSION),
+            ('package', self.archive['package'] if self.archive else None),
+            ('seconds', time.time() - self.start),
+            ('stages', self.stages),
+            ('hash', OrderedDict([('bytes', sum(item['bytes'] for item in hashed)),
+                                  ('seconds', self.stages['hash']), ('files', hashed)])),
+            ('archive', self.archive)])
+
+@contextlib.contextmanager
+def profile_stage(opts, stage):
+    '''
+        profile_stage : add the time spent in the with block to the stage of
+                        the BuildProfile of the build, when it has one.
+    '''
+    profile = build_context(opts).profile
+    start = time.time()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.stages[stage] += time.time() - start
 
-    pkg_mf_file.write("<!-- sha256sum - for calculating checksum -->\n")
+def _metric_labels(**labels):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"' % (key, escape(labels[key])) for key in sorted(labels))
+
+def profile_metrics(profiles):
+    '''
+        profile_metrics : the BuildProfile dicts as Prometheus text format
+                          metrics, labelled with the package and VERSION.
+    '''
+    metrics = OrderedDict([
+        ('nfvpt_build_seconds', ('Wall time of the package build.', [])),
+        ('nfvpt_stage_seconds', ('Time spent per package build stage.', [])),
+        ('nfvpt_hash_bytes_per_second', ('Hashing throughput per file.', [])),
+        ('nfvpt_archive_bytes_in', ('Bytes written to the package archive.', [])),
+        ('nfvpt_archive_bytes_out', ('Size of the package.', [])),
+        ('nfvpt_archive_compression_ratio', ('Package size over the bytes archived.', [])),
+        ('nfvpt_archive_bytes_per_second', ('Archiving throughput.', [])),
+    ])
+    for profile in profiles:
+        package = profile['package'] or ''
+        labels = dict(package=package, version=profile['version'])
+        metrics['nfvpt_build_seconds'][1].append((labels, profile['seconds']))
+        for stage, seconds in profile['stages'].items():
+            metrics['nfvpt_stage_seconds'][1].append((dict(labels, stage=stage), seconds))
+        for item in profile['hash']['files']:
+            metrics['nfvpt_hash_bytes_per_second'][1].append((dict(labels, file=item['name']),
+                                                              item['bytes_per_second']))
+        if profile['archive']:
+            for key in ('bytes_in', 'bytes_out', 'ratio', 'bytes_per_second'):
+                name = 'nfvpt_archive_compression_ratio' if key == 'ratio' else 'nfvpt_archive_' + key
+                metrics[name][1].append((labels, profile['archive'][key]))
+    lines = []
+    for name, (description, samples) in metrics.items():
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in samples:
+            lines.append('%s{%s} %r' % (name, _metric_labels(**labels), float(value)))
+    return '\n'.join(lines) + '\n'
+
+def write_profile_report(opts, profiles):
+    '''
+        write_profile_report : write the BuildProfile dicts of a build (or of
+                               every package of a --batch) to the
+                               --profile_report JSON file and the
+                               --profile_metrics Prometheus textfile.
+    '''
+    if opts.get('profile_report'):
+        with open(opts['profile_report'], 'w') as f:
+            json.dump(OrderedDict([('version', VERSION), ('packages', profiles)]), f, indent=2)
+        logger.info("profile report written to %s" % opts['profile_report'])
+    if opts.get('profile_metrics'):
+        # written aside and renamed, the textfile collector may read it any time
+        tmp = opts['profile_metrics'] + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(profile_metrics(profiles))
+        os.rename(tmp, opts['profile_metrics'])
+
+class Progress(object):
+    '''
+        Progress : bytes hashed and archived of one package, reported to
+                   callback as a dict (package, phase, member, bytes,
+                   total, bytes_per_second, eta, status) when a phase
+                   starts and ends and at most every interval seconds in
+                   between. advance is called from the read loops: it adds
+                   up and reads the clock every PROGRESS_STEP bytes only.
+    '''
+    def __init__(self, callback, package=None, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.package = package
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.phase = None
+        self.member = None
+        self.total = 0
+        self.done = 0
+        self.started = self.reported = time.time()
+        self.next_check = PROGRESS_STEP
+
+    def start(self, phase, total):
+        '''
+            start : a phase (hash, archive) of total bytes begins.
+        '''
+        with self.lock:
+            self.phase = phase
+            self.member = None
+            self.total = total
+            self.done = 0
+            self.next_check = PROGRESS_STEP
+            self.started = time.time()
+        self._report('running')
+
+    def start_member(self, name, size):
+        '''
+            start_member : name is read next; a member the total of the
+                           phase did not count extends it.
+        '''
+        with self.lock:
+            self.member = name
+            self.total = max(self.total, self.done + size)
+
+    def advance(self, count):
+        with self.lock:
+            self.done += count
+            if self.done < self.next_check:
+                return
+            self.next_check = self.done + PROGRESS_STEP
+        if time.time() - self.reported >= self.interval:
+            self._report('running')
+
+    def finish(self, status='done'):
+        self._report(status)
+
+    def _report(self, status):
+        with self.lock:
+            now = self.reported = time.time()
+            elapsed = now - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            remaining = max(self.total - self.done, 0)
+            event = OrderedDict([('package', self.package), ('phase', self.phase),
+                                 ('member', self.member), ('bytes', self.done), ('total', self.total),
+                                 ('bytes_per_second', rate),
+                                 ('eta', remaining / rate if rate else None), ('status', status)])
+        self.callback(event)
+
+def _human_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return '%.1f %s' % (count, unit)
+        count /= 1024.0
+    return '%.1f TiB' % count
+
+class ProgressBar(object):
+    '''
+        ProgressBar : Progress callback drawing one line on a terminal,
+                      redrawn in place and ended when a phase is over.
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.width = 0
+
+    def __call__(self, event):
+        fraction = float(event['bytes']) / event['total'] if event['total'] else 1.0
+        filled = int(fraction * PROGRESS_BAR_WIDTH)
+        if event['eta'] is None:
+            eta = '--:--:--'
+        else:
+            eta = '%d:%02d:%02d' % (event['eta'] // 3600, event['eta'] % 3600 // 60, event['eta'] % 60)
+        line = '%-7s [%s%s] %5.1f%%  %s/%s  %s/s  ETA %s  %s' % (
+            event['phase'], '#' * filled, '.' * (PROGRESS_BAR_WIDTH - filled), fraction * 100,
+            _human_bytes(event['bytes']), _human_bytes(event['total']),
+            _human_bytes(event['bytes_per_second']), eta, event['member'] or '')
+        self.stream.write('\r' + line.ljust(self.width))
+        self.width = len(line)
+        if event['status'] != 'running':
+            self.stream.write('\n')
+            self.width = 0
+        self.stream.flush()
+
+class JsonProgress(object):
+    '''
+        JsonProgress : Progress callback writing every event as a JSON line,
+                       for machine consumers of --progress json.
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+def progress_callback(progress):
+    '''
+        progress_callback : the callback of a --progress mode (auto draws a
+                            bar when stderr is a terminal), or the callable
+                            given to the library as progress.
+    '''
+    if callable(progress):
+        return progress
+    if progress == 'auto':
+        progress = 'bar' if sys.stderr.isatty() else 'none'
+    if progress == 'bar':
+        return ProgressBar()
+    if progress == 'json':
+        return JsonProgress()
+    return None
+
+def batch_progress(options):
+    '''
+        batch_progress : packages built on several processes at once can't
+                         share a terminal line; keep only --progress json.
+    '''
+    if options.get('progress') != 'json':
+        options.pop('progress', None)
+
+def manifest_comment(digests):
+    # as the tool always wrote it: repackage names sha1sum when the package
+    # carries sha1 checksums, everything else sha256sum
+    main_digest = 'sha1' if 'sha1' in digests else 'sha256'
+    return "<!-- %ssum - for calculating checksum -->\n" % main_digest
+
+def createPackageMF(ctx,outdir,version,digests=DEFAULT_DIGESTS):
+    ctx.pkgmf_file = os.path.join(outdir, ctx.pkgmf_file)
+    pkg_mf_file  = open(ctx.pkgmf_file, "w")
+
+    pkg_mf_file.write(manifest_comment(digests))
 
     pkg_mf_file.write("<PackageContents>\n")
     if version:
@@ -123,19 +591,18 @@ def closePackageMF(pkg_mf_file):
     pkg_mf_file.write("</PackageContents> \n")
     pkg_mf_file.close()
 
-def updatePackageMF(filename, file, opt, chksum,ha_package):
-    global disk_file_num, bootstrap_file_num
+def updatePackageMF(ctx, filename, file, opt, chksum,ha_package):
     str1 = "  <File_Info> \n"
     filename.write(str1)
-    str1 = "    <name>" + file + "</name>" + "\n"
+    str1 = "    <name>" + manifest_escape(file) + "</name>" + "\n"
     filename.write(str1)
     if opt == "disk_img_names":
-      if disk_file_num == 0:
+      if ctx.disk_file_num == 0:
         str1 = "    <type>root_image</type>\n"
-        disk_file_num = disk_file_num+1
+        ctx.disk_file_num = ctx.disk_file_num+1
       else:
-        str1 = "    <type>ephemeral_disk%s_image</type>\n"%disk_file_num
-        disk_file_num = disk_file_num+1
+        str1 = "    <type>ephemeral_disk%s_image</type>\n"%ctx.disk_file_num
+        ctx.disk_file_num = ctx.disk_file_num+1
     elif opt == "image_properties":
         str1 = "    <type>image_properties</type>\n"
     elif opt == "system_generated_properties":
@@ -144,51 +611,1281 @@ def updatePackageMF(filename, file, opt, chksum,ha_package):
         if (ha_package):
             str1 = "    <type>bootstrap_file</type>\n"
         else:
-            str1 = "    <type>bootstrap_file_%s</type>\n"%bootstrap_file_num
-            bootstrap_file_num = bootstrap_file_num+1
+            str1 = "    <type>bootstrap_file_%s</type>\n"%ctx.bootstrap_file_num
+            ctx.bootstrap_file_num = ctx.bootstrap_file_num+1
     else:
        str1 = "    <type>unknown</type>\n"
 
     filename.write(str1)
 
-    str1 = "    <sha256_checksum>" + chksum + "</sha256_checksum>\n"
-    filename.write(str1)
+    if not isinstance(chksum, dict):
+        chksum = {'sha256': chksum}
+    for algo in sorted(chksum, key=SUPPORTED_DIGESTS.index):
+        str1 = "    <%s_checksum>" % algo + chksum[algo] + "</%s_checksum>\n" % algo
+        filename.write(str1)
 
     str1 = "  </File_Info>\n"
     filename.write(str1)
 
-def sha1sum(filename):
-    hasher = hashlib.sha1()
-    with open(filename, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
+def manifest_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def iter_manifest(fileobj):
+    '''
+        iter_manifest : read a package.mf incrementally, yielding its top
+                        level elements as (tag, value): an OrderedDict of the
+                        child elements for File_Info, the text otherwise.
+                        Elements are dropped once yielded, so big manifests
+                        are never held in memory as a whole.
+    '''
+    from xml.etree import cElementTree
+    depth = 0
+    root = None
+    for event, elem in cElementTree.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                if elem.tag != PACKAGE_CONTENTS_TAG:
+                    raise ValueError("Invalid package manifest file format. Expecting tag %s" %
+                                     PACKAGE_CONTENTS_TAG)
+                root = elem
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag == FILE_INFO_TAG:
+            yield elem.tag, OrderedDict((child.tag, (child.text or '').strip() or None) for child in elem)
+        else:
+            yield elem.tag, (elem.text or '').strip() or None
+        root.clear()
+
+class ManifestWriter(object):
+    '''
+        ManifestWriter : package.mf built in a buffer, with its values
+                         escaped, for one write to the package:
+
+                             writer = ManifestWriter(digests)
+                             writer.element('Packaging_Version', '1.0')
+                             writer.file_info(record)
+                             archive.addbytes(pkgmf_file, writer.getvalue())
+    '''
+    def __init__(self, digests):
+        self.buffer = io.StringIO()
+        self.buffer.write(unicode(manifest_comment(digests)))
+        self.buffer.write(u'<%s>\n' % PACKAGE_CONTENTS_TAG)
+
+    def _write(self, indent, tag, value):
+        value = u'' if value is None else manifest_escape(unicode(value))
+        self.buffer.write(u'%s<%s>%s</%s>\n' % (indent, tag, value, tag))
+
+    def element(self, tag, value):
+        self._write(u'\t', tag, value)
+
+    def file_info(self, record):
+        self.buffer.write(u'\t<%s>\n' % FILE_INFO_TAG)
+        for tag, value in record.items():
+            self._write(u'\t\t', tag, value)
+        self.buffer.write(u'\t</%s>\n' % FILE_INFO_TAG)
+
+    def getvalue(self):
+        return (self.buffer.getvalue() + u'</%s>' % PACKAGE_CONTENTS_TAG).encode('utf-8')
+
+def manifest_bytes(entries, file_info, digests):
+    '''
+        manifest_bytes : the package.mf rewritten from the top level entries
+                         of iter_manifest, with all its File_Info replaced
+                         by the records of file_info, where the first one was.
+    '''
+    writer = ManifestWriter(digests)
+    written = False
+    for tag, value in entries:
+        if tag != FILE_INFO_TAG:
+            writer.element(tag, value)
+        elif not written:
+            for record in file_info:
+                writer.file_info(record)
+            written = True
+    if not written:
+        for record in file_info:
+            writer.file_info(record)
+    return writer.getvalue()
+
+def _file_identity(st):
+    '''
+        _file_identity : (dev, inode, size, mtime, ctime) of a stat result,
+                         the times at the highest resolution the platform
+                         reports. Writing to a file or setting its mtime back
+                         (touch -r, cp -p, rsync --inplace) moves its ctime,
+                         which can't be set from user space.
+    '''
+    times = []
+    for name in ('st_mtime', 'st_ctime'):
+        value = getattr(st, name + '_ns', None)
+        if value is None:
+            value = int(getattr(st, name) * 1000000000)
+        times.append(str(value))
+    return (st.st_dev, st.st_ino, st.st_size) + tuple(times)
+
+def _probe_digest(path, size):
+    '''
+        _probe_digest : sha256 of the first, middle and last
+                        CHECKSUM_PROBE_SIZE bytes of path, the sample a
+                        cached checksum is checked against before it is used.
+    '''
+    hasher = hashlib.sha256(str(size))
+    with open(path, 'rb') as afile:
+        for offset in sorted(set([0, max(0, size // 2 - CHECKSUM_PROBE_SIZE // 2),
+                                  max(0, size - CHECKSUM_PROBE_SIZE)])):
+            afile.seek(offset)
+            hasher.update(afile.read(CHECKSUM_PROBE_SIZE))
     return hasher.hexdigest()
 
-def sha256sum(filename):
-    hasher = hashlib.sha256()
-    ascii_filename = filename.encode('ascii', 'ignore')
-    with open(ascii_filename, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
+class ChecksumCache(object):
+    '''
+        ChecksumCache : persistent checksum store (sqlite) keyed by the file
+                        identity (dev, inode, size, mtime, ctime) and
+                        algorithm. A cached checksum is only returned after
+                        rehashing a sample of the file (_probe_digest), so
+                        the archive skips hashing unchanged images, e.g. when
+                        repackaging the same base images with different
+                        bootstrap files, and a build whose images are all
+                        cached can write package.mf first.
+                        Entries not used for CHECKSUM_CACHE_MAX_AGE days or
+                        beyond the CHECKSUM_CACHE_MAX_ENTRIES most recently
+                        used ones are evicted.
+    '''
+    def __init__(self, path=None, max_entries=CHECKSUM_CACHE_MAX_ENTRIES,
+                 max_age=CHECKSUM_CACHE_MAX_AGE):
+        if path is None:
+            path = default_checksum_cache_path()
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != CHECKSUM_CACHE_SCHEMA:
+                # entries of older versions lack the ctime and the probe
+                self.db.execute('DROP TABLE IF EXISTS checksums')
+                self.db.execute('PRAGMA user_version = %d' % CHECKSUM_CACHE_SCHEMA)
+            self.db.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                            'dev INTEGER, ino INTEGER, size INTEGER, mtime TEXT, ctime TEXT, '
+                            'algo TEXT, digest TEXT, probe TEXT, path TEXT, last_used REAL, '
+                            'PRIMARY KEY (dev, ino, size, mtime, ctime, algo))')
+            self.db.commit()
+
+    def lookup(self, path, algos, st=None):
+        '''
+            lookup : {algo: hex digest} of the algos cached for path, empty
+                     when the file is not in the cache or changed since it
+                     was hashed. Entries whose sample doesn't match the file
+                     anymore are dropped.
+        '''
+        identity = _file_identity(st or os.stat(path))
+        where = 'dev=? AND ino=? AND size=? AND mtime=? AND ctime=?'
+        with self.lock:
+            rows = self.db.execute('SELECT algo, digest, probe FROM checksums WHERE ' + where,
+                                   identity).fetchall()
+        rows = [row for row in rows if row[0] in algos]
+        if not rows:
+            return {}
+        try:
+            probe = _probe_digest(path, identity[2])
+        except (IOError, OSError):
+            return {}
+        with self.lock:
+            if any(row[2] != probe for row in rows):
+                logger.info("%s changed since it was hashed, dropping its cached checksums" % path)
+                self.db.execute('DELETE FROM checksums WHERE ' + where, identity)
+                self.db.commit()
+                return {}
+            self.db.execute('UPDATE checksums SET last_used=? WHERE ' + where, (time.time(),) + identity)
+            self.db.commit()
+        return dict((str(algo), str(digest)) for algo, digest, probe in rows)
+
+    def store(self, path, checksums, st):
+        '''
+            store : remember the {algo: hex digest} checksums of path as it
+                    was when st was taken; nothing is stored if the file
+                    changed meanwhile.
+        '''
+        identity = _file_identity(st)
+        probe = _probe_digest(path, st.st_size)
+        if _file_identity(os.stat(path)) != identity:
+            return
+        with self.lock:
+            for algo, digest in checksums.items():
+                self.db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                identity + (algo, digest, probe, os.path.abspath(path), time.time()))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        self.db.execute('DELETE FROM checksums WHERE last_used < ?',
+                        (time.time() - self.max_age * 86400,))
+        self.db.execute('DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums '
+                        'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def verify(self, sample):
+        '''
+            verify : rehash a random sample of the cached files in full and
+                     drop the entries that are stale (file gone, replaced,
+                     or a different checksum). Returns a list of
+                     (path, algo, status) tuples.
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT dev, ino, size, mtime, ctime, algo, digest, path FROM checksums '
+                                   'ORDER BY RANDOM() LIMIT ?', (sample,)).fetchall()
+        results = []
+        for row in rows:
+            key, digest, path = tuple(row[:6]), row[6], row[7]
+            status = 'ok'
+            try:
+                st = os.stat(path)
+                if _file_identity(st) + (key[5],) != key:
+                    status = 'stale'
+                elif hash_file(path, key[5]) != digest:
+                    status = 'mismatch'
+            except (IOError, OSError):
+                status = 'missing'
+            if status != 'ok':
+                with self.lock:
+                    self.db.execute('DELETE FROM checksums WHERE dev=? AND ino=? AND size=? '
+                                    'AND mtime=? AND ctime=? AND algo=?', key)
+                    self.db.commit()
+            results.append((path, key[5], status))
+        return results
+
+def default_checksum_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'nfvpt', 'checksums.db')
+
+_checksum_cache = None
+_checksum_cache_lock = threading.Lock()
+
+def get_checksum_cache(opts):
+    '''
+        get_checksum_cache : process wide ChecksumCache, or None when disabled
+                             with --no_cache or when it can't be opened.
+    '''
+    global _checksum_cache
+    if opts.get('no_cache') or not sqlite3:
+        return None
+    with _checksum_cache_lock:
+        if _checksum_cache is None:
+            try:
+                _checksum_cache = ChecksumCache()
+            except (OSError, IOError, sqlite3.Error) as e:
+                logger.info("Checksum cache disabled: %s" % e)
+                opts['no_cache'] = True
+                return None
+    return _checksum_cache
+
+class MultiHasher(object):
+    '''
+        MultiHasher : feeds every block to one hasher per requested
+                      algorithm, so sha1 and sha256 come from a single read.
+    '''
+    def __init__(self, algos):
+        self.hashers = [(algo, hashlib.new(algo)) for algo in algos]
+        self.seconds = 0.0
+
+    def update(self, buf):
+        start = time.time()
+        for algo, hasher in self.hashers:
             hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-    return hasher.hexdigest()
+        self.seconds += time.time() - start
+
+    def update_zeros(self, count):
+        '''
+            update_zeros : feed count NUL bytes, for the holes of sparse
+                           images, from a shared zero block instead of
+                           reading them from the file.
+        '''
+        block = _zero_block()
+        while count > 0:
+            self.update(block[:min(count, len(block))])
+            count -= len(block)
+
+    def hexdigests(self):
+        return dict((algo, hasher.hexdigest()) for algo, hasher in self.hashers)
+
+    def close(self):
+        pass
+
+class ThreadedHasher(object):
+    '''
+        ThreadedHasher : MultiHasher whose algorithms run on up to workers
+                         threads, fed through bounded queues, so a member is
+                         hashed while the archive compresses and writes it
+                         (--hash_workers). hashlib releases the GIL on large
+                         updates. The blocks are hashed after update returns,
+                         so they must not be reused buffers.
+    '''
+    def __init__(self, algos, workers):
+        count = max(1, min(workers, len(algos)))
+        self.hashers = [MultiHasher(algos[n::count]) for n in range(count)]
+        self.queues = [Queue.Queue(HASH_QUEUE_DEPTH) for hasher in self.hashers]
+        self.threads = []
+        for hasher, queue in zip(self.hashers, self.queues):
+            thread = threading.Thread(target=self._run, args=(hasher, queue))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.seconds = 0.0
+
+    @staticmethod
+    def _run(hasher, queue):
+        buf = queue.get()
+        while buf is not None:
+            hasher.update(buf)
+            buf = queue.get()
+
+    def update(self, buf):
+        for queue in self.queues:
+            queue.put(buf)
+
+    def update_zeros(self, count):
+        block = _zero_block()
+        while count > 0:
+            self.update(block[:min(count, len(block))])
+            count -= len(block)
+
+    def close(self):
+        '''
+            close : wait for the threads to hash what they were given;
+                    seconds is then the time the busiest one spent hashing.
+        '''
+        if not self.threads:
+            return
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.seconds = max(hasher.seconds for hasher in self.hashers)
+
+    def hexdigests(self):
+        self.close()
+        digests = {}
+        for hasher in self.hashers:
+            digests.update(hasher.hexdigests())
+        return digests
+
+_zeros = None
+
+def _zero_block():
+    global _zeros
+    if _zeros is None:
+        _zeros = memoryview(bytes(bytearray(HASH_BLOCK_SIZE)))
+    return _zeros
+
+_libc_fadvise = None
+
+def _fadvise(fd, offset, length, advice):
+    '''
+        _fadvise : page cache hint through os.posix_fadvise, or libc when the
+                   python version doesn't have it. It's only a hint, so it
+                   silently does nothing where it isn't supported.
+    '''
+    global _libc_fadvise
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+        return
+    if _libc_fadvise is None:
+        try:
+            import ctypes
+            _libc_fadvise = ctypes.CDLL(None).posix_fadvise
+            _libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+        except (ImportError, OSError, AttributeError):
+            _libc_fadvise = False
+    if _libc_fadvise:
+        _libc_fadvise(fd, offset, length, advice)
+
+class FileReader(object):
+    '''
+        FileReader : sequential reader for large package members. It reads
+                     block_size bytes per syscall, tells the kernel the access
+                     is sequential and, with drop_cache, drops the pages it
+                     already consumed every DROP_BEHIND_SIZE bytes, so that
+                     packaging a 16 GB image doesn't evict the rest of the
+                     host's page cache.
+    '''
+    def __init__(self, path, block_size=None, drop_cache=True):
+        self.block_size = block_size or HASH_BLOCK_SIZE
+        self.drop_cache = drop_cache
+        self.fileobj = io.open(path, 'rb', buffering=0)
+        self.fd = self.fileobj.fileno()
+        self.offset = 0
+        self.dropped = 0
+        self._extents = None
+        _fadvise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def extents(self):
+        '''
+            extents : [(offset, length)] of the data regions of the file,
+                      found with SEEK_DATA/SEEK_HOLE. Files that use all their
+                      blocks and filesystems that can't tell where the holes
+                      are give a single extent covering the whole file.
+        '''
+        if self._extents is not None:
+            return self._extents
+        st = os.fstat(self.fd)
+        self._extents = [(0, st.st_size)] if st.st_size else []
+        if st.st_blocks * 512 >= st.st_size:
+            return self._extents
+        extents = []
+        pos = 0
+        try:
+            while pos < st.st_size:
+                try:
+                    start = os.lseek(self.fd, pos, SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # only a hole left up to the end of the file
+                        break
+                    raise
+                pos = os.lseek(self.fd, start, SEEK_HOLE)
+                extents.append((start, pos - start))
+            self._extents = extents
+        except OSError:
+            pass
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        return self._extents
+
+    def regions(self):
+        '''
+            regions : (offset, length, is_data) covering the whole file,
+                      holes included.
+        '''
+        pos = 0
+        for offset, length in self.extents():
+            if offset > pos:
+                yield pos, offset - pos, False
+            yield offset, length, True
+            pos = offset + length
+        size = os.fstat(self.fd).st_size
+        if size > pos:
+            yield pos, size - pos, False
+
+    def blocks(self):
+        '''
+            blocks : memoryviews over one reused buffer (readinto), each only
+                     valid until the next block is read. For hashing. The
+                     holes of sparse files come from a zero block, unread.
+        '''
+        buf = bytearray(self.block_size)
+        view = memoryview(buf)
+        zeros = _zero_block()
+        for offset, length, is_data in self.regions():
+            if not is_data:
+                while length > 0:
+                    yield zeros[:min(length, len(zeros))]
+                    length -= len(zeros)
+                continue
+            self.fileobj.seek(offset)
+            while length > 0:
+                count = self.fileobj.readinto(view[:min(length, self.block_size)])
+                if not count:
+                    raise IOError("%s truncated while being read" % self.fileobj.name)
+                self._consumed(count)
+                length -= count
+                yield view[:count]
+
+    def chunks(self, offset=0, length=None):
+        '''
+            chunks : length bytes from offset (up to the end of the file by
+                     default) as bytes objects, for consumers that keep the
+                     data around (compressors).
+        '''
+        self.fileobj.seek(offset)
+        while length is None or length > 0:
+            size = self.block_size if length is None else min(length, self.block_size)
+            buf = self.fileobj.read(size)
+            if not buf:
+                break
+            self._consumed(len(buf))
+            if length is not None:
+                length -= len(buf)
+            yield buf
+
+    def _consumed(self, count):
+        self.offset += count
+        if self.drop_cache and self.offset - self.dropped >= DROP_BEHIND_SIZE:
+            _fadvise(self.fd, self.dropped, self.offset - self.dropped, POSIX_FADV_DONTNEED)
+            self.dropped = self.offset
+
+    def close(self):
+        if self.drop_cache:
+            _fadvise(self.fd, 0, 0, POSIX_FADV_DONTNEED)
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def file_checksums(filename, algos=DEFAULT_DIGESTS, block_size=None, drop_cache=True, progress=None):
+    '''
+        file_checksums : {algo: hex digest} of filename for all algos,
+                         reading the file once.
+    '''
+    hasher = MultiHasher(algos)
+    with FileReader(filename, block_size, drop_cache) as reader:
+        for block in reader.blocks():
+            hasher.update(block)
+            if progress is not None:
+                progress.advance(len(block))
+    return hasher.hexdigests()
+
+def hash_file(filename, algo='sha256'):
+    return file_checksums(filename, [algo])[algo]
+
+def precompute_checksums(files, opts):
+    '''
+        precompute_checksums : the checksums of files (list of (path, algos))
+                               in order, when they are all known before
+                               archiving without reading the images: those
+                               of the images come from the checksum cache,
+                               the small files are hashed. Otherwise a list
+                               of None, to let the archive hash each member
+                               while writing it.
+    '''
+    unknown = [None] * len(files)
+    cache = get_checksum_cache(opts)
+    if cache is None or not all(os.path.isfile(path) for path, algos in files):
+        return unknown
+    with profile_stage(opts, 'hash'):
+        checksums = []
+        for path, algos in files:
+            st = os.stat(path)
+            if st.st_size < CHECKSUM_CACHE_MIN_SIZE:
+                checksums.append(None)
+                continue
+            cached = cache.lookup(path, algos, st)
+            if len(cached) < len(algos):
+                return unknown
+            checksums.append(cached)
+        return [chksum or file_checksums(path, algos, opts.get('block_size'), drop_cache=False)
+                for (path, algos), chksum in zip(files, checksums)]
+
+def verify_checksum_cache(sample):
+    cache = get_checksum_cache({})
+    if cache is None:
+        print("Checksum cache is not available")
+        return
+    results = cache.verify(sample)
+    for path, algo, status in results:
+        print("%-8s %-7s %s" % (status, algo, path))
+    print("verified %d cached checksums in %s, %d dropped" %
+          (len(results), cache.path, len([r for r in results if r[2] != 'ok'])))
+
+def _sparse_header(tarinfo, extents):
+    '''
+        _sparse_header : old GNU sparse member ('S') headers for tarinfo,
+                         storing only the data extents. The map ends with an
+                         empty extent at the real size when the file ends
+                         with a hole, as GNU tar writes it.
+    '''
+    realsize = tarinfo.size
+    sparse_map = list(extents)
+    if not sparse_map or sum(sparse_map[-1]) < realsize:
+        sparse_map.append((realsize, 0))
+    tarinfo.type = tarfile.GNUTYPE_SPARSE
+    tarinfo.size = sum(length for offset, length in extents)
+    buf = tarinfo.tobuf(tarfile.GNU_FORMAT)
+    prefix, header = buf[:-tarfile.BLOCKSIZE], bytearray(buf[-tarfile.BLOCKSIZE:])
+
+    def entries(items):
+        return b''.join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT) +
+                        tarfile.itn(length, 12, tarfile.GNU_FORMAT) for offset, length in items)
+
+    header[386:482] = entries(sparse_map[:4]).ljust(96, tarfile.NUL)
+    header[482:483] = b'\1' if len(sparse_map) > 4 else tarfile.NUL
+    header[483:495] = tarfile.itn(realsize, 12, tarfile.GNU_FORMAT)
+    header[148:156] = b' ' * 8
+    header[148:155] = ("%06o" % sum(header)).encode('ascii') + tarfile.NUL
+    blocks = [prefix, bytes(header)]
+    rest = sparse_map[4:]
+    while rest:
+        ext = entries(rest[:21]).ljust(504, tarfile.NUL)
+        rest = rest[21:]
+        blocks.append(ext + (b'\1' if rest else tarfile.NUL) + tarfile.NUL * 7)
+    return b''.join(blocks)
+
+def _member_header(tarinfo, extents):
+    '''
+        _member_header : tar header(s) of a member with these data extents;
+                         mostly empty ephemeral disks are stored sparse.
+    '''
+    if sum(length for offset, length in extents) < tarinfo.size:
+        return _sparse_header(tarinfo, extents)
+    return tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+def _tarinfo_for(path, arcname):
+    '''
+        _tarinfo_for : build the tar header for a regular file the same way
+                       'tar -C <dir> <file>' would, i.e. the member is stored
+                       under its base name.
+    '''
+    st = os.stat(path)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = st.st_size
+    tarinfo.mtime = int(st.st_mtime)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    if pwd:
+        try:
+            tarinfo.uname = pwd.getpwuid(st.st_uid)[0]
+        except KeyError:
+            pass
+    if grp:
+        try:
+            tarinfo.gname = grp.getgrgid(st.st_gid)[0]
+        except KeyError:
+            pass
+    return tarinfo
+
+class ParallelGzipWriter(object):
+    '''
+        ParallelGzipWriter : file like object producing a standard gzip stream.
+                             With threads > 1 the input is cut into blocks of
+                             GZIP_BLOCK_SIZE that are deflated independently on
+                             a thread pool (pigz style). Every block but the
+                             last ends on a byte boundary (Z_SYNC_FLUSH), so the
+                             concatenated blocks form a single deflate stream
+                             that any gunzip/tar can read.
+    '''
+    def __init__(self, fileobj, level=6, threads=1, header=True):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(1, threads)
+        self.crc = zlib.crc32(b'') & 0xffffffff
+        self.size = 0
+        self.buf = []
+        self.buffered = 0
+        self.pending = collections.deque()
+        if self.threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.threads)
+            self.compressor = None
+        else:
+            self.pool = None
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unix
+        if header:
+            self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                                           int(time.time()), 0, 3))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        if self.pool is None:
+            self.fileobj.write(self.compressor.compress(data))
+            return
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= GZIP_BLOCK_SIZE:
+            self._submit(False)
+
+    def _submit(self, last):
+        block = b''.join(self.buf)
+        self.buf = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(_deflate_block, (block, self.level, last)))
+        # keep a bounded number of blocks in flight, in output order
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        '''
+            flush : push everything written so far to the output file,
+                    ending on a byte boundary (used between members for
+                    the --compress_report accounting).
+        '''
+        if self.pool is None:
+            self.fileobj.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            return
+        if self.buffered:
+            self._submit(False)
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def full_flush(self):
+        '''
+            full_flush : flush, and forget the data written so far, so the
+                         stream can be inflated from here on without it
+                         (the member starts of an --index). The blocks of
+                         threads > 1 are deflated independently already.
+        '''
+        if self.pool is None:
+            self.fileobj.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+            return
+        self.flush()
+
+    def write_deflated(self, path, crc, size):
+        '''
+            write_deflated : copy the deflate data in path, prepared with
+                             finish_deflate for size bytes of input with
+                             the given crc32, into the stream as it is.
+        '''
+        self.flush()
+        with open(path, 'rb') as afile:
+            buf = afile.read(GZIP_BLOCK_SIZE)
+            while buf:
+                self.fileobj.write(buf)
+                buf = afile.read(GZIP_BLOCK_SIZE)
+        self.crc = crc32_combine(self.crc, crc, size)
+        self.size += size
+        if self.pool is None:
+            # the window of the old compressor doesn't match the stream anymore
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def finish_deflate(self):
+        '''
+            finish_deflate : end a writer created with header=False on a byte
+                             boundary, without the final block nor the gzip
+                             trailer, so that its output can be spliced into
+                             other streams with write_deflated.
+        '''
+        self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def close(self):
+        if self.pool is None:
+            self.fileobj.write(self.compressor.flush())
+        else:
+            self._submit(True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+
+    def abort(self):
+        if self.pool is not None:
+            self.pool.terminate()
+
+class StoreWriter(object):
+    '''
+        StoreWriter : plain tar output for --no_compress / --compress none.
+                      qcow2 images are usually compressed internally already,
+                      so gzip costs a lot of CPU for little gain on them.
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def full_flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class ZstdWriter(object):
+    '''
+        ZstdWriter : zstd compressed tar output. Much faster than gzip,
+                     meant for internal staging of packages; NFVIS and
+                     vManage only accept .tar.gz.
+    '''
+    def __init__(self, fileobj, level=3, threads=1):
+        if not zstandard:
+            raise IOError("zstd compression needs the zstandard module, run pip install zstandard")
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        self.writer = compressor.stream_writer(fileobj)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def flush(self):
+        self.writer.flush(zstandard.FLUSH_BLOCK)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+
+    def abort(self):
+        pass
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    for row in mat:
+        if not vec:
+            break
+        if vec & 1:
+            total ^= row
+        vec >>= 1
+    return total
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, row) for row in mat]
+
+def crc32_combine(crc1, crc2, len2):
+    '''
+        crc32_combine : crc32 of A + B from crc32(A), crc32(B) and len(B), as
+                        zlib's crc32_combine (which python doesn't expose).
+    '''
+    if len2 <= 0:
+        return crc1
+    # operator for one zero bit, then squared to two and four zero bits
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    # apply len2 zero bytes to crc1, a bit of len2 at a time
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return (crc1 ^ crc2) & 0xffffffff
+
+def _deflate_block(block, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class PackageArchive(object):
+    '''
+        PackageArchive : in-process replacement for the 'tar -czf' subprocess.
+                         Every member is read exactly once; the bytes copied
+                         into the archive are fed to the hasher on the way
+                         through, so the package.mf checksums do not need a
+                         second read of the (multi-GB) images.
+                         With index, every member starts at a point the
+                         package can be read from and <package>.idx lists
+                         them (see iter_package_member). The bytes of the
+                         members are reported to progress, a Progress.
+    '''
+    def __init__(self, filename, codec='gzip', level=None, threads=1, report=False,
+                 cache=None, block_size=None, drop_cache=True, shared=None, index=False,
+                 profile=None, progress=None, hash_workers=1):
+        if level is None:
+            level = ARCHIVE_CODECS[codec][1]
+        if index and codec == 'zstd':
+            raise IOError("--index is only supported for gzip and uncompressed packages")
+        self.filename = filename
+        self.codec = codec
+        self.level = level
+        self.raw = open(filename, 'wb')
+        if codec == 'none':
+            self.fileobj = StoreWriter(self.raw)
+        elif codec == 'zstd':
+            self.fileobj = ZstdWriter(self.raw, level=level, threads=threads)
+        else:
+            self.fileobj = ParallelGzipWriter(self.raw, level=level, threads=threads)
+        self.offset = 0
+        # per member size/time accounting for --compress_report and profiles
+        self.report = [] if report or profile is not None else None
+        self.print_members = report
+        self.profile = profile
+        self.close_seconds = 0.0
+        self.cache = cache
+        self.block_size = block_size
+        self.drop_cache = drop_cache
+        # {path: SharedMember} of the images prepared once for a --batch
+        self.shared = shared or {}
+        self.index = [] if index else None
+        self.progress = progress
+        self.hash_workers = hash_workers
+
+    def expect(self, total):
+        '''
+            expect : total bytes of the members about to be added, for the
+                     progress ETA.
+        '''
+        if self.progress is not None:
+            self.progress.start('archive', total)
+
+    def _write(self, buf):
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+    def add(self, path, arcname=None, digests=DEFAULT_DIGESTS, checksums=None):
+        '''
+            add : append the file at path as a tar member and return the
+                  {algo: hex digest} checksums of its contents for all
+                  digests, computed from the same read. Checksums computed
+                  beforehand are returned as they are, those the checksum
+                  cache holds for the unchanged file are not computed
+                  again (see ChecksumCache.lookup).
+        '''
+        if arcname is None:
+            arcname = os.path.basename(path)
+        start = time.time()
+        point = self._start_member()
+        stored = self.raw.tell()
+        st = os.stat(path)
+        tarinfo = _tarinfo_for(path, arcname)
+        cache = self.cache if st.st_size >= CHECKSUM_CACHE_MIN_SIZE else None
+        chksum = dict(checksums or {})
+        shared = self.shared.get(os.path.abspath(path))
+        spliced = (shared is not None and shared.identity == _file_identity(st) and
+                   shared.spool and self.codec == 'gzip' and shared.level == self.level)
+        if spliced:
+            # the spool holds the very bytes these checksums were computed from
+            for algo in digests:
+                if algo not in chksum and algo in shared.checksums:
+                    chksum[algo] = shared.checksums[algo]
+        spliced = spliced and all(algo in chksum for algo in digests)
+        if cache and not spliced:
+            chksum.update(cache.lookup(path, [algo for algo in digests if algo not in chksum], st))
+        missing = [algo for algo in digests if algo not in chksum]
+        hasher = self._hasher(missing, st.st_size) if missing else None
+        copied = 0
+        size = tarinfo.size
+        if self.progress is not None:
+            self.progress.start_member(arcname, size)
+        try:
+            if spliced:
+                # deflated once for the whole batch, copy the compressed bytes
+                self._write(_member_header(tarinfo, shared.extents))
+                self.fileobj.write_deflated(shared.spool, shared.crc, shared.size)
+                self.offset += shared.size
+                copied = shared.size
+                if self.progress is not None:
+                    self.progress.advance(size)
+            else:
+                copied = self._copy_member(path, tarinfo, hasher)
+            if copied != tarinfo.size:
+                raise IOError("%s changed size while being archived" % path)
+            computed = hasher.hexdigests() if hasher else {}
+        finally:
+            if hasher:
+                hasher.close()
+        self._index_member(point, tarinfo, size, copied)
+        self._end_member(arcname, size, stored, start, hasher)
+        if computed:
+            if cache:
+                cache.store(path, computed, st)
+            chksum.update(computed)
+        return chksum
+
+    def addfile(self, tarinfo, fileobj, digests=DEFAULT_DIGESTS):
+        '''
+            addfile : append a member with the header fields of tarinfo and
+                      the data read from fileobj, e.g. a member of another
+                      package streamed with tarfile. Returns the checksums
+                      of the data.
+        '''
+        start = time.time()
+        point = self._start_member()
+        stored = self.raw.tell()
+        tarinfo = copy.copy(tarinfo)
+        tarinfo.type = tarfile.REGTYPE
+        self._write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+        hasher = self._hasher(digests, tarinfo.size)
+        copied = 0
+        progress = self.progress
+        if progress is not None:
+            progress.start_member(tarinfo.name, tarinfo.size)
+        try:
+            buf = fileobj.read(self.block_size or HASH_BLOCK_SIZE)
+            while buf:
+                hasher.update(buf)
+                self._write(buf)
+                copied += len(buf)
+                if progress is not None:
+                    progress.advance(len(buf))
+                buf = fileobj.read(self.block_size or HASH_BLOCK_SIZE)
+            if copied != tarinfo.size:
+                raise IOError("%s: %d bytes read, %d expected" % (tarinfo.name, copied, tarinfo.size))
+            computed = hasher.hexdigests()
+        finally:
+            hasher.close()
+        self._index_member(point, tarinfo, tarinfo.size, copied)
+        self._end_member(tarinfo.name, tarinfo.size, stored, start, hasher)
+        return computed
+
+    def addbytes(self, arcname, data, digests=DEFAULT_DIGESTS):
+        '''
+            addbytes : append a member holding data, owned by the current
+                       user, for files generated in memory (package.mf).
+        '''
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        tarinfo.uid = os.getuid()
+        tarinfo.gid = os.getgid()
+        if pwd:
+            try:
+                tarinfo.uname = pwd.getpwuid(tarinfo.uid)[0]
+            except KeyError:
+                pass
+        if grp:
+            try:
+                tarinfo.gname = grp.getgrgid(tarinfo.gid)[0]
+            except KeyError:
+                pass
+        return self.addfile(tarinfo, io.BytesIO(data), digests)
+
+    def _start_member(self):
+        '''
+            _start_member : with an index, flush the compressor so that the
+                            next member can be read without what precedes
+                            it. Returns its (offset in the tar, offset in the
+                            package).
+        '''
+        if self.index is None:
+            return None
+        self.fileobj.full_flush()
+        return self.offset, self.raw.tell()
+
+    def _index_member(self, point, tarinfo, size, stored):
+        if point is None:
+            return
+        offset, compressed_offset = point
+        entry = OrderedDict([('name', tarinfo.name), ('offset', offset),
+                             ('data_offset', self.offset - stored), ('size', size),
+                             ('compressed_offset', compressed_offset)])
+        if tarinfo.type == tarfile.GNUTYPE_SPARSE:
+            # only the data extents are stored, iter_package_member streams these
+            entry['sparse'] = True
+        self.index.append(entry)
+
+    def _hasher(self, algos, size):
+        '''
+            _hasher : hasher of a member of size bytes. With hash_workers,
+                      members of more than a block are hashed on threads
+                      while they are written.
+        '''
+        if self.hash_workers > 1 and size > (self.block_size or HASH_BLOCK_SIZE):
+            return ThreadedHasher(algos, self.hash_workers)
+        return MultiHasher(algos)
+
+    def _end_member(self, arcname, size, stored, start, hasher=None):
+        remainder = self.offset % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        if self.report is not None:
+            self.fileobj.flush()
+            self.report.append({'name': arcname, 'size': size,
+                                'stored': self.raw.tell() - stored,
+                                'seconds': time.time() - start,
+                                'hash_seconds': hasher.seconds if hasher else 0.0,
+                                'hash_threaded': isinstance(hasher, ThreadedHasher)})
+
+    def _copy_member(self, path, tarinfo, hasher):
+        '''
+            _copy_member : write the header and data of path, feeding the
+                           data to hasher. Returns the number of data bytes
+                           written (the data extents of sparse files).
+        '''
+        copied = 0
+        progress = self.progress
+        with FileReader(path, self.block_size, self.drop_cache) as reader:
+            self._write(_member_header(tarinfo, reader.extents()))
+            for offset, length, is_data in reader.regions():
+                if not is_data:
+                    if hasher:
+                        hasher.update_zeros(length)
+                    if progress is not None:
+                        progress.advance(length)
+                    continue
+                for buf in reader.chunks(offset, length):
+                    if hasher:
+                        hasher.update(buf)
+                    self._write(buf)
+                    copied += len(buf)
+                    if progress is not None:
+                        progress.advance(len(buf))
+        return copied
+
+    def close(self):
+        start = time.time()
+        # end of archive marker plus padding to a full record, as tar does
+        self._write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self.offset % tarfile.RECORDSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.fileobj.close()
+        self.raw.close()
+        self.close_seconds = time.time() - start
+        if self.progress is not None:
+            self.progress.finish()
+        if self.profile is not None:
+            self.profile.add_archive(self)
+        if self.index is not None:
+            index = OrderedDict([('package', os.path.basename(self.filename)), ('codec', self.codec),
+                                 ('package_size', os.path.getsize(self.filename)),
+                                 ('members', self.index)])
+            with open(self.filename + PACKAGE_INDEX_SUFFIX, 'w') as f:
+                json.dump(index, f, indent=2)
+
+    def print_report(self):
+        '''
+            print_report : size and time spent per member, to help picking
+                           a codec per image type.
+        '''
+        if not self.print_members:
+            return
+        print("%-36s %14s %14s %7s %9s %9s" % ("member", "bytes", "stored", "ratio", "seconds", "MB/s"))
+        for item in self.report:
+            ratio = float(item['stored']) / item['size'] if item['size'] else 0.0
+            rate = item['size'] / (1024.0 * 1024.0) / item['seconds'] if item['seconds'] else 0.0
+            print("%-36s %14d %14d %7.3f %9.3f %9.1f" % (item['name'], item['size'], item['stored'],
+                                                       ratio, item['seconds'], rate))
+            logger.info("archived %s: %d bytes stored as %d in %.3fs" %
+                        (item['name'], item['size'], item['stored'], item['seconds']))
+
+    def abort(self):
+        '''
+            abort : close and remove a partially written archive.
+        '''
+        try:
+            if self.progress is not None:
+                self.progress.finish('failed')
+            self.fileobj.abort()
+            self.raw.close()
+        finally:
+            for filename in (self.filename, self.filename + PACKAGE_INDEX_SUFFIX):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+def package_digests(opts):
+    return opts.get('digests') or DEFAULT_DIGESTS
+
+def archive_codec(opts):
+    if opts.get('no_compress'):
+        return 'none'
+    return opts.get('compress') or 'gzip'
+
+def package_target(filename, opts):
+    '''
+        package_target : file name of the package with the extension of the
+                         selected codec, replacing the one of another codec.
+    '''
+    extension = ARCHIVE_CODECS[archive_codec(opts)][0]
+    if filename.endswith(extension):
+        return filename
+    for ext, level in ARCHIVE_CODECS.values():
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+            break
+    return filename + extension
+
+def open_package_archive(filename, opts):
+    '''
+        open_package_archive : PackageArchive for filename using the archive
+                               options (codec, level, threads) in opts. The
+                               --progress of the package is reported from
+                               here on.
+    '''
+    ctx = build_context(opts)
+    target = package_target(filename, opts)
+    callback = progress_callback(opts.get('progress'))
+    ctx.progress = Progress(callback, os.path.basename(target)) if callback else None
+    return PackageArchive(target, codec=archive_codec(opts),
+                          level=opts.get('compress_level'),
+                          threads=opts.get('compress_threads', 1),
+                          report=opts.get('compress_report', False),
+                          cache=get_checksum_cache(opts),
+                          block_size=opts.get('block_size'),
+                          drop_cache=not opts.get('keep_page_cache'),
+                          shared=opts.get('shared_members'),
+                          index=opts.get('index', False),
+                          profile=ctx.profile, progress=ctx.progress,
+                          hash_workers=opts.get('hash_workers', 1))
+
+# an image shared by several packages of a batch: identity is the
+# _file_identity the image had when planned, extents its data extents. For
+# gzip packages it is hashed and deflated into spool once, crc/size the
+# crc32 and length of the deflated data; other packages copy and hash it
+# themselves, checksums is empty
+SharedMember = collections.namedtuple('SharedMember', 'identity checksums extents spool level crc size')
+
+def prepare_shared_member(path, spool_dir, opts):
+    '''
+        prepare_shared_member : SharedMember for the image at path. For gzip
+                                packages its tar member data is deflated in
+                                the same read that hashes it, into a file in
+                                spool_dir that every package copies as is.
+    '''
+    st = os.stat(path)
+    digests = package_digests(opts)
+    codec = archive_codec(opts)
+    level = opts.get('compress_level')
+    if level is None:
+        level = ARCHIVE_CODECS[codec][1]
+    spool = None
+    crc = size = 0
+    if codec == 'gzip':
+        spool = os.path.join(spool_dir, '%d-%d.deflate' % (st.st_dev, st.st_ino))
+        hasher = MultiHasher(digests)
+        with open(spool, 'wb') as raw:
+            deflater = ParallelGzipWriter(raw, level, opts.get('compress_threads', 1), header=False)
+            with FileReader(path, opts.get('block_size'), drop_cache=False) as reader:
+                extents = reader.extents()
+                for offset, length, is_data in reader.regions():
+                    if not is_data:
+                        hasher.update_zeros(length)
+                        continue
+                    for buf in reader.chunks(offset, length):
+                        hasher.update(buf)
+                        deflater.write(buf)
+            deflater.finish_deflate()
+        checksums = hasher.hexdigests()
+        crc, size = deflater.crc, deflater.size
+    else:
+        with FileReader(path, drop_cache=False) as reader:
+            extents = reader.extents()
+        checksums = {}
+    if _file_identity(os.stat(path)) != _file_identity(st):
+        raise IOError("%s changed while being prepared" % path)
+    return SharedMember(_file_identity(st), checksums, extents, spool, level, crc, size)
+
+def _member_path(cur_dir, item):
+    '''
+        _member_path : bare file names are relative to the scratch directory
+                       (same as 'tar -C <scratch_dir> <file>').
+    '''
+    if "/" in item:
+        return item
+    return os.path.join(cur_dir, item)
 
 
 def cleanup(opts):
+    with profile_stage(opts, 'cleanup'):
+        _cleanup(opts)
+
+def _cleanup(opts):
     logger.info("Cleaning up the directory")
     if 'verbose' in opts and opts['verbose']:
         print("\ndeleting template and manifest files")
-    if os.path.isfile(image_prop_file):
-        os.remove(image_prop_file)
-    if os.path.isfile(pkgmf_file):
-        os.remove(pkgmf_file)
-    if os.path.isfile(sys_gen_prop):
-        os.remove(sys_gen_prop)
+    ctx = build_context(opts)
+    if os.path.isfile(ctx.image_prop_file):
+        os.remove(ctx.image_prop_file)
+    if os.path.isfile(ctx.pkgmf_file):
+        os.remove(ctx.pkgmf_file)
+    if os.path.isfile(ctx.sys_gen_prop):
+        os.remove(ctx.sys_gen_prop)
     #if 'newjson' not in opts:
-    if opts['cleanup']:
+    if opts.get('cleanup'):
         if 'verbose' in opts and opts['verbose']:
             print("deleting qcow2 and config files")
       #delete qcow2 and bstrap files
@@ -197,73 +1894,320 @@ def cleanup(opts):
             if os.path.isfile(file):
                 os.remove(file)
         '''
-        for item in bsfile_list:
+        for item in ctx.bsfile_list:
           file=item['src']
           if os.path.isfile(file):
             os.remove(file)
-    if 'newjson' in opts:
+    # no scratch_dir yet when the spec is rejected before package_output_dir
+    if 'newjson' in opts and 'scratch_dir' in opts:
         os.removedirs(opts['scratch_dir'])
 
 def buildTargetFile(opts):
-    extension = ".tar.gz"
+    '''
+        buildTargetFile : write the package and its package.mf, returns the
+                          package file name. Raises PackagingError.
+    '''
+    ctx = build_context(opts)
     cur_dir = opts['scratch_dir']
     outname = opts['package_filename']
     opts['package_filename'] = os.path.join(opts['package_output_dir'],outname)
-    pkg_mf_file = createPackageMF(opts['scratch_dir'],opts['ha_package'])
-    file_dict = {'disk_img_names':opts['root_disk_image'], \
-                'bootstrap_file':bootstrap_sources, \
-                'image_properties':image_prop_file}
+    digests = package_digests(opts)
+    pkg_mf_file = createPackageMF(ctx,opts['scratch_dir'],opts['ha_package'],digests)
+    # metadata first, so readers streaming the package get it before the
+    # images; package.mf only joins it when all the checksums are cached
+    file_dict = OrderedDict([('image_properties', ctx.image_prop_file)])
     ha_package = opts['ha_package']
     if ha_package:
-        file_dict['system_generated_properties'] = sys_gen_prop
-    tar_cmd = ["tar", "-czf"]
+        file_dict['system_generated_properties'] = ctx.sys_gen_prop
+    file_dict['bootstrap_file'] = ctx.bootstrap_sources
+    file_dict['disk_img_names'] = opts['root_disk_image']
 
-    if opts['package_filename'].endswith(".tar.gz"):
-        tar_cmd.append(opts['package_filename'])
-    else:
-        tar_cmd.append(opts['package_filename'] + extension)
+    members = []
     for opt in file_dict.keys(): # loop through the keys in file_dict
         file = file_dict[opt]
         if type(file) == type([]):
             for item in file:
-                chksum = sha256sum(item)
-                if "/" in item: # checks if the item is a pathname (directory/filename)
-                    (path, file) = item.rsplit("/",1)
-                    path = "/" if path == "" else path
-                    tar_cmd.extend(["-C", path, file])
-                else:
-                    tar_cmd.extend(["-C", cur_dir, item])
-                    file = item
-                updatePackageMF(pkg_mf_file, file, opt, chksum,opts['ha_package'])
+                members.append((opt, _member_path(cur_dir, item)))
         elif file != None:
             if os.path.isfile(file) == False:
-                print("File %s doesn't exist, Please make sure file exists and rerun the tool."%file)
                 cleanup(opts)
-                sys.exit()
+                raise PackageInternalError("File %s doesn't exist, Please make sure file exists and rerun the tool."%file,
+                                           key=file)
             else:
-                chksum = sha256sum(file)
-                if "/" in file: #checks if the file is a pathname (directory/filename)
-                    (path, file) = file.rsplit("/",1)
-                    path = "/" if path == "" else path
-                    tar_cmd.extend(["-C", path, file])
-                else:
-                    tar_cmd.extend(["-C", cur_dir, file])
-                updatePackageMF(pkg_mf_file, file, opt, chksum,opts['ha_package'])
-
-    closePackageMF(pkg_mf_file)
-    if "/" in pkgmf_file:
-        (path, file) = pkgmf_file.rsplit("/",1)
-        path = "/" if path == "" else path
-        tar_cmd.extend(["-C", path, file])
-    else:
-        tar_cmd.extend(["-C", cur_dir, pkgmf_file])
+                members.append((opt, _member_path(cur_dir, file)))
 
-    print(tar_cmd)
+    archive = open_package_archive(opts['package_filename'], opts)
+    target = archive.filename
+    print("Creating package %s" % target)
     try:
-        subprocess.call(tar_cmd) # run the command
-    except OSError:
-        pass
+        checksums = precompute_checksums([(path, digests) for opt, path in members], opts)
+        archive.expect(sum(os.path.getsize(path) for opt, path in members))
+        # package.mf goes first as well only when all the checksums are known
+        # beforehand, from the checksum cache; with --index, cat reads it
+        # directly wherever it is
+        manifest_first = all(checksums)
+        if manifest_first:
+            for (opt, path), chksum in zip(members, checksums):
+                updatePackageMF(ctx, pkg_mf_file, os.path.basename(path), opt, chksum,opts['ha_package'])
+            closePackageMF(pkg_mf_file)
+            archive.add(_member_path(cur_dir, ctx.pkgmf_file))
+        for (opt, path), chksum in zip(members, checksums):
+            # unless precomputed, the checksums are computed while the file is written to the archive
+            chksum = archive.add(path, digests=digests, checksums=chksum)
+            if not manifest_first:
+                updatePackageMF(ctx, pkg_mf_file, os.path.basename(path), opt, chksum,opts['ha_package'])
+
+        if not manifest_first:
+            closePackageMF(pkg_mf_file)
+            # package.mf carries the checksums of everything above, so it goes last
+            archive.add(_member_path(cur_dir, ctx.pkgmf_file))
+        archive.close()
+        archive.print_report()
+    except (IOError, OSError) as e:
+        logger.error("Failed to create the package %s: %s" % (target, e))
+        archive.abort()
+        cleanup(opts)
+        raise PackageInternalError("Failed to create the package %s: %s" % (target, e))
     cleanup(opts)
+    return target
+
+def template_copy(template):
+    '''
+        template_copy : copy of a parsed image_properties template for
+                        make_image_prop_xml to fill in. make_image_prop_xml
+                        only sets, pops and appends to the members of
+                        image_properties, so the document, image_properties
+                        and its lists are copied and everything below them
+                        is shared with template.
+    '''
+    properties = template.get('image_properties')
+    if not isinstance(properties, dict):
+        return copy.deepcopy(template)
+    copied = OrderedDict(template)
+    copied['image_properties'] = OrderedDict(
+        (key, list(value) if isinstance(value, list) else value) for key, value in properties.items())
+    return copied
+
+class TemplateCache(object):
+    '''
+        TemplateCache : image_properties templates parsed once per (path,
+                        mtime, size), the built-in one under None, handed
+                        out as template_copy copies. Thread safe, for
+                        --batch workers and the serve daemon.
+    '''
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path=None):
+        if path is None:
+            key = None
+        else:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            key = (path, st.st_mtime, st.st_size)
+        with self.lock:
+            template = self.templates.get(key)
+        if template is None:
+            if path is None:
+                template = xmltodict.parse(image_properties_template_contents)
+            else:
+                with open(path, 'r') as fd:
+                    template = xmltodict.parse(fd.read())
+            with self.lock:
+                # the template changed on disk, forget the older parse
+                for stale in [stale for stale in self.templates if stale and stale[0] == path]:
+                    del self.templates[stale]
+                self.templates[key] = template
+        return template_copy(template)
+
+_templates = TemplateCache()
+
+def image_properties_template(path=None):
+    '''
+        image_properties_template : a copy of the parsed image_properties
+                                    template at path (the built-in one by
+                                    default), parsed once per version of
+                                    the file.
+    '''
+    return _templates.get(path)
+
+def package_from_json(jsonfile, cli_options, timings=None, profile=None):
+    '''
+        package_from_json : build_from_json -> make_image_prop_xml ->
+                            buildTargetFile for one --newjson spec, with the
+                            archive options taken from cli_options. The time
+                            spent per stage is recorded in timings, and in
+                            detail in the BuildProfile profile. Returns the
+                            package file name.
+    '''
+    if timings is None:
+        timings = {}
+    start = time.time()
+    template_dict = image_properties_template()
+    options = build_from_json(template_dict, jsonfile, profile)
+    for key in ARCHIVE_OPTIONS:
+        if key in cli_options:
+            options[key] = cli_options[key]
+    timings['build_from_json'] = time.time() - start
+    start = time.time()
+    with profile_stage(options, 'render'):
+        make_image_prop_xml(template_dict,options)
+    timings['make_image_prop_xml'] = time.time() - start
+    if options['verbose']:
+        print("Creating the target file %s " % options['package_filename'])
+    start = time.time()
+    target = buildTargetFile(options)
+    timings['buildTargetFile'] = time.time() - start
+    return target
+
+def batch_specs(pattern):
+    '''
+        batch_specs : the --newjson specs of a --batch directory (*.json in
+                      it) or glob pattern, sorted.
+    '''
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.json')
+    return sorted(glob.glob(pattern))
+
+def spec_images(jsonfile):
+    '''
+        spec_images : the image paths of the image_list of a --newjson spec;
+                      empty when it can't be read, the build reports why.
+    '''
+    try:
+        with open(jsonfile, 'r') as f:
+            obj = json.load(f)
+        return [os.path.join(images['path'], images['image_name']) for images in obj['image_list']]
+    except (IOError, ValueError, KeyError, TypeError):
+        return []
+
+def plan_batch(specs, opts, spool_dir):
+    '''
+        plan_batch : build planner of --batch. Groups the specs by the
+                     identity of their images (so links and copies
+                     of the same file count once) and prepares the images
+                     used by more than one spec once, see
+                     prepare_shared_member. Returns the {path: SharedMember}
+                     given to the builds and a summary for the report.
+    '''
+    groups = OrderedDict()
+    for spec in specs:
+        for path in spec_images(spec):
+            try:
+                identity = _file_identity(os.stat(path))
+            except OSError:
+                continue
+            groups.setdefault(identity, []).append((spec, os.path.abspath(path)))
+    shared = {}
+    summary = []
+    for identity, users in groups.items():
+        paths = sorted(set(path for spec, path in users))
+        count = len(set(spec for spec, path in users))
+        if count < 2:
+            continue
+        start = time.time()
+        try:
+            member = prepare_shared_member(paths[0], spool_dir, opts)
+        except (IOError, OSError) as e:
+            logger.warning("not sharing %s between packages: %s" % (paths[0], e))
+            continue
+        for path in paths:
+            shared[path] = member
+        summary.append(OrderedDict([('image', paths[0]), ('packages', count),
+                                    ('seconds', time.time() - start)]))
+        print("Prepared %s once for %d packages" % (paths[0], count))
+    return shared, summary
+
+def _batch_build(job):
+    '''
+        _batch_build : build one spec of a batch, reporting errors in the
+                       result instead of exiting so that a bad spec doesn't
+                       stop the others.
+    '''
+    jsonfile, cli_options, profiled = job
+    result = OrderedDict([('source', jsonfile), ('status', 'failed'), ('output', None),
+                          ('error', None), ('seconds', 0.0), ('timings', {})])
+    start = time.time()
+    profile = BuildProfile() if profiled else None
+    try:
+        result['output'] = package_from_json(jsonfile, cli_options, result['timings'], profile)
+        result['status'] = 'ok'
+        if profile is not None:
+            result['profile'] = profile.to_dict()
+    except PackagingError as e:
+        result['error'] = e.to_json() if e.errorCode else str(e)
+    except SystemExit as e:
+        result['error'] = str(e.code) if e.code else 'build aborted'
+    except Exception as e:
+        logger.exception("batch build of %s failed" % jsonfile)
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+def batch_build(opts):
+    '''
+        batch_build : --batch, build a package from every spec matched by
+                      opts['batch'] on --batch_workers processes and write
+                      the summary report. Returns the per spec results.
+    '''
+    specs = batch_specs(opts['batch'])
+    if not specs:
+        print("No --newjson specs found for %s" % opts['batch'])
+        sys.exit(1)
+    cli_options = dict((key, opts[key]) for key in ARCHIVE_OPTIONS if key in opts)
+    batch_progress(cli_options)
+    workers = opts.get('batch_workers') or multiprocessing.cpu_count()
+    start = time.time()
+    spool_dir = tempfile.mkdtemp(prefix='nfvpt-shared-')
+    try:
+        cli_options['shared_members'], shared_summary = plan_batch(specs, cli_options, spool_dir)
+        profiled = 'profile_report' in opts or 'profile_metrics' in opts
+        jobs = [(spec, cli_options, profiled) for spec in specs]
+        print("Building %d packages on %d workers" % (len(jobs), min(workers, len(jobs))))
+        # a fresh process per spec, builds only share the prepared images and the checksum cache
+        results = run_batch_jobs(_batch_build, jobs, workers, fresh=True)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    write_profile_report(opts, [result.pop('profile') for result in results if 'profile' in result])
+    write_batch_report(results, opts.get('batch_report') or 'batch_report.json',
+                       time.time() - start, [('shared_images', shared_summary)])
+    return results
+
+def run_batch_jobs(func, jobs, workers, fresh=False):
+    '''
+        run_batch_jobs : map func over jobs, in process with a single worker
+                         or on a pool of worker processes, in job order.
+                         fresh gives every job a new process.
+    '''
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [func(job) for job in jobs]
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1 if fresh else None)
+    try:
+        return pool.map_async(func, jobs, chunksize=1).get(sys.maxsize)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def write_batch_report(results, report_file, elapsed, extra=()):
+    '''
+        write_batch_report : print the summary of a batch (--batch or a bulk
+                             convert) and write it as JSON to report_file,
+                             with the extra (key, value) items.
+    '''
+    failed = [result for result in results if result['status'] != 'ok']
+    print("%-40s %-7s %9s  %s" % ("source", "status", "seconds", "output / error"))
+    for result in results:
+        print("%-40s %-7s %9.3f  %s" % (os.path.basename(result['source']), result['status'],
+                                        result['seconds'], result['output'] or result['error']))
+    print("%d packages done, %d failed in %.3fs" % (len(results) - len(failed), len(failed), elapsed))
+    report = OrderedDict([('packages', len(results)), ('ok', len(results) - len(failed)),
+                          ('failed', len(failed)), ('seconds', elapsed)] + list(extra) +
+                         [('results', results)])
+    with open(report_file, 'w') as fd:
+        json.dump(report, fd, indent=2)
+    logger.info("batch report written to %s" % report_file)
 
 def extract_path(pkg_name=''):
     '''
@@ -278,15 +2222,14 @@ def extract_path(pkg_name=''):
         if os.path.isfile(curr_dir+'/'+pkg_name):
             path = curr_dir
         else:
-            print('File %s not present, enter the correct path'%pkg_name)
-            sys.exit()
+            raise PackageInternalError('File %s not present, enter the correct path'%pkg_name, key=pkg_name)
     else:
         if os.path.isfile(pkg_name):
             path = os.path.dirname(pkg_name)
             pkg_name = os.path.basename(pkg_name)
         else:
-            print('Path %s specified is not correct or file doesn''t exist'%pkg_name)
-            sys.exit()
+            raise PackageInternalError('Path %s specified is not correct or file doesn''t exist'%pkg_name,
+                                       key=pkg_name)
     return path, pkg_name
 
 def convertTargetFile(opts,pkg_name=''):
@@ -310,74 +2253,104 @@ def convertTargetFile(opts,pkg_name=''):
 
     dest_path = opts['dest_dir']
     if not os.path.isdir(dest_path):
-        print('The destination path defined does not exist, please enter the correct path')
-        return
-    print('Conversion started ##############')
+        error_handler('The destination path defined does not exist, please enter the correct path',
+                      opts,lineno(),INTERNAL_ERROR,'dest_dir')
     try:
-        #Call the function to change the image properties 
-        # after untar of the package.
-
-        # check if the /tmp exist on the system or not
-        if os.path.isdir("/tmp"):
-            temp_dir = tempfile.mkdtemp(dir="/tmp/")
-        else:
-            temp_dir = tempfile.mkdtemp(dir=os.getcwd())
-        print(temp_dir)
-        # use temp_dir, and when done:
-        src_path = temp_dir
-        convert_image_properties(opts['src_dir'], pkg_name, src_path)
-
-        #Calculate the new sha256 cheksum of the change files and 
-        #update the package.mf file.
-        pkg_dict={}
-
-        with open(os.path.join(src_path,'package.mf'),"r") as fd:
-            pkg_dict = xmltodict.parse(fd.read())
-        tar_cmd = ["tar", "-czf", dest_path+'/'+'vmanage_'+pkg_name]
-        for pkg in pkg_dict['PackageContents']['File_Info']:
-            if 'sha1_checksum' in pkg:
-                del pkg['sha1_checksum']
-            filename = pkg['name']
-            full_path = os.path.join(src_path, filename)
-            if os.path.isfile(full_path) == False:
-                print("File %s doesn't exist, Please make sure file in tar.gz and package.mf have same name."%full_path)
-                subprocess.call(["rm", "-rf", str(temp_dir)])
-                cleanup(opts)
-                sys.exit()
-            else:
-                chksum = sha256sum(full_path)
-                pkg['sha256_checksum'] = chksum
-                tar_cmd.extend(["-C", src_path, filename])
-
-        #Addition of the keys in the package.mf file
-        pkg_dict['PackageContents']['Packaging_Version'] = 1.0
-        pkg_dict['PackageContents'] = collections.OrderedDict(reversed(list(pkg_dict['PackageContents'].items()))) 
-        pkg_val=(xmltodict.unparse(pkg_dict, pretty=True, full_document=False))
-
-        with open(os.path.join(src_path, pkgmf_file), "w+") as f:
-            f.write("<!-- sha256sum - for calculating checksum -->\n")
-        with open(os.path.join(src_path, pkgmf_file), "a") as f:
-            f.write(pkg_val)
-        tar_cmd.extend(["-C", src_path, pkgmf_file])
-        print(tar_cmd)
-        subprocess.call(tar_cmd) # run the command
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-    except OSError:
-        logger.info('OSError occured while converting the package.')
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-        pass
+        target = convert_package(opts, opts['src_dir'], pkg_name, dest_path)
+    except PackagingError:
+        cleanup(opts)
+        raise
+    except (IOError, OSError, tarfile.TarError) as e:
+        logger.info('Error occured while converting the package: %s' % e)
+        error_handler('Failed to convert %s: %s' % (pkg_name, e),opts,lineno(),INTERNAL_ERROR,pkg_name)
     except Exception as e:
-        print 'Exception occured %s'%e
-        logger.info('Exception occured while converting the package.')
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-        pass
+        logger.exception('Exception occured while converting the package.')
+        error_handler('Failed to convert %s: %s' % (pkg_name, e),opts,lineno(),INTERNAL_ERROR,pkg_name)
     cleanup(opts)
+    return target
 
-def convert_image_properties(pkg_dir , filename, src):
+def convert_package(opts, src_dir, pkg_name, dest_path):
     '''
-    This function performs the following conversion or addition:
+        convert_package : write the vmanage supported vmanage_<pkg_name> to
+                          dest_path from the package src_dir/pkg_name. Errors
+                          are raised, after removing the partial package.
+                          Returns the package file name.
+    '''
+    archive = None
+    members = OrderedDict()
+    try:
+        # read the package in memory; members bigger than CONVERT_SPOOL_SIZE
+        # (images of non metadata packages) spill to a temporary file
+        manifest = None
+        with tarfile.open(os.path.join(src_dir, pkg_name), 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if member.name == pkgmf_file:
+                    manifest = list(iter_manifest(tar.extractfile(member)))
+                    continue
+                spool = tempfile.SpooledTemporaryFile(max_size=CONVERT_SPOOL_SIZE)
+                shutil.copyfileobj(tar.extractfile(member), spool, HASH_BLOCK_SIZE)
+                if member.name in members:
+                    members[member.name][1].close()
+                members[member.name] = (member, spool)
+        if manifest is None:
+            raise IOError("%s doesn't contain a package.mf" % pkg_name)
+
+        #Call the function to change the image properties
+        if 'image_properties.xml' in members:
+            tarinfo, spool = members['image_properties.xml']
+            spool.seek(0)
+            template_dict = convert_image_properties(xmltodict.parse(spool.read()))
+            data = xmltodict.unparse(template_dict, pretty=True).encode('utf-8')
+            spool.close()
+            tarinfo = copy.copy(tarinfo)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(time.time())
+            members['image_properties.xml'] = (tarinfo, io.BytesIO(data))
+
+        #Calculate the new sha256 cheksum of the change files and
+        #update the package.mf file.
+        digests = package_digests(opts)
+        file_info = manifest_file_info(manifest)
+        for pkg in file_info:
+            for algo in SUPPORTED_DIGESTS:
+                if algo not in digests and algo+'_checksum' in pkg:
+                    del pkg[algo+'_checksum']
+            if pkg['name'] not in members:
+                raise IOError("File %s doesn't exist, Please make sure file in tar.gz and package.mf have same name." % pkg['name'])
+        archive = open_package_archive(dest_path+'/'+'vmanage_'+pkg_name, opts)
+        archive.expect(sum(members[pkg['name']][0].size for pkg in file_info))
+        # metadata first, the images after it
+        for pkg in sorted(file_info, key=lambda pkg: is_image_type(pkg.get('type') or '')):
+            tarinfo, spool = members[pkg['name']]
+            spool.seek(0)
+            chksum = archive.addfile(tarinfo, spool, digests)
+            for algo in digests:
+                pkg[algo+'_checksum'] = chksum[algo]
+
+        #Addition of the keys in the package.mf file, last as it carries the
+        #checksums computed above
+        manifest = [(PACKAGING_VERSION_TAG, '1.0')] + [(tag, value) for tag, value in manifest
+                                                       if tag != PACKAGING_VERSION_TAG]
+        archive.addbytes(pkgmf_file, manifest_bytes(manifest, file_info, digests))
+        archive.close()
+        archive.print_report()
+        return archive.filename
+    except Exception:
+        if archive:
+            archive.abort()
+        raise
+    finally:
+        for tarinfo, spool in members.values():
+            spool.close()
+
+def convert_image_properties(template_dict):
+    '''
+    This function performs the following conversion or addition on the
+    parsed image_properties.xml of the old package:
 
-    - Untar the old package and parse the custom variable from the old format
+    - Parse the custom variable from the old format
     <custom_property>
         <UUID></UUID>
     </custom_property>
@@ -390,74 +2363,71 @@ def convert_image_properties(pkg_dir , filename, src):
         <val></val>
     </custom_property>
 
+    Properties in the vmanage format already, like those of the packages
+    this tool builds, are kept as they are.
     - Altering the version in the package to repalce '_' with '-'
     - Removing the profile section from the package.
     - Adding 'imageType' as 'virtualMachine'.
+
+    Returns template_dict, changed in place.
     '''
-    try:
-        tar_cmd = ['tar', '-xzf', pkg_dir+ '/' + filename, '-C', src]
-        subprocess.call(tar_cmd) # run the command
-        # Untar the file given
-        with open(os.path.join(src,'image_properties.xml'),"r") as fd:
-            template_dict = xmltodict.parse(fd.read())
-
-        IMAGE_TYPE='imageType'
-        #PACKAGE_NAME='package_filename'
-        template_dict['image_properties'][IMAGE_TYPE] = 'virtualmachine'
-        custom_list = []
-        if 'custom_property' in template_dict['image_properties'].keys():
-            custom_list = (template_dict['image_properties']['custom_property'])
-
-        # change the version tag in image propeties '_' to '-'
-        # need to add more cases if vmanage doesn't support other format.
-        if 'version' in template_dict['image_properties'].keys():
-            template_dict['image_properties']['version'] = template_dict['image_properties']['version'].replace('_', '-')    
-    
-        # removing the profile section for now, remove this code when the esc-lite
-        # changes comes in for the profile.
-        if 'profiles' in template_dict['image_properties'].keys():
-            del template_dict['image_properties']['profiles']
-        
-        if 'default_profile' in template_dict['image_properties'].keys():
-            del template_dict['image_properties']['default_profile']
-
-        # this is the list of attributes that are needed to be added to a property element.
-        # we can always add more values in the future.
-
-        attr_list = ['display']
-        DISPLAY=0
-        for custom in custom_list:
-            key_list = custom.keys()
-            value_list = custom.values()
-            custom.popitem()
-            custom['name'] = {}
-            custom['name']['@'+attr_list[DISPLAY]] = key_list[0]
-            custom['name']['#text'] = key_list[0]
-
-            # If the type of the values list is a list
-            # then the type of the property is 'selection'
-            # and the format for val is slightly different.
-            # else the type is 'string' for all properties
-
-            if type(value_list[0]) == list:
-                custom['type'] = 'selection'
-                val_list=[]
-                for v in value_list[0]:
-                    val={}
-                    val['@'+attr_list[DISPLAY]]= v
-                    val['#text'] = v
-                    val_list.append(val)
-                custom['val'] = val_list
-            else:
-                custom['type'] = 'string'
-                custom['val'] = value_list[0]
-        val=(xmltodict.unparse(template_dict, pretty=True))
-        with open(os.path.join(src,'image_properties.xml'), "w") as f:
-            f.write(val)
-    except OSError:
-        logger.info("Error in creating/accessing the tmp directory")
-        subprocess.call(["rm", "-rf", str(src)])
-        sys.exit()
+    IMAGE_TYPE='imageType'
+    #PACKAGE_NAME='package_filename'
+    template_dict['image_properties'][IMAGE_TYPE] = 'virtualmachine'
+    custom_list = []
+    if 'custom_property' in template_dict['image_properties'].keys():
+        custom_list = (template_dict['image_properties']['custom_property'])
+        # a single custom_property is parsed as the property itself
+        if isinstance(custom_list, dict):
+            custom_list = [custom_list]
+            template_dict['image_properties']['custom_property'] = custom_list
+
+    # change the version tag in image propeties '_' to '-'
+    # need to add more cases if vmanage doesn't support other format.
+    if 'version' in template_dict['image_properties'].keys():
+        template_dict['image_properties']['version'] = template_dict['image_properties']['version'].replace('_', '-')
+
+    # removing the profile section for now, remove this code when the esc-lite
+    # changes comes in for the profile.
+    if 'profiles' in template_dict['image_properties'].keys():
+        del template_dict['image_properties']['profiles']
+
+    if 'default_profile' in template_dict['image_properties'].keys():
+        del template_dict['image_properties']['default_profile']
+
+    # this is the list of attributes that are needed to be added to a property element.
+    # we can always add more values in the future.
+
+    attr_list = ['display']
+    DISPLAY=0
+    for custom in custom_list or []:
+        if not isinstance(custom, dict) or ('type' in custom and 'name' in custom):
+            continue
+        key_list = custom.keys()
+        value_list = custom.values()
+        custom.popitem()
+        custom['name'] = {}
+        custom['name']['@'+attr_list[DISPLAY]] = key_list[0]
+        custom['name']['#text'] = key_list[0]
+
+        # If the type of the values list is a list
+        # then the type of the property is 'selection'
+        # and the format for val is slightly different.
+        # else the type is 'string' for all properties
+
+        if type(value_list[0]) == list:
+            custom['type'] = 'selection'
+            val_list=[]
+            for v in value_list[0]:
+                val={}
+                val['@'+attr_list[DISPLAY]]= v
+                val['#text'] = v
+                val_list.append(val)
+            custom['val'] = val_list
+        else:
+            custom['type'] = 'string'
+            custom['val'] = value_list[0]
+    return template_dict
 
 def get_image_extension(image_name):
     for ext in ACCEPTED_IMG_EXTS:
@@ -466,9 +2436,8 @@ def get_image_extension(image_name):
                 print("\nCurrently NFVIS does not support registration"
                       " of packaged images that are not in .qcow2 format\n")
             return ext[1:]
-    print("\nUnsupported image format '." + str(image_name.rsplit(".")[1]) +"'")
-    print("Supported image format - " + str(ACCEPTED_IMG_EXTS) + "\n")
-    sys.exit()
+    raise PackageValidationError("\nUnsupported image format '." + str(image_name.rsplit(".")[1]) + "'\n"
+                                 "Supported image format - " + str(ACCEPTED_IMG_EXTS) + "\n", key=image_name)
 
 def handle_root_disk_images(opts,t_dict):
     for (pos,image) in list(islice(enumerate(opts['root_disk_image']),1,None)):
@@ -587,10 +2556,13 @@ def initialize_logger(opts):
     logger.addHandler(logger_handler)
 
 def error_handler(message,opts,code,etype,vname):
-    error = '{"errorCode":"'+ str(code) + '", "errorType":"' +  etype + '", "errorMessage":"'+message+'", "key":"'+vname +'"}'
-    if len(opts) > 0:
+    # clean up as soon as the build has options, the BuildContext alone is
+    # there from the start
+    if any(key != 'ctx' for key in opts):
         cleanup(opts)
-    sys.exit(error)
+    if etype == VALIDATION_ERROR:
+        raise PackageValidationError(message, code, vname)
+    raise PackageInternalError(message, code, vname)
 
 def unparse_resource_properties(opts, resource_properties):
     for rp in resource_properties:
@@ -613,8 +2585,6 @@ def handle_mounts_and_custom_vars(opts, t_dict, bs_file_list):
     sysgen_list = []
     ui_list = []
     bs_list = []
-    inside = re.compile("INSIDE_VLAN")
-    outside = re.compile("OUTSIDE_VLAN")
     for bsfile in bs_file_list:
         bs_dict = {}
         if not 'name' in bsfile:
@@ -636,13 +2606,9 @@ def handle_mounts_and_custom_vars(opts, t_dict, bs_file_list):
         if not os.path.exists(fullfilename):
             logger.error("Bootstrap file %s doesn't exit"%(fullfilename))
             error_handler("Bootstrap file not found",opts,lineno(),INTERNAL_ERROR,bsfile['name'])
-        bootstrap_sources.append(fullfilename)
-        if bsfile['ha_mode'] == 'primary':
-            bs_dict['@vm'] = '1'
-        elif bsfile['ha_mode'] == 'secondary':
-            bs_dict['@vm'] = '2'
-        elif bsfile['ha_mode'] == 'standalone':
-            bs_dict['@vm'] = '0'
+        build_context(opts).bootstrap_sources.append(fullfilename)
+        if bsfile['ha_mode'] in HA_MODE_VM:
+            bs_dict['@vm'] = HA_MODE_VM[bsfile['ha_mode']]
         bs_list.append(bs_dict)
 
         if 'userInput' in bsfile:
@@ -685,9 +2651,9 @@ def handle_mounts_and_custom_vars(opts, t_dict, bs_file_list):
                     Skip iteration
                 '''
                 sysgen_var_dict['name'] = each_var['name']
-                if not inside.search(each_var['name']) is None:
+                if 'INSIDE_VLAN' in each_var['name']:
                     inside_count += 1
-                if not outside.search(each_var['name']) is None:
+                if 'OUTSIDE_VLAN' in each_var['name']:
                     outside_count += 1
                 if type in each_var:
                     sysgen_var_dict['type'] = each_var['type']
@@ -710,151 +2676,343 @@ def handle_mounts_and_custom_vars(opts, t_dict, bs_file_list):
     sysgen_list = [json.loads(ss,object_pairs_hook=OrderedDict) for ss in sysgen_set]
     return sysgen_list
 
-def validate_packagename(json_fields,opts):
-    version = json_fields['vnf_version']
-    valid_version = (version[0] != '.' and version[len(version)-1] != '.' and bool(re.match('^[0-9.]+$',version)))
-    if not valid_version:
-        logger.info(error_messages['vnf_version'])
-        error_handler(error_messages['vnf_version'],opts,lineno(),VALIDATION_ERROR,'vnf_version')
-    final_package_name_entities = {'package_filename','vnf_name','vnf_type','vnf_version'}
-    for fpne in final_package_name_entities:
-        if not bool(re.match('^[a-zA-Z0-9.-]+$',json_fields[fpne])):
-            logger.error(error_messages[fpne])
-            error_handler(error_messages[fpne],opts,lineno(),VALIDATION_ERROR,fpne)
-
-def validate_resourceproperties(json_fields,opts):
-    if 'resource_properties' in json_fields:
-        if 'vnic_max' in json_fields['resource_properties'] and not(8<=json_fields['resource_properties']['vnic_max']<=256):
-            logger.error("Max number of VNICs can only be between 8-256")
-            error_handler(error_messages['vnic_max'],opts,lineno(),VALIDATION_ERROR,'vnic_max')
-        if 'mgmt_vnic' in json_fields['resource_properties'] or 'ha_vnic' in json_fields['resource_properties']:
-            if not(0<=json_fields['resource_properties']['mgmt_vnic']<=json_fields['resource_properties']['vnic_max']):
-                logger.error("Range of Management vnic id is 0 to max number of VNICs")
-                error_handler(error_messages['mgmt_vnic'],opts,lineno(),VALIDATION_ERROR,'mgmt_vnic')
-        if 'mgmt_vnic_count' in json_fields['resource_properties'] and not(0<=json_fields['resource_properties']['mgmt_vnic_count']<=2):
-            logger.error("Management vnic id count can only be between 0 and 2")
-            error_handler(error_messages['mgmt_vnic_count'],opts,lineno(),VALIDATION_ERROR,'mgmt_vnic_count')
-        if 'ha_vnic_count' in json_fields['resource_properties'] and 'mgmt_vnic_count' in json_fields['resource_properties'] and \
-            'vnic_max' in json_fields['resource_properties']:
-            max_ha_vnic_count  = json_fields['resource_properties']['vnic_max']-json_fields['resource_properties']['mgmt_vnic_count']-2
-            if not(0<=json_fields['resource_properties']['ha_vnic_count']<=max_ha_vnic_count):
-                logger.error("Invalid ha_vnic_count")
-                error_handler(error_messages['ha_vnic_count'],opts,lineno(),VALIDATION_ERROR,'ha_vnic_count')
-
-
-
-
-def validate_imageproperties(json_fields,opts):
-    if 'image_properties' in json_fields:
-        img_properties = {'sriov','monitored','console_type_serial','privilege'}
-        for img_prop in img_properties:
-            if img_prop in json_fields['image_properties'] and json_fields['image_properties'][img_prop] != True \
-                and json_fields['image_properties'][img_prop] != False:
-                logger.error("Invalid " +img_prop+" type. Can only be true or false")
-                error_handler(error_messages[img_prop],opts,lineno(),VALIDATION_ERROR,img_prop)
-        if 'bootup_time' in json_fields['image_properties'] and not (600 <= json_fields['image_properties']['bootup_time'] <= 3000):
-            logger.error("Boot up time has to be between 600 and 3000")
-            error_handler(error_messages['bootup_time'],opts,lineno(),VALIDATION_ERROR,'bootup_time')
-
 def lineno():
-    return inspect.currentframe().f_back.f_lineno
+    return sys._getframe(1).f_lineno
+
+class SpecRule(object):
+    '''
+        SpecRule : one rule of a spec schema. The values found at path
+                   (dotted keys, 'key[]' for every item of a list, '' for
+                   the whole spec) must pass check, one of
+                       'required'  the path exists
+                       'pattern'   a string matching the regex arg
+                       'choice'    one of the values in arg
+                       'bool'      true or false
+                       'range'     a number in the (min, max) arg
+                       a function  called with the value, true when valid
+                   message is the error message, or a function of the value
+                   for messages naming an item. code is the errorCode of a
+                   violation, fixed per rule: the code the tool reported
+                   for the check before the schema (the line of its
+                   error_handler call), from 1900 up for the checks it
+                   didn't make.
+    '''
+    def __init__(self, path, check, message, code, key=None, arg=None):
+        self.path = path
+        self.check = check
+        self.message = message
+        self.code = code
+        self.key = key or path.rsplit('.', 1)[-1].replace('[]', '')
+        self.arg = arg
+
+def _spec_path(path):
+    '''
+        _spec_path : compile a SpecRule path into a function returning the
+                     values found at it in a spec.
+    '''
+    if not path:
+        return lambda spec: [spec]
+    steps = [(step[:-2], True) if step.endswith('[]') else (step, False)
+             for step in path.split('.')]
+    # the common top level and one level deep keys get a direct lookup
+    if len(steps) == 1 and not steps[0][1]:
+        key = steps[0][0]
+        return lambda spec: [spec[key]] if key in spec else []
+    if len(steps) == 2 and not steps[0][1] and not steps[1][1]:
+        (outer, _), (inner, _) = steps
+        def nested(spec):
+            node = spec.get(outer)
+            return [node[inner]] if isinstance(node, dict) and inner in node else []
+        return nested
+    # and so do the items of a top level list and a key of them
+    if steps[0][1] and (len(steps) == 1 or (len(steps) == 2 and not steps[1][1])):
+        key = steps[0][0]
+        if len(steps) == 1:
+            return lambda spec: spec[key] if isinstance(spec.get(key), list) else []
+        inner = steps[1][0]
+        def items(spec):
+            nodes = spec.get(key)
+            if not isinstance(nodes, list):
+                return []
+            return [node[inner] for node in nodes if isinstance(node, dict) and inner in node]
+        return items
+    def values(spec):
+        nodes = [spec]
+        for key, each in steps:
+            found = []
+            for node in nodes:
+                if isinstance(node, dict) and key in node:
+                    if not each:
+                        found.append(node[key])
+                    elif isinstance(node[key], list):
+                        found.extend(node[key])
+            nodes = found
+        return nodes
+    return values
+
+def _spec_objects(path):
+    '''
+        _spec_objects : compile a SpecRule path into a function returning the
+                        objects found at it in a spec, the spec itself for
+                        the empty path.
+    '''
+    if not path:
+        return lambda spec: [spec]
+    values = _spec_path(path)
+    return lambda spec: [node for node in values(spec) if isinstance(node, dict)]
+
+def _is_number(value):
+    # bool is an int but no number in a spec
+    return type(value) in NUMBER_TYPES
+
+class SpecValidator(object):
+    '''
+        SpecValidator : a schema (list of SpecRule) compiled once into
+                        checks over the parsed spec, grouped by path so that
+                        each path is looked up once per spec whatever the
+                        number of rules on it. validate() runs all of them
+                        and returns every violation, as
+                        PackageValidationError, in the order of the rules.
+    '''
+    def __init__(self, rules):
+        # (parent, [(key, each, required, checks)]): the rules on the keys
+        # of the objects found at parent, the rules on parent itself with
+        # key None
+        groups, keys = {}, {}
+        self.groups = []
+        for index, rule in enumerate(rules):
+            parent, _, key = rule.path.rpartition('.') if rule.path else ('', '', None)
+            each = key is not None and key.endswith('[]')
+            if each:
+                key = key[:-2]
+            if parent not in groups:
+                groups[parent] = (_spec_objects(parent), [])
+                self.groups.append(groups[parent])
+            if (parent, key, each) not in keys:
+                keys[parent, key, each] = (key, each, [], [])
+                groups[parent][1].append(keys[parent, key, each])
+            required, checks = keys[parent, key, each][2:]
+            if rule.check == 'required':
+                required.append((index, rule))
+            else:
+                checks.append((index, rule, self._compile(rule)))
+
+    def _compile(self, rule):
+        if rule.check == 'pattern':
+            regex = rule.arg if hasattr(rule.arg, 'match') else re.compile(rule.arg)
+            valid = lambda value: isinstance(value, basestring) and regex.match(value) is not None
+        elif rule.check == 'choice':
+            choices = rule.arg if isinstance(rule.arg, frozenset) else frozenset(rule.arg)
+            valid = lambda value: isinstance(value, basestring) and value in choices
+        elif rule.check == 'bool':
+            valid = lambda value: value == True or value == False
+        elif rule.check == 'range':
+            low, high = rule.arg
+            valid = lambda value: _is_number(value) and low <= value <= high
+        else:
+            valid = rule.check
+        return valid
+
+    def validate(self, spec):
+        if not isinstance(spec, dict):
+            return [PackageValidationError('The spec must be a JSON object', 1904, 'spec')]
+        found = []
+        for objects, keys in self.groups:
+            objects = objects(spec)
+            for key, each, required, checks in keys:
+                if key is None:
+                    values = objects
+                elif not each:
+                    values = [node[key] for node in objects if key in node]
+                else:
+                    values = []
+                    for node in objects:
+                        if isinstance(node.get(key), list):
+                            values.extend(node[key])
+                if not values:
+                    for index, rule in required:
+                        found.append((index, self._violation(rule, None)))
+                    continue
+                for value in values:
+                    for index, rule, valid in checks:
+                        if not valid(value):
+                            found.append((index, self._violation(rule, value)))
+        if len(found) > 1:
+            # stable: the violations of one rule stay in the order of the values
+            found.sort(key=lambda violation: violation[0])
+        return [violation for index, violation in found]
+
+    @staticmethod
+    def _violation(rule, value):
+        message = rule.message(value) if callable(rule.message) else rule.message
+        return PackageValidationError(message, rule.code, rule.key)
+
+def _bootstrap_file_count_valid(ha):
+    '''
+        _bootstrap_file_count_valid : the check of the bootstrap file count
+                                      of HA (two files) or standalone (one)
+                                      packages.
+    '''
+    def valid(spec):
+        resources = spec.get('resource_properties')
+        if not isinstance(resources, dict) or 'ha_capable' not in resources or \
+                bool(resources['ha_capable']) != ha:
+            return True
+        bootstrap = spec.get('bootstrap')
+        file_list = bootstrap.get('file_list') if isinstance(bootstrap, dict) else None
+        return not isinstance(file_list, list) or len(file_list) >= (2 if ha else 1)
+    return valid
+
+def _mgmt_vnic_valid(resources):
+    if not isinstance(resources, dict):
+        return True
+    if 'mgmt_vnic' not in resources and 'ha_vnic' not in resources:
+        return True
+    mgmt_vnic, vnic_max = resources.get('mgmt_vnic'), resources.get('vnic_max')
+    return _is_number(mgmt_vnic) and _is_number(vnic_max) and 0 <= mgmt_vnic <= vnic_max
+
+def _ha_vnic_count_valid(resources):
+    if not isinstance(resources, dict):
+        return True
+    if not all(key in resources for key in ('ha_vnic_count', 'mgmt_vnic_count', 'vnic_max')):
+        return True
+    counts = [resources[key] for key in ('ha_vnic_count', 'mgmt_vnic_count', 'vnic_max')]
+    if not all(_is_number(count) for count in counts):
+        return False
+    ha_vnic_count, mgmt_vnic_count, vnic_max = counts
+    return 0 <= ha_vnic_count <= vnic_max - mgmt_vnic_count - 2
+
+def _disk(image):
+    return str(image.get('disk', '')).lower() if isinstance(image, dict) else ''
+
+def _root_disk_count_valid(images):
+    return not isinstance(images, list) or len([image for image in images if 'root' in _disk(image)]) <= 1
+
+def _image_disk_valid(image):
+    disk = _disk(image)
+    return 'root' in disk or disk[-1:].isdigit()
+
+def _image_path(image):
+    if not isinstance(image, dict):
+        return str(image)
+    return os.path.join(str(image.get('path', '')), str(image.get('image_name', '')))
+
+def _volume_size_valid(unit):
+    '''
+        _volume_size_valid : the check of the volumes with sizes in unit.
+    '''
+    to_gib = VOLUME_SIZE_GIB[unit]
+    def valid(volume):
+        if not isinstance(volume, dict) or volume.get('sizeunit') != unit or 'size' not in volume:
+            return True
+        try:
+            return to_gib(int(volume['size'])) <= VOLUME_MAX_GIB
+        except (TypeError, ValueError):
+            return False
+    return valid
+
+def newjson_schema():
+    '''
+        newjson_schema : the rules of the --newjson spec format, in the order
+                         the checks of the tool always ran.
+    '''
+    return [
+        SpecRule('vnf_type', 'required', error_messages['vnf_type'], 765),
+        SpecRule('package_filename', 'required', "Package_filename is missing", 768),
+        SpecRule('vnf_version', 'required', error_messages['vnf_version'], 771),
+        SpecRule('image_properties.monitored', 'required', error_messages['monitored'], 774),
+        SpecRule('vnf_name', 'required', error_messages['vnf_name'], 777),
+        SpecRule('app_vendor', 'required', error_messages['app_vendor'], 780),
+        SpecRule('image_list', 'required', "image_list is missing", 1901),
+        SpecRule('image_list[].image_name', lambda name: isinstance(name, basestring) and
+                 (len(name) <= 5 or name.endswith('.qcow2')), error_messages['image_name'], 784),
+        SpecRule('image_list', lambda images: isinstance(images, list), "image_list must be a list of images", 1902),
+        SpecRule('image_list', _root_disk_count_valid, error_messages['more_root'].strip(), 879),
+        SpecRule('image_list[]', _image_disk_valid, lambda image: error_messages['ephemeral'] + _image_path(image), 888, key='image_list'),
+        SpecRule('bootstrap.file_list', lambda file_list: isinstance(file_list, list),
+                 error_messages['file_list'], 1903),
+        SpecRule('', _bootstrap_file_count_valid(True), error_messages['file_list'], 789, key='file_list'),
+        SpecRule('', _bootstrap_file_count_valid(False), error_messages['file_list'], 792, key='file_list'),
+        SpecRule('bootstrap.file_list[]', lambda bfile: 'parse' not in bfile or
+                 bfile['parse'] == True or bfile['parse'] == False,
+                 lambda bfile: error_messages['parse'] + str(bfile.get('name')), 796, key='parse'),
+        SpecRule('vnf_type', 'choice', error_messages['vnf_type'], 800, arg=VNF_TYPES),
+        SpecRule('vnf_version', 'pattern', error_messages['vnf_version'], 718, arg=VERSION_RE),
+        SpecRule('package_filename', 'pattern', error_messages['package_filename'], 723, arg=NAME_RE),
+        SpecRule('vnf_name', 'pattern', error_messages['vnf_name'], 723, arg=NAME_RE),
+        SpecRule('vnf_type', 'pattern', error_messages['vnf_type'], 723, arg=NAME_RE),
+        SpecRule('image_properties.sriov', 'bool', error_messages['sriov'], 754),
+        SpecRule('image_properties.monitored', 'bool', error_messages['monitored'], 754),
+        SpecRule('image_properties.console_type_serial', 'bool', error_messages['console_type_serial'], 754),
+        SpecRule('image_properties.privilege', 'bool', error_messages['privilege'], 754),
+        SpecRule('image_properties.bootup_time', 'range', error_messages['bootup_time'], 757, arg=(600, 3000)),
+        SpecRule('resource_properties.vnic_max', 'range', error_messages['vnic_max'], 729, arg=(8, 256)),
+        SpecRule('resource_properties', _mgmt_vnic_valid, error_messages['mgmt_vnic'], 733, key='mgmt_vnic'),
+        SpecRule('resource_properties.mgmt_vnic_count', 'range', error_messages['mgmt_vnic_count'], 736,
+                 arg=(0, 2)),
+        SpecRule('resource_properties', _ha_vnic_count_valid, error_messages['ha_vnic_count'], 742,
+                 key='ha_vnic_count'),
+        SpecRule('bootstrap.bootstrap_cloud_init_drive_type', 'choice',
+                 error_messages['bootstrap_cloud_init_drive_type'], 810, arg=CLOUD_INIT_DRIVE_TYPES),
+        SpecRule('bootstrap.bootstrap_cloud_init_bus_type', 'choice',
+                 error_messages['bootstrap_cloud_init_bus_type'], 817, arg=CLOUD_INIT_BUS_TYPES),
+        SpecRule('volumes[]', _volume_size_valid('MiB'), error_messages['size'], 828, key='size'),
+        SpecRule('volumes[]', _volume_size_valid('GiB'), error_messages['size'], 832, key='size'),
+        SpecRule('volumes[]', _volume_size_valid('TiB'), error_messages['size'], 836, key='size'),
+        SpecRule('volumes[].deviceType', 'choice', error_messages['deviceType'], 840, arg=VOLUME_DEVICE_TYPES),
+        SpecRule('volumes[].format', 'choice', error_messages['format'], 844, arg=VOLUME_FORMATS),
+    ]
+
+_spec_validator = None
+
+def spec_validator():
+    '''
+        spec_validator : the --newjson SpecValidator, compiled on first use.
+    '''
+    global _spec_validator
+    if _spec_validator is None:
+        _spec_validator = SpecValidator(newjson_schema())
+    return _spec_validator
+
+def validate_spec(spec):
+    '''
+        validate_spec : every violation of the --newjson schema in spec, a
+                        spec file name or the parsed spec. Nothing is read
+                        but the spec itself.
+    '''
+    if isinstance(spec, basestring):
+        try:
+            with open(spec, 'r') as f:
+                spec = json.load(f)
+        except (IOError, OSError) as e:
+            return [PackageInternalError("Invalid Json file path specified: %s" % e, 539, spec)]
+        except ValueError as e:
+            return [PackageValidationError("Invalid JSON: %s" % e, 1905, spec)]
+    return spec_validator().validate(spec)
 
 def validate_json(json_fields,opts):
-    if not 'vnf_type' in json_fields:
-        logger.error(error_messages['vnf_type'])
-        error_handler(error_messages['vnf_type'],opts,lineno(),VALIDATION_ERROR,'vnf_type')
-    if not 'package_filename' in json_fields:
-        logger.error(error_messages['vnf_version'])
-        error_handler("Package_filename is missing",opts,lineno(),VALIDATION_ERROR,'package_filename')
-    if not 'vnf_version' in json_fields:
-        logger.error("Vnf_version is missing in the json file")
-        error_handler(error_messages['vnf_version'],opts,lineno(),VALIDATION_ERROR,'vnf_version')
-    if not 'monitored' in json_fields['image_properties']:
-        logger.error(error_messages['monitored'])
-        error_handler(error_messages['monitored'],opts,lineno(),VALIDATION_ERROR,'monitored')
-    if not 'vnf_name' in json_fields:
-        logger.error(error_messages['vnf_name'])
-        error_handler(error_messages['vnf_name'],opts,lineno(),VALIDATION_ERROR,'vnf_name')
-    if not 'app_vendor' in json_fields:
-        logger.error(error_messages['app_vendor'])
-        error_handler(error_messages['app_vendor'],opts,lineno(),VALIDATION_ERROR,'app_vendor')
-    for image in json_fields['image_list']:
-        if len(image['image_name']) > 5 and image['image_name'][len(image['image_name'])-6:] != '.qcow2':
-            logger.error("Invalid image extension")
-            error_handler(error_messages['image_name'],opts,lineno(),VALIDATION_ERROR,'image_name')
-    if 'bootstrap' in json_fields and 'file_list' in json_fields['bootstrap']:
-        if 'ha_capable' in json_fields['resource_properties']:
-            if json_fields['resource_properties']['ha_capable'] and len(json_fields['bootstrap']['file_list']) < 2:
-                logger.error("At least two bootstrap files needed for HA packaging")
-                error_handler(error_messages['file_list'],opts,lineno(),VALIDATION_ERROR,'file_list')
-            if not json_fields['resource_properties']['ha_capable'] and len(json_fields['bootstrap']['file_list']) < 1:
-                logger.error("At least one bootstrap file is needed for standalone packaging")
-                error_handler(error_messages['file_list'],opts,lineno(),VALIDATION_ERROR,'file_list')
-        for bfile in json_fields['bootstrap']['file_list']:
-            if 'parse' in bfile and bfile['parse'] != True and bfile['parse'] != False:
-                logger.error("Invalid parse type.Can only be true or false")
-                error_handler(error_messages['parse']+bfile['name'],opts,lineno(),VALIDATION_ERROR,'parse')
-    allowed_vnf_types = set(['FIREWALL','ROUTER','LOADBALANCER','OTHER', 'vWAAS', 'vWLC', 'WLC'])
-    if json_fields['vnf_type'] not in allowed_vnf_types:
-        logger.error(error_messages['vnf_type'])
-        error_handler(error_messages['vnf_type'],opts,lineno(),VALIDATION_ERROR,'vnf_type')
-    #validate package name
-    validate_packagename(json_fields,opts)
-    validate_imageproperties(json_fields,opts)
-    validate_resourceproperties(json_fields,opts)
-    if 'bootstrap' in json_fields:
-        if 'bootstrap_cloud_init_drive_type' in json_fields['bootstrap']:
-            bootstrap = json_fields['bootstrap']
-            if bootstrap['bootstrap_cloud_init_drive_type'] != 'cdrom' and bootstrap['bootstrap_cloud_init_drive_type'] != 'disk':
-               logger.error(error_messages['bootstrap_cloud_init_drive_type'])
-               error_handler(error_messages['bootstrap_cloud_init_drive_type'],\
-                   opts,lineno(),VALIDATION_ERROR,'bootstrap_cloud_init_drive_type')
-        if 'bootstrap_cloud_init_bus_type' in json_fields['bootstrap']:
-            bootstrap = json_fields['bootstrap']
-            bus_types = set(['virtio','scsi','ide'])
-            if bootstrap['bootstrap_cloud_init_bus_type'] not in bus_types:
-                logger.error(error_messages['bootstrap_cloud_init_bus_type'])
-                error_handler(error_messages['bootstrap_cloud_init_bus_type'], \
-                    opts,lineno(),VALIDATION_ERROR,'bootstrap_cloud_init_bus_type')
-    if 'volumes' in json_fields:
-        for volume in json_fields['volumes']:
-            if 'size' in volume and 'sizeunit' in volume:
-                size = int(volume['size'])
-                unit = volume['sizeunit']
-                limit = 256
-                if unit == 'MiB':
-                    if size/1000 > limit:
-                        logger.error(error_messages['size'])
-                        error_handler(error_messages['size'],opts,lineno(),VALIDATION_ERROR,'size')
-                elif unit == 'GiB':
-                    if size > limit:
-                        logger.error(error_messages['size'])
-                        error_handler(error_messages['size'],opts,lineno(),VALIDATION_ERROR,'size')
-                elif unit == 'TiB':
-                    if size*1000 > limit:
-                       logger.error(error_messages['size'])
-                       error_handler(error_messages['size'],opts,lineno(),VALIDATION_ERROR,'size')
-            if 'deviceType' in volume:
-                if volume['deviceType'] != 'disk' and volume['deviceType'] != 'cdrom':
-                    logger.error(error_messages['deviceType'])
-                    error_handler(error_messages['deviceType'],opts,lineno(),VALIDATION_ERROR,'deviceType')
-            if 'format' in volume:
-                if volume['format'] != 'qcow2' and volume['format'] != 'raw' and volume['format'] != 'vmdk':
-                    logger.error(error_messages['format'])
-                    error_handler(error_messages['format'],opts,lineno(),VALIDATION_ERROR,'format')
-
-def build_from_json(t_dict, jsonfile):
+    violations = spec_validator().validate(json_fields)
+    for violation in violations:
+        logger.error(violation.errorMessage)
+    if violations:
+        error = violations[0]
+        error_handler(error.errorMessage, opts, error.errorCode, error.errorType, error.key)
+
+def build_from_json(t_dict, jsonfile, profile=None):
     logger.info('Checking if Json file %s exists or not...'%(jsonfile))
+    opts = {}
+    build_context(opts).profile = profile
     if os.path.exists(jsonfile):
         logger.info("Reading the json file")
-        with open(jsonfile,'r') as f:
-            obj = json.load(f)
-        opts = {}
+        with profile_stage(opts, 'parse'):
+            with open(jsonfile,'r') as f:
+                obj = json.load(f)
         # validate the json file
         logger.info(obj)
         logger.info("->>>>>>>>>>>>>>>>>>>=====<<<<<<<<<<<<<<<<-")
         logger.info(opts)
-        validate_json(obj,opts)
+        with profile_stage(opts, 'validate'):
+            validate_json(obj,opts)
         sysgen_list = []
         opts['ha_package'] = True
         opts['no_compress'] = False
@@ -927,13 +3085,14 @@ def build_from_json(t_dict, jsonfile):
                 opts[json_element] = obj[json_element]
         if 'package_output_dir' in opts:
             s_dict = {'system_generated_properties': {'system_property': sysgen_list}}
-            sys_gen_xml = xmltodict.unparse(s_dict, pretty=True)
-            global sys_gen_prop
-            logger.info("creating system_generated_properties.xml file")
-            sys_gen_prop = os.path.join(opts['scratch_dir'], sys_gen_prop)
-            with open(os.path.join(opts['scratch_dir'], sys_gen_prop), "w") as fd:
-                logger.info("writing system properties to system_generated_properties.xml file")
-                fd.write(sys_gen_xml)
+            with profile_stage(opts, 'render'):
+                sys_gen_xml = xmltodict.unparse(s_dict, pretty=True)
+                ctx = build_context(opts)
+                logger.info("creating system_generated_properties.xml file")
+                ctx.sys_gen_prop = os.path.join(opts['scratch_dir'], ctx.sys_gen_prop)
+                with open(ctx.sys_gen_prop, "w") as fd:
+                    logger.info("writing system properties to system_generated_properties.xml file")
+                    fd.write(sys_gen_xml)
         else:
             logger.error(error_messages['package_output_dir'])
             error_handler(error_messages['package_output_dir'],opts,536,INTERNAL_ERROR,'package_output_dir')
@@ -947,14 +3106,14 @@ def db_build_from_json(opts, t_dict):
     json_file = opts['json']
     custom_list = []
     sysgen_list = []
+    ctx = build_context(opts)
     if os.path.exists(json_file):
         with open(json_file, 'r') as f:
             obj = json.load(f)
     else:
-        print('No JSON input file found')
-        sys.exit()
+        raise PackageInternalError('No JSON input file found', key=json_file)
     for file in obj['file']:
-        bootstrap_sources.append(file['@name'])
+        ctx.bootstrap_sources.append(file['@name'])
         for pos in file['position']:
             bs_dict = {}
             if opts['multi_use'] and 'terminationMode' in pos:
@@ -974,7 +3133,7 @@ def db_build_from_json(opts, t_dict):
             if 'vmMode' in file:
                 bs_dict['@firewallMode'] = file['vmMode']
             bs_dict['#text'] = file['@name']
-            bsfile_list.append(bs_dict)
+            ctx.bsfile_list.append(bs_dict)
             if 'UserInput' in pos:
                 for opt in pos['UserInput']:
                     each_custom = {}
@@ -1013,7 +3172,7 @@ def db_build_from_json(opts, t_dict):
                     sysgen_list.append(each_sys)
 
 
-    t_dict['image_properties']['bootstrap_file'] = bsfile_list
+    t_dict['image_properties']['bootstrap_file'] = ctx.bsfile_list
     '''
         eleminate dups
     '''
@@ -1024,9 +3183,8 @@ def db_build_from_json(opts, t_dict):
     sysgen_list = [json.loads(ss,object_pairs_hook=OrderedDict) for ss in sysgen_set]
     s_dict = {'system_generated_properties': {'system_property': sysgen_list}}
     sys_gen_xml = xmltodict.unparse(s_dict, pretty=True)
-    global sys_gen_prop
-    sys_gen_prop = os.path.join(opts['scratch_dir'], sys_gen_prop)
-    with open(sys_gen_prop, "w") as fd:
+    ctx.sys_gen_prop = os.path.join(opts['scratch_dir'], ctx.sys_gen_prop)
+    with open(ctx.sys_gen_prop, "w") as fd:
         fd.write(sys_gen_xml)
 
 
@@ -1037,9 +3195,8 @@ def add_profiles(opts,t_dict):
         l = []
         for item in profiles:
             if not "," in item or len(item.split(",")) <4:
-                print("profile should be in the format name,desc,vcpu,mem,disk \
-                \n example:--profile profile1,\"This is profile 1\",2,2048,4096.")
-                sys.exit()
+                raise PackageValidationError("profile should be in the format name,desc,vcpu,mem,disk \
+                \n example:--profile profile1,\"This is profile 1\",2,2048,4096.", key='profile')
             #if decsription is not provided
             if len(item.split(",")) <= 4:
                 (name,vcpus,memory_mb,root_disk_mb) = item.split(",")
@@ -1058,6 +3215,7 @@ def add_default_options(opts,t_dict):
 
 
 def make_image_prop_xml(template_dict,opts):
+    ctx = build_context(opts)
     for arg in opts:
         if arg == "root_disk_image":
             template_dict['image_properties']['root_image_disk_format']=get_image_extension(opts[arg][0])
@@ -1119,9 +3277,9 @@ def make_image_prop_xml(template_dict,opts):
                 template_dict['image_properties'][arg] = opts[arg]
         elif arg == 'bootstrap':
             if opts['ha_package']:
-                template_dict['image_properties']['bootstrap_file']=bsfile_list
+                template_dict['image_properties']['bootstrap_file']=ctx.bsfile_list
             else:
-                for i,src_dest in enumerate(bsfile_list,1):
+                for i,src_dest in enumerate(ctx.bsfile_list,1):
                     val = src_dest['dst']
                     template_dict['image_properties']['bootstrap_file_'+str(i)] = val
         elif arg == 'custom':
@@ -1155,35 +3313,31 @@ def make_image_prop_xml(template_dict,opts):
         add_custom_special(opts,template_dict)
     l = xmltodict.unparse(template_dict, pretty=True)
 
-    global image_prop_file
     if 'newjson' in opts:
         logger.info("creating image_properties.xml")
-        image_prop_file = os.path.join(opts['scratch_dir'], image_prop_file)
+        ctx.image_prop_file = os.path.join(opts['scratch_dir'], ctx.image_prop_file)
     if 'newjson' in opts:
         logger.info("writing to image_properties.xml")
-    with open(image_prop_file,"w") as fd:
+    with open(ctx.image_prop_file,"w") as fd:
         fd.write(l)
 
 def validateArguments(opts):
+    ctx = build_context(opts)
     if  opts['ha_package'] and ('_' in opts['name'] or '_' in opts['vnf_version'] or '_' in opts['vnf_type']):
-        print("'_' character not allowed in -n(--vnf_name)/-t(--vnf_type) and -r/(--vnf_version) options")
-        sys.exit()
+        raise PackageValidationError("'_' character not allowed in -n(--vnf_name)/-t(--vnf_type) and -r/(--vnf_version) options")
     bootstrap_len = len(opts['bootstrap']) if 'bootstrap' in opts else 0
     if bootstrap_len != 0:
         bs_files = opts['bootstrap']
         if (bootstrap_len > 20):
-            print("No of bootstraps given %s, max allowd is 20."%len(bs_files))
-            sys.exit()
+            raise PackageValidationError("No of bootstraps given %s, max allowd is 20."%len(bs_files))
         for key_vals in bs_files:
             if len(key_vals)<2 and opts['ha_package']:
-                print("--bootstrap options must be in format of comma separated key:value pairs; see Usage string")
-                sys.exit()
+                raise PackageValidationError("--bootstrap options must be in format of comma separated key:value pairs; see Usage string")
             elif opts['ha_package']:
                 key_val_dict = {}
                 for key_val in key_vals:
                     if ':' not in key_val or len(key_val.split(':')) > 2:
-                        print("--bootstrap options must be in format of comma separated key:value pairs; see Usage string")
-                        sys.exit()
+                        raise PackageValidationError("--bootstrap options must be in format of comma separated key:value pairs; see Usage string")
                     key,val = key_val.split(':')
                     if key != 'file':
                         if key == "mount_point":
@@ -1193,26 +3347,23 @@ def validateArguments(opts):
                         key = '#text'
                     key_val_dict[key] = val
                 if '@mnt_pnt' not in key_val_dict or '#text' not in key_val_dict:
-                    print("--bootstrap must at minimum contain 'mount_point:value' and 'file:value' key:value pair")
-                    sys.exit()
+                    raise PackageValidationError("--bootstrap must at minimum contain 'mount_point:value' and 'file:value' key:value pair")
                 file = key_val_dict['#text']
                 if not os.path.isfile(file):
-                    print("--bootstrap option - %s not found"%file)
-                    sys.exit()
+                    raise PackageInternalError("--bootstrap option - %s not found"%file)
                 mnt_pnt = key_val_dict['@mnt_pnt']
                 file = key_val_dict['#text']
                 if mnt_pnt == '/':
                     key_val_dict['@mnt_pnt'] = '/'+file
-                bootstrap_sources.append(file)
-                bsfile_list.append(key_val_dict)
+                ctx.bootstrap_sources.append(file)
+                ctx.bsfile_list.append(key_val_dict)
             elif not opts['ha_package']:
                 for item in key_vals:
                     bsfile={}
                     if ":" in item:
                         (key,val)=item.split(":")
                         if os.path.isfile(val) == False:
-                            print("File %s doesn't exist, Please make sure file exists and rerun the tool."%(val))
-                            sys.exit()
+                            raise PackageInternalError("File %s doesn't exist, Please make sure file exists and rerun the tool."%(val))
                         else:
                             if key == '/':
                                 bsfile["dst"]=key+val
@@ -1221,8 +3372,8 @@ def validateArguments(opts):
                             else:
                                 bsfile["dst"]=key
                             bsfile["src"]=val
-                            bootstrap_sources.append(val)
-                            bsfile_list.append(bsfile)
+                            ctx.bootstrap_sources.append(val)
+                            ctx.bsfile_list.append(bsfile)
                     else:
                         print("wrong format of bootstrap options")
 
@@ -1255,32 +3406,29 @@ def validateArguments(opts):
       for item in items:
           if not (opts['vcpu_min'] is None and opts['vcpu_max'] is None) :
             if (int(item) < int(opts['vcpu_min'])) or (int(item) > int(opts['vcpu_max'])):
-              print("vcpu=%s given in the profile should be in the range of min_vcpu=%s to max_vcpu=%s, exiting...retry again" % (item, opts['min_vcpu'], opts['max_vcpu']))
-              sys.exit()
+              raise PackageValidationError("vcpu=%s given in the profile should be in the range of min_vcpu=%s to max_vcpu=%s, exiting...retry again" % (item, opts['min_vcpu'], opts['max_vcpu']))
 
       items = [item[1] for item in modProf]
       for item in items:
           if not (opts['memory_mb_min'] is None and opts['memory_mb_max'] is None) :
             if (int(item) < int(opts['memory_mb_min'])) or (int(item) > int(opts['memory_mb_max'])):
-              print("mem=%s MB given in the profile should be in the range of min_mem=%s MB to max_mem=%s MB, exiting...retry again" % (item, opts['min_mem'], opts['max_mem']))
-              sys.exit()
+              raise PackageValidationError("mem=%s MB given in the profile should be in the range of min_mem=%s MB to max_mem=%s MB, exiting...retry again" % (item, opts['min_mem'], opts['max_mem']))
 
       items = [item[2] for item in modProf]
       for item in items:
           if not (opts['root_disk_gb_min'] is None and opts['root_disk_gb_max'] is None) :
             if (int(item) < int(opts['root_disk_gb_min'])*1024) or (int(item) > int(opts['root_disk_gb_max'])*1024):
-              print("disk=%s MB given in the profile should be in the range of min_disk=%s GBto max_disk=%s GB, exiting...retry again" % (item, opts['min_disk'], opts['max_disk']))
-              sys.exit()
+              raise PackageValidationError("disk=%s MB given in the profile should be in the range of min_disk=%s GBto max_disk=%s GB, exiting...retry again" % (item, opts['min_disk'], opts['max_disk']))
 
 
 def get_mandatory_args(opts):
    mandatoryArgs = ["package_filename","root_disk_image","name","vnf_type","vnf_version","monitored","optimize", "sysinfo_support"]
    for mandatoryArg in mandatoryArgs:
        if not mandatoryArg in opts:
-            input = raw_input(re.sub('[^a-zA-Z0-9 \n.]', ' ', str(mandatoryArg))+ ': ' )
-            while not (re.match('^[a-zA-Z0-9-.-_,]*$',input)) or input == '':
+            input = raw_input(PROMPT_STRIP_RE.sub(' ', str(mandatoryArg))+ ': ' )
+            while not (MANDATORY_INPUT_RE.match(input)) or input == '':
                 print("invalid input...\n")
-                input = raw_input('Following Mandatory parameters are needed: \n' + re.sub('[^a-zA-Z0-9 \n.]', ' ', str(mandatoryArg))+ ': ' )
+                input = raw_input('Following Mandatory parameters are needed: \n' + PROMPT_STRIP_RE.sub(' ', str(mandatoryArg))+ ': ' )
                 if mandatoryArg == "root_disk_image":
                     opts[mandatoryArg] = input.split(",")
                 elif mandatoryArg == "monitored":
@@ -1311,6 +3459,27 @@ def csv_arg_parse(string):
 def csv_arg_parse_case(string):
     return string.split(',')
 
+def size_arg_parse(string):
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    try:
+        if string[-1:].lower() in units:
+            size = int(string[:-1]) * units[string[-1:].lower()]
+        else:
+            size = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s', e.g. 65536, 256K or 4M" % string)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size has to be positive")
+    return size
+
+def digests_arg_parse(string):
+    digests = csv_arg_parse(string)
+    for algo in digests:
+        if algo not in SUPPORTED_DIGESTS:
+            raise argparse.ArgumentTypeError("invalid digest '%s', supported: %s" %
+                                             (algo, ','.join(SUPPORTED_DIGESTS)))
+    return [algo for algo in SUPPORTED_DIGESTS if algo in digests]
+
 def pack_files(opts):
     directory = opts['pack']
     files = os.listdir(directory)
@@ -1335,38 +3504,26 @@ def find_non_ha_bootstrap_sources(opts):
                 inferred by the script
     """
     directory = opts['pack']
-    def _handle_file_info(item_path, item_value):
-        """
-            Handle each File_Info element to extract list of bootstrap files
-
-            Args:
-                item_path (list): List of tuples of ancestral tag names
-                    and dictionary of their attribute names and values
-                item_value (OrderedDict) : Dictionary of tags, attributes, and values
-                    inside the element at given depth
-
-            Returns:
-                bool : always returns True to continue parsing
-        """
-        if item_path[0][0] != PACKAGE_CONTENTS_TAG:
-            print("Invalid package manifest file format. Expecting tag {}".format(PACKAGE_CONTENTS_TAG))
-            sys.exit(1)
-        if item_path[1][0] != FILE_INFO_TAG:
-            return True
-        file_type = item_value.get(FILE_INFO_TYPE_TAG)
-        if file_type and file_type.startswith(BOOTSTRAP_FILE_TYPE_PREFIX):
-            file_name = item_value.get(FILE_INFO_NAME_TAG)
-            if file_name:
-                bootstrap_sources.append(file_name.encode(ASCII_CHARSET))
-        return True
     package_manifest_abs_path = os.path.join(directory, pkgmf_file)
     if os.path.isfile(package_manifest_abs_path) and not os.path.islink(package_manifest_abs_path):
-        with open(package_manifest_abs_path, "rt") as mf:
-            xmltodict.parse(mf, item_depth=2, item_callback=_handle_file_info)
+        with open(package_manifest_abs_path, "rb") as mf:
+            try:
+                for tag, file_info in iter_manifest(mf):
+                    if tag != FILE_INFO_TAG:
+                        continue
+                    file_type = file_info.get(FILE_INFO_TYPE_TAG)
+                    if file_type and file_type.startswith(BOOTSTRAP_FILE_TYPE_PREFIX):
+                        file_name = file_info.get(FILE_INFO_NAME_TAG)
+                        if file_name:
+                            build_context(opts).bootstrap_sources.append(file_name.encode(ASCII_CHARSET))
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
 
 
 def find_ha_bootstrap_sources(opts):
     directory = opts['pack']
+    bootstrap_sources = build_context(opts).bootstrap_sources
     #suck the image properties file and ensure all the bootstraps are available
     with open(os.path.join(directory,'image_properties.xml'),"r") as fd:
         template_dict = xmltodict.parse(fd.read())
@@ -1410,33 +3567,257 @@ def convert(options, file_path):
         convert : function to conver the non-vmanaged packages 
                   to vmanaged version.
     '''
+    if os.path.isdir(file_path) or glob.has_magic(file_path):
+        results = bulk_convert(options, file_path)
+        sys.exit(1 if any(result['status'] != 'ok' for result in results) else 0)
     print ('Conversion Started  ##########')
     convertTargetFile(options, file_path)
     print ('Conversion Finished ##########')
 
+def _convert_one(job):
+    '''
+        _convert_one : convert one package of a bulk convert, reporting
+                       errors in the result instead of stopping the others.
+    '''
+    pkg_file, opts = job
+    result = OrderedDict([('source', pkg_file), ('status', 'failed'), ('output', None),
+                          ('error', None), ('seconds', 0.0)])
+    start = time.time()
+    try:
+        src_dir, pkg_name = os.path.split(os.path.abspath(pkg_file))
+        result['output'] = convert_package(opts, src_dir, pkg_name, opts.get('dest_dir', src_dir))
+        result['status'] = 'ok'
+    except PackagingError as e:
+        result['error'] = e.to_json() if e.errorCode else str(e)
+    except Exception as e:
+        logger.info('Error occured while converting %s: %s' % (pkg_file, e))
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+def bulk_convert(options, file_path):
+    '''
+        bulk_convert : --modify_package convert with a directory (its
+                       *.tar.gz, but the vmanage_ outputs of an earlier run)
+                       or a glob as --file_path, converting the packages on
+                       --batch_workers processes. Returns the per package
+                       results, also written to --batch_report.
+    '''
+    if os.path.isdir(file_path):
+        packages = [pkg for pkg in sorted(glob.glob(os.path.join(file_path, '*.tar.gz')))
+                    if not os.path.basename(pkg).startswith('vmanage_')]
+    else:
+        packages = sorted(pkg for pkg in glob.glob(file_path) if os.path.isfile(pkg))
+    if not packages:
+        print('No package found for %s' % file_path)
+        sys.exit(1)
+    if 'dest_dir' in options and not os.path.isdir(options['dest_dir']):
+        print('The destination path defined does not exist, please enter the correct path')
+        sys.exit(1)
+    opts = dict((key, options[key]) for key in ARCHIVE_OPTIONS + ['dest_dir'] if key in options)
+    batch_progress(opts)
+    workers = options.get('batch_workers') or multiprocessing.cpu_count()
+    print('Converting %d packages on %d workers' % (len(packages), min(workers, len(packages))))
+    start = time.time()
+    results = run_batch_jobs(_convert_one, [(pkg, opts) for pkg in packages], workers)
+    write_batch_report(results, options.get('batch_report') or 'convert_report.json', time.time() - start)
+    return results
+
 
-def recal_checksum(path, filename, tar_cmd, cksum):
+def is_image_type(file_type):
+    return file_type == 'root_image' or EPHEMERAL_IMAGE_RE.match(file_type) is not None
+
+def manifest_file_info(entries):
+    '''
+        manifest_file_info : the File_Info records of the package.mf entries
+                             read by iter_manifest.
+    '''
+    return [value for tag, value in entries if tag == FILE_INFO_TAG]
+
+def read_package_manifest(pkg_file):
+    '''
+        read_package_manifest : the top level entries of the package.mf of a
+                                package (see iter_manifest), read by
+                                streaming the tar up to it. None when the
+                                package has none.
+    '''
+    with tarfile.open(pkg_file, 'r|*') as tar:
+        for member in tar:
+            if member.name == pkgmf_file and member.isfile():
+                return list(iter_manifest(tar.extractfile(member)))
+    return None
+
+def manifest_digests(file_info):
+    '''
+        manifest_digests : the checksum types the File_Info records carry.
+    '''
+    return [algo for algo in SUPPORTED_DIGESTS if any(algo+'_checksum' in pkg for pkg in file_info)]
+
+def verify_package(pkg_file, block_size=None):
+    '''
+        verify_package : check a package against its package.mf, reading it
+                         once: every member is hashed while it is streamed
+                         (with the checksums the manifest carries, or all
+                         SUPPORTED_DIGESTS while package.mf hasn't been
+                         read yet) and compared to its File_Info afterwards.
+                         Returns the mismatched checksums and the missing
+                         and extra members, errors (also of a truncated or
+                         corrupt .tar.gz) are raised.
+    '''
+    block_size = block_size or HASH_BLOCK_SIZE
+    file_info = None
+    algos = SUPPORTED_DIGESTS
+    checksums = {}
+    size = 0
+    with open(pkg_file, 'rb') as raw:
+        gzipped = raw.read(2) == b'\x1f\x8b'
+        raw.seek(0)
+        stream = gzip.GzipFile(fileobj=raw, mode='rb') if gzipped else raw
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                fileobj = tar.extractfile(member)
+                if member.name == pkgmf_file:
+                    file_info = manifest_file_info(iter_manifest(fileobj))
+                    algos = manifest_digests(file_info)
+                    continue
+                hasher = MultiHasher(algos)
+                for block in iter(lambda: fileobj.read(block_size), b''):
+                    hasher.update(block)
+                checksums[member.name] = hasher.hexdigests()
+                size += member.size
+        # tarfile stops at the end of archive blocks, read up to the gzip
+        # trailer so its crc and length are checked too
+        while stream.read(block_size):
+            pass
+    if file_info is None:
+        raise IOError("%s doesn't contain a package.mf" % pkg_file)
+
+    mismatched = []
+    missing = []
+    listed = set()
+    for pkg in file_info:
+        name = pkg.get(FILE_INFO_NAME_TAG) or ''
+        name = name.encode('utf-8') if isinstance(name, unicode) else name
+        listed.add(name)
+        if name not in checksums:
+            missing.append(OrderedDict([('name', name), ('type', pkg.get(FILE_INFO_TYPE_TAG))]))
+            continue
+        for algo in SUPPORTED_DIGESTS:
+            if algo+'_checksum' in pkg and pkg[algo+'_checksum'] != checksums[name][algo]:
+                mismatched.append(OrderedDict([('name', name), ('type', pkg.get(FILE_INFO_TYPE_TAG)),
+                                               ('algo', algo), ('expected', pkg[algo+'_checksum']),
+                                               ('actual', checksums[name][algo])]))
+    extra = sorted(name for name in checksums if name not in listed)
+    return OrderedDict([('members', len(checksums)), ('bytes', size), ('digests', algos),
+                        ('mismatched', mismatched), ('missing', missing), ('extra', extra)])
+
+def load_package_index(pkg_file):
+    '''
+        load_package_index : the --index sidecar of a package, None when it
+                             has none or the package changed since.
+    '''
+    try:
+        with open(pkg_file + PACKAGE_INDEX_SUFFIX) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get('package_size') != os.path.getsize(pkg_file):
+        logger.info("%s%s is out of date, ignoring it" % (pkg_file, PACKAGE_INDEX_SUFFIX))
+        return None
+    return index
+
+def iter_package_member(pkg_file, name, block_size=None):
+    '''
+        iter_package_member : the data of the member name of a package, in
+                              blocks. With an --index sidecar the package is
+                              read from the start of the member on, so only
+                              the member is inflated; otherwise (and for
+                              sparse members) the package is streamed up to
+                              it. Raises KeyError for a missing member.
+    '''
+    block_size = block_size or HASH_BLOCK_SIZE
+    index = load_package_index(pkg_file)
+    if index is not None:
+        entries = [entry for entry in index['members'] if entry['name'] == name]
+        if not entries:
+            raise KeyError(name)
+        if not entries[0].get('sparse'):
+            return _indexed_member(pkg_file, index['codec'], entries[0], block_size)
+    return _streamed_member(pkg_file, name, block_size)
+
+def _indexed_member(pkg_file, codec, entry, block_size):
+    skip = entry['data_offset'] - entry['offset']
+    remaining = entry['size']
+    with open(pkg_file, 'rb') as raw:
+        inflater = None
+        if codec == 'gzip':
+            # the member starts on a full flush, a raw inflate can start there
+            raw.seek(entry['compressed_offset'])
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            raw.seek(entry['compressed_offset'] + skip)
+            skip = 0
+        while remaining > 0:
+            if inflater is None:
+                data = raw.read(min(block_size, remaining))
+            else:
+                data = inflater.unconsumed_tail or raw.read(min(block_size, skip + remaining))
+            if not data:
+                raise IOError("%s ends in the middle of %s" % (pkg_file, entry['name']))
+            buf = data if inflater is None else inflater.decompress(data, min(block_size, skip + remaining))
+            dropped = min(skip, len(buf))
+            skip -= dropped
+            buf = buf[dropped:dropped + remaining]
+            remaining -= len(buf)
+            if buf:
+                yield buf
+
+def _streamed_member(pkg_file, name, block_size):
+    with tarfile.open(pkg_file, 'r|*') as tar:
+        for member in tar:
+            if member.name == name and member.isfile():
+                fileobj = tar.extractfile(member)
+                for block in iter(lambda: fileobj.read(block_size), b''):
+                    yield block
+                return
+    raise KeyError(name)
+
+def _verify_one(job):
+    '''
+        _verify_one : verify one package of a verify run, reporting errors
+                      in the result instead of stopping the others.
+    '''
+    pkg_file, block_size = job
+    result = OrderedDict([('source', pkg_file), ('status', 'failed'), ('error', None), ('seconds', 0.0)])
+    start = time.time()
+    try:
+        result.update(verify_package(pkg_file, block_size))
+        if not (result['mismatched'] or result['missing'] or result['extra']):
+            result['status'] = 'ok'
+    except Exception as e:
+        logger.info('Error occured while verifying %s: %s' % (pkg_file, e))
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+def recal_checksum(path, filename, archive, digests):
     '''
         recal_checksum: function to check if the file is present or not 
-                        and recalculate the sha1 or sha256 cheksum and also add the
-                        file name in the tar command.
-        Input: directory path, filename, tar command
-        return: extended tar command and the checksum of the file.
+                        and add it to the archive, recalculating all the
+                        requested (sha1 and/or sha256) cheksums while it is
+                        written.
+        Input: directory path, filename, PackageArchive, list of digests
+        return: {algo: checksum} of the file.
     '''
     file_path = os.path.join(path, filename)
     # calucalte the checksum for the files
     if not os.path.isfile(file_path):
-        print("File %s doesn't exist, Please make sure the path entered for the root disk image is correct."%file_path)
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-        cleanup(options)
-        sys.exit()
+        raise IOError("File %s doesn't exist, Please make sure the path entered for the root disk image is correct."%file_path)
     else:
-        if cksum == 'sha1_checksum':
-            chksum = sha1sum(file_path)
-        else:
-            chksum = sha256sum(file_path)
-        tar_cmd.extend(["-C", path, filename])
-    return tar_cmd, chksum
+        chksum = archive.add(file_path, filename, digests)
+    return chksum
 
 def repackage(options, file_path, convert=False):
     '''
@@ -1452,56 +3833,87 @@ def repackage(options, file_path, convert=False):
     if not os.path.isdir(dest_path):
         print ('The destination path defined does not exist, please enter the correct path')
         return
-    # Here metadata.tar.gz will be untared and after that repackaging with the root_disk_images 
-    # will be done.
+    try:
+        repackage_package(options, os.path.join(options['src_dir'], pkg_name),
+                          options['root_disk_image'], dest_path)
+    except PackagingError as e:
+        print('%s' % e)
+    except (IOError, OSError, tarfile.TarError) as e:
+        print('Failed to repackage %s: %s' % (pkg_name, e))
+        logger.info('Error occured while repackaging the package: %s' % e)
+    except Exception as e:
+        logger.exception('Exception occured while repackaging the package.')
+        cleanup(options)
+        raise PackageInternalError('Failed to repackage %s: %s' % (pkg_name, e))
+    cleanup(options)
+    print ('Re-package Finished ##########')
+
+def repackage_package(options, src_pkg, images, dest_path):
+    '''
+        repackage_package : write repackaged_<name> to dest_path from the
+                            metadata package src_pkg and the vm images.
+                            Errors are raised, after removing the partial
+                            package. Returns the package file name.
     '''
-        1. Untar the metadata file to a temp directory.
-        2. generate the new package.mf based on the previous version or the option provided.
-        3. tar all the file back along with root_disk_images, to a file with prefix 'repackaged'.
+    # The metadata package is streamed member by member straight into the
+    # new package; only the new images are read from disk.
     '''
+        1. Read the package.mf of the metadata package.
+        2. Copy its metadata members to the package with prefix 'repackaged',
+           verifying their checksums against package.mf on the way.
+        3. Add the root_disk_images and the new package.mf.
+    '''
+    manifest = read_package_manifest(src_pkg)
+    if manifest is None:
+        raise PackageInternalError("%s doesn't contain a package.mf" % src_pkg, key=src_pkg)
+    target = os.path.join(dest_path, 'repackaged_'+os.path.basename(src_pkg))
+    archive = None
     try:
-        # check if the /tmp exist on the system or not
-        if os.path.isdir("/tmp"):
-            temp_dir = tempfile.mkdtemp(dir="/tmp/")
-        else:
-            temp_dir = tempfile.mkdtemp(dir=os.getcwd())
-        print(temp_dir)
-
-        # use temp_dir to untar and delete when done:
-        src_path = temp_dir
-        tar_cmd = ['tar', '-xzf', os.path.join(options['src_dir'], pkg_name), '-C', src_path]
-        subprocess.call(tar_cmd) # run the command
-
-        #Calculate the new sha256/sha1 cheksum of the change files and
-        #update the package.mf file.
-        pkg_dict={}
-        with open(os.path.join(src_path,'package.mf'),"r") as fd:
-            pkg_dict = xmltodict.parse(fd.read())
-        tar_cmd = ["tar", "-czf", os.path.join(dest_path,'repackaged_'+pkg_name)]
 
         #delete the disk image info as we need to update the image name
-        image_list = [file_entry for file_entry in pkg_dict['PackageContents']['File_Info']
-                    if ((file_entry['type'] == 'root_image') or re.match('^ephemeral_disk[0-9]+_image$',file_entry['type']))]
-        print image_list
-        for img in image_list:
-            full_path = os.path.join(src_path,img['name'])
-            if os.path.exists(full_path):
-                os.remove(full_path)
-        pkg_dict['PackageContents']['File_Info']=[file_entry for file_entry in pkg_dict['PackageContents']['File_Info']
-                 if not ((file_entry['type'] == 'root_image') or re.match('^ephemeral_disk[0-9]+_image$',file_entry['type']))]
-
-        sha_type = 'sha256_checksum'
-        for pkg in pkg_dict['PackageContents']['File_Info']:
-            if 'sha1_checksum' in pkg:
-                sha_type = 'sha1_checksum'
-            filename = pkg['name']
-            tar_cmd, chksum = recal_checksum(src_path, filename, tar_cmd, sha_type)
-            pkg[sha_type] = chksum
+        file_info = manifest_file_info(manifest)
+        image_list = [file_entry for file_entry in file_info if is_image_type(file_entry['type'])]
+        logger.debug("images of %s: %s" % (src_pkg, [pkg['name'] for pkg in image_list]))
+        file_info = [file_entry for file_entry in file_info if not is_image_type(file_entry['type'])]
+
+        # unless --digests is given, keep the checksum types the manifest
+        # already carries, all of them computed from one read of each file
+        digests = options.get('digests')
+        if not digests:
+            digests = manifest_digests(file_info) or DEFAULT_DIGESTS
+        disks = [extract_path(disk) for disk in images]
+        disk_files = [(os.path.join(os.path.abspath(path), filename), digests)
+                      for path, filename in disks]
+        archive = open_package_archive(target, options)
+        # the metadata members add to it as they are streamed
+        archive.expect(sum(os.path.getsize(path) for path, algos in disk_files))
+        entries = dict((pkg['name'], pkg) for pkg in file_info)
+        copied = set()
+        with tarfile.open(src_pkg, 'r|*') as tar:
+            for member in tar:
+                pkg = entries.get(member.name)
+                if pkg is None or not member.isfile() or member.name in copied:
+                    continue
+                chksum = archive.addfile(member, tar.extractfile(member), digests)
+                copied.add(member.name)
+                for algo in SUPPORTED_DIGESTS:
+                    old = pkg.get(algo+'_checksum')
+                    if old is not None and algo in chksum and old != chksum[algo]:
+                        logger.warning("%s checksum of %s doesn't match the package.mf of %s" %
+                                       (algo, member.name, src_pkg))
+                        print("Warning: %s checksum of %s doesn't match package.mf, updating it" %
+                              (algo, member.name))
+                    if algo in digests:
+                        pkg[algo+'_checksum'] = chksum[algo]
+                    elif algo+'_checksum' in pkg:
+                        del pkg[algo+'_checksum']
+        for name in entries:
+            if name not in copied:
+                raise IOError("File %s doesn't exist, Please make sure file in tar.gz and package.mf have same name." % name)
 
         #Add the root disk file to the metdata as well and update the checksum
-        for disk_count,disk in enumerate(options['root_disk_image']):
-            path, filename = extract_path(disk)
-            root_dict={}
+        for disk_count,(path, filename) in enumerate(disks):
+            root_dict=OrderedDict()
             root_dict['name'] = filename
             if (disk_count == 0):
                 root_dict['type'] = 'root_image'
@@ -1509,33 +3921,558 @@ def repackage(options, file_path, convert=False):
                 root_dict['type'] = 'ephemeral_disk{disk_count}_image'.format(disk_count=disk_count)
 
             path = os.path.abspath(path)
-            tar_cmd, chksum = recal_checksum(path, filename, tar_cmd, sha_type)
-            root_dict[sha_type] = chksum
-            pkg_dict['PackageContents']['File_Info'].append(root_dict)
-
-        pkg_val=(xmltodict.unparse(pkg_dict, pretty=True, full_document=False))
-        with open(os.path.join(src_path, pkgmf_file), "w+") as f:
-            if sha_type == 'sha256_checksum':
-                f.write("<!-- sha256sum - for calculating checksum -->\n")
+            chksum = recal_checksum(path, filename, archive, digests)
+            for algo in digests:
+                root_dict[algo+'_checksum'] = chksum[algo]
+            file_info.append(root_dict)
+
+        # package.mf carries the checksums of the new images, so it goes last
+        archive.addbytes(pkgmf_file, manifest_bytes(manifest, file_info, digests))
+        archive.close()
+        archive.print_report()
+    except:
+        if archive:
+            archive.abort()
+        raise
+    return target
+
+class Packager(object):
+    '''
+        Packager : library interface to the packaging tool.
+
+            packager = Packager(digests=['sha256'], compress_threads=2)
+            target = packager.build('spec.json')
+            packager.convert(target)
+            packager.repackage('metadata.tar.gz', ['isrv.qcow2'])
+
+        The keyword options are the archive options of the command line
+        (ARCHIVE_OPTIONS, e.g. compress_level, digests, no_cache). Every call
+        works on its own copy of them and its own BuildContext, so one
+        Packager can be used repeatedly and from several threads. Errors are
+        raised as PackagingError (PackageValidationError for bad specs or
+        options, PackageInternalError otherwise) with the errorCode,
+        errorType and key of the JSON error the tool prints; nothing calls
+        sys.exit. progress, a callable, is given the Progress events of
+        every package.
+    '''
+    def __init__(self, **options):
+        unknown = [key for key in options if key not in ARCHIVE_OPTIONS]
+        if unknown:
+            raise ValueError("Unknown packaging options: %s" % ', '.join(sorted(unknown)))
+        self.options = options
+
+    def _options(self):
+        options = copy.deepcopy(dict((key, value) for key, value in self.options.items()
+                                     if key != 'progress'))
+        if 'progress' in self.options:
+            options['progress'] = self.options['progress']
+        return options
+
+    def build(self, spec, timings=None, profile=None):
+        '''
+            build : build the package described by the --newjson spec file,
+                    returns the package file name.
+        '''
+        return package_from_json(spec, self._options(), timings, profile)
+
+    def convert(self, pkg_file, dest_dir=None):
+        '''
+            convert : write the vmanage supported vmanage_<name> of pkg_file
+                      to dest_dir (default: next to pkg_file), returns its
+                      file name.
+        '''
+        src_dir, pkg_name = extract_path(pkg_file)
+        dest_dir = self._dest_dir(dest_dir, src_dir)
+        return convert_package(self._options(), src_dir, pkg_name, dest_dir)
+
+    def repackage(self, pkg_file, images, dest_dir=None):
+        '''
+            repackage : write repackaged_<name> from the metadata package
+                        pkg_file and the vm images (root disk first) to
+                        dest_dir (default: next to pkg_file), returns its
+                        file name.
+        '''
+        if not images:
+            raise PackageValidationError('VM images is not provied, please provide the root_disk_image.',
+                                         key='root_disk_image')
+        src_dir, pkg_name = extract_path(pkg_file)
+        dest_dir = self._dest_dir(dest_dir, src_dir)
+        return repackage_package(self._options(), os.path.join(src_dir, pkg_name), list(images), dest_dir)
+
+    def _dest_dir(self, dest_dir, src_dir):
+        dest_dir = src_dir if dest_dir is None else dest_dir
+        if not os.path.isdir(dest_dir):
+            raise PackageInternalError('The destination path defined does not exist, please enter the correct path',
+                                       key=dest_dir)
+        return dest_dir
+
+class ServiceBusy(Exception):
+    '''
+        ServiceBusy : the job queue of the packaging service is full.
+    '''
+    pass
+
+class PackagingService(object):
+    '''
+        PackagingService : job queue of the serve subcommand. Build (a
+                           --newjson spec) and convert jobs are queued and
+                           run by a bounded pool of worker threads of this
+                           process, through one Packager, so xmltodict, the
+                           checksum cache and the parsed image_properties
+                           template stay warm from one job to the next.
+                           Finished jobs are kept for status queries, the
+                           SERVE_MAX_JOBS most recent ones. The progress of
+                           a running job (bytes, total, eta) is kept in its
+                           record; jobs run at the same time can't share a
+                           terminal line, so of the progress option only
+                           json or a callable is also given the events.
+    '''
+    def __init__(self, options=None, workers=1, queue_size=SERVE_QUEUE_SIZE, spool_dir=None):
+        options = dict(options or {})
+        progress = options.pop('progress', None)
+        self.forward = progress_callback(progress) if progress == 'json' or callable(progress) else None
+        self.current = threading.local()
+        options['progress'] = self._progress
+        self.packager = Packager(**options)
+        self.queue = Queue.Queue(queue_size)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.spool_dir = spool_dir or tempfile.mkdtemp(prefix='nfvpt-serve-')
+        self.workers = []
+        for _ in range(max(1, workers)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, request):
+        '''
+            submit : queue a job and return its status. request is a dict:
+                     {"type": "build", "spec": <spec path or spec object>} or
+                     {"type": "convert", "package": <path>, "dest_dir": <dir>}
+                     Raises ValueError for a malformed request and
+                     ServiceBusy when the queue is full.
+        '''
+        kind = request.get('type', 'build')
+        if kind == 'build':
+            source = request.get('spec')
+            if not isinstance(source, (basestring, dict)):
+                raise ValueError('a build job needs "spec", a spec file path or a spec object')
+        elif kind == 'convert':
+            source = request.get('package')
+            if not isinstance(source, basestring):
+                raise ValueError('a convert job needs "package", the path of the package')
+        else:
+            raise ValueError('unknown job type %s, expected build or convert' % kind)
+        with self.lock:
+            job = OrderedDict([('id', str(self.next_id)), ('type', kind),
+                               ('source', source if isinstance(source, basestring) else None),
+                               ('status', 'queued'), ('stage', None), ('submitted', time.time()),
+                               ('started', None), ('finished', None), ('output', None),
+                               ('error', None), ('timings', {}), ('progress', None)])
+            self.next_id += 1
+            if isinstance(source, dict):
+                job['source'] = os.path.join(self.spool_dir, 'job-%s.json' % job['id'])
+                with open(job['source'], 'w') as f:
+                    json.dump(source, f)
+            try:
+                self.queue.put_nowait((job, request.get('dest_dir')))
+            except Queue.Full:
+                raise ServiceBusy('the job queue is full (%d jobs), retry later' % self.queue.maxsize)
+            self.jobs[job['id']] = job
+            self._expire()
+            return self._view(job)
+
+    def job(self, job_id):
+        '''
+            job : status of one job, None for an unknown job.
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else self._view(job)
+
+    def list_jobs(self):
+        with self.lock:
+            return [self._view(job) for job in self.jobs.values()]
+
+    def shutdown(self):
+        '''
+            shutdown : cancel the queued jobs, let the running ones finish
+                       and stop the workers.
+        '''
+        while True:
+            try:
+                job, dest_dir = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            with self.lock:
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def _view(self, job):
+        view = OrderedDict(job)
+        # the worker adds timings without the lock; items() is atomic
+        view['timings'] = dict(job['timings'].items())
+        if job['status'] == 'running' and job['type'] == 'build':
+            # the build stages done so far are those with a timing
+            view['stage'] = next((stage for stage in PACKAGE_STAGES
+                                  if stage not in job['timings']), None)
+        return view
+
+    def _progress(self, event):
+        '''
+            _progress : Progress callback of the jobs, called on the worker
+                        thread running the job.
+        '''
+        job = getattr(self.current, 'job', None)
+        if job is not None:
+            with self.lock:
+                job['progress'] = OrderedDict((key, event[key]) for key in
+                                              ('phase', 'member', 'bytes', 'total',
+                                               'bytes_per_second', 'eta'))
+        if self.forward is not None:
+            self.forward(event)
+
+    def _expire(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job['status'] in ('ok', 'failed', 'cancelled')]
+        for job_id in finished[:max(0, len(self.jobs) - SERVE_MAX_JOBS)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            job, dest_dir = item
+            with self.lock:
+                job['status'] = 'running'
+                job['started'] = time.time()
+                if job['type'] == 'convert':
+                    job['stage'] = 'convert'
+            self.current.job = job
+            try:
+                if job['type'] == 'build':
+                    output = self.packager.build(job['source'], job['timings'])
+                else:
+                    output = self.packager.convert(job['source'], dest_dir)
+                status, error = 'ok', None
+            except PackagingError as e:
+                output, status = None, 'failed'
+                error = e.to_json() if e.errorCode else str(e)
+            except Exception as e:
+                logger.exception("job %s failed" % job['id'])
+                output, status = None, 'failed'
+                error = '%s: %s' % (type(e).__name__, e)
+            self.current.job = None
+            with self.lock:
+                job.update(status=status, stage=None, output=output, error=error,
+                           finished=time.time())
+
+# HTTP classes of serve/submit: request handler, servers and client
+# connections on a localhost port and on a unix socket
+ServiceHTTP = collections.namedtuple('ServiceHTTP', 'handler tcp_server unix_server '
+                                                    'tcp_connection unix_connection')
+_service_http = None
+
+def service_http():
+    '''
+        service_http : the ServiceHTTP classes, defined on first use so that
+                       the other commands don't import the HTTP modules.
+    '''
+    global _service_http
+    if _service_http is not None:
+        return _service_http
+    import socket
+    import hmac
+    import BaseHTTPServer
+    import SocketServer
+    import httplib
+    import urlparse
+
+    class _ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        '''
+            _ServiceHandler : JSON over HTTP front end of the PackagingService:
+                POST /jobs        queue a job (PackagingService.submit)
+                GET  /jobs        status of all the jobs
+                GET  /jobs/<id>   status of one job
+            On a TCP port every request carries the token of the service
+            as 'Authorization: Bearer <token>'.
+        '''
+        def _authorized(self):
+            token = getattr(self.server, 'token', None)
+            if token is None:
+                return True
+            if hmac.compare_digest(self.headers.getheader('authorization') or '', 'Bearer ' + token):
+                return True
+            self._reply(401, {'error': 'missing or wrong token, see --token_file'})
+            return False
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            path = urlparse.urlparse(self.path).path.rstrip('/')
+            if path == '/jobs':
+                self._reply(200, self.server.service.list_jobs())
+            elif path.startswith('/jobs/'):
+                job = self.server.service.job(path[len('/jobs/'):])
+                if job is None:
+                    self._reply(404, {'error': 'no such job'})
+                else:
+                    self._reply(200, job)
             else:
-                f.write("<!-- sha1sum - for calculating checksum -->\n")
-        with open(os.path.join(src_path, pkgmf_file), "a") as f:
-            f.write(pkg_val)
-        tar_cmd.extend(["-C", src_path, pkgmf_file])
-        print(tar_cmd)
-        subprocess.call(tar_cmd) # run the command
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-    except OSError:
-        logger.info('OSError occured while converting the package.')
-        subprocess.call(["rm", "-rf", str(temp_dir)])
-        pass
-    except Exception as e:
-        print 'Exception occured %s'%e
-        logger.info('Exception occured while converting the package.')
-        subprocess.call(["rm", "-rf", str(temp_dir)])
+                self._reply(404, {'error': 'unknown path %s' % path})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            if urlparse.urlparse(self.path).path.rstrip('/') != '/jobs':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                length = int(self.headers.getheader('content-length') or 0)
+                request = json.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise ValueError('the request must be a JSON object')
+                self._reply(202, self.server.service.submit(request))
+            except ServiceBusy as e:
+                self._reply(503, {'error': str(e)})
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+
+        def _reply(self, code, body):
+            data = json.dumps(body)
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # client_address is empty on a unix socket
+            logger.info('serve: ' + format % args)
+
+    class _HTTPServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    class _UnixServiceServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    class _UnixHTTPConnection(httplib.HTTPConnection):
+        def __init__(self, path, timeout=None):
+            httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+            self.path = path
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if self.timeout is not None:
+                self.sock.settimeout(self.timeout)
+            self.sock.connect(self.path)
+
+    _service_http = ServiceHTTP(_ServiceHandler, _HTTPServiceServer, _UnixServiceServer,
+                                httplib.HTTPConnection, _UnixHTTPConnection)
+    return _service_http
+
+def read_service_token(path, create=False):
+    '''
+        read_service_token : the token of a serve listening on a TCP port,
+                             from path, a file only its owner may read.
+                             With create, a missing file is created holding
+                             a random token.
+    '''
+    if create and not os.path.exists(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).encode('hex') + '\n')
+    if os.stat(path).st_mode & 0o077:
+        raise IOError('%s must only be readable by its owner (chmod 600 %s)' % (path, path))
+    with open(path) as f:
+        token = f.read().strip()
+    if not token:
+        raise IOError('%s holds no token' % path)
+    return token
+
+class ServiceClient(object):
+    '''
+        ServiceClient : client of a running 'nfvpt.py serve', over its unix
+                        socket or its localhost port with the token of the
+                        service.
+    '''
+    def __init__(self, socket_path=None, port=None, timeout=60, token=None):
+        if not socket_path and not port:
+            raise ValueError('a unix socket or a port of the service is needed')
+        self.socket_path = socket_path
+        self.port = port
+        self.timeout = timeout
+        self.token = token
+
+    def _request(self, method, path, body=None):
+        http = service_http()
+        if self.socket_path:
+            conn = http.unix_connection(self.socket_path, self.timeout)
+        else:
+            conn = http.tcp_connection('127.0.0.1', self.port, timeout=self.timeout)
+        try:
+            data = None if body is None else json.dumps(body)
+            headers = {'Content-Type': 'application/json'}
+            if self.token:
+                headers['Authorization'] = 'Bearer ' + self.token
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+            reply = json.loads(response.read(), object_pairs_hook=OrderedDict)
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise IOError('%s %s: %d %s' % (method, path, response.status, reply.get('error')))
+        return reply
+
+    def submit(self, request):
+        return self._request('POST', '/jobs', request)
+
+    def job(self, job_id):
+        return self._request('GET', '/jobs/%s' % job_id)
+
+    def jobs(self):
+        return self._request('GET', '/jobs')
+
+    def wait(self, job_id, interval=0.2):
+        '''
+            wait : poll the job until it is finished, returns its status.
+        '''
+        while True:
+            job = self.job(job_id)
+            if job['status'] not in ('queued', 'running'):
+                return job
+            time.sleep(interval)
+
+def serve(argv):
+    '''
+        serve : nfvpt.py serve - run the packaging service until interrupted.
+    '''
+    parser = argparse.ArgumentParser(prog='nfvpt.py serve',
+                                     description='packaging service: queue --newjson builds and '
+                                                 'conversions over a unix socket or localhost HTTP',
+                                     epilog='Trust model: a job names the files it reads (images, '
+                                            'bootstrap files, packages) and the directory it writes '
+                                            'to, and runs with the rights of the user running serve. '
+                                            'Whoever can reach the service can read and write files '
+                                            'as that user, so only they must: the unix socket is made '
+                                            'readable by its owner only, and on a TCP port every '
+                                            'request must carry the token of --token_file, a file only '
+                                            'its owner may read. Any local user can connect to a '
+                                            'localhost port; keep the token file private.')
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument('--socket', dest='socket_path', default=None,
+                           help='listen on this unix socket, only usable by its owner (recommended)')
+    transport.add_argument('--port', dest='port', type=int, default=None,
+                           help='listen on this localhost port instead, requires --token_file')
+    parser.add_argument('--token_file', '--token-file', dest='token_file', default=None,
+                        help='file holding the token clients of --port must send; created with a '
+                             'random token, readable by its owner only, when it does not exist')
+    parser.add_argument('--workers', dest='workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of jobs run at the same time; default is the number of CPUs')
+    parser.add_argument('--queue_size', '--queue-size', dest='queue_size', type=int,
+                        default=SERVE_QUEUE_SIZE,
+                        help='number of jobs that can wait; more are refused; default is %d'
+                             % SERVE_QUEUE_SIZE)
+    parser.add_argument('--log_dir', dest='log_dir', default=argparse.SUPPRESS,
+                        help='log file of the service')
+    add_archive_arguments(parser)
+    options = vars(parser.parse_args(argv))
+    token = None
+    if options['port'] is not None:
+        if not options['token_file']:
+            parser.error('--port requires --token_file, any local user can connect to it')
+        try:
+            token = read_service_token(options['token_file'], create=True)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+    if 'log_dir' in options:
+        initialize_logger(options)
+    archive_options = dict((key, options[key]) for key in ARCHIVE_OPTIONS if key in options)
+    service = PackagingService(archive_options, options['workers'], options['queue_size'])
+    http = service_http()
+    if options['socket_path']:
+        path = options['socket_path']
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        server = http.unix_server(path, http.handler)
+        os.chmod(path, 0o600)
+        where = path
+    else:
+        server = http.tcp_server(('127.0.0.1', options['port']), http.handler)
+        where = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.token = token
+    server.service = service
+    # SIGTERM stops the service like ^C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    print('Packaging service on %s with %d workers' % (where, options['workers']))
+    logger.info('Packaging service on %s with %d workers' % (where, options['workers']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
         pass
-    cleanup(options)
-    print ('Re-package Finished ##########')
+    finally:
+        server.server_close()
+        if options['socket_path'] and os.path.exists(options['socket_path']):
+            os.remove(options['socket_path'])
+        service.shutdown()
+
+def submit(argv):
+    '''
+        submit : nfvpt.py submit - queue specs (or packages to convert) on a
+                 running service and optionally wait for them.
+    '''
+    parser = argparse.ArgumentParser(prog='nfvpt.py submit',
+                                     description='queue jobs on a running nfvpt.py serve')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='--newjson spec files, or packages with --convert')
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument('--socket', dest='socket_path', default=None,
+                           help='unix socket of the service')
+    transport.add_argument('--port', dest='port', type=int, default=None,
+                           help='localhost port of the service, requires --token_file')
+    parser.add_argument('--token_file', '--token-file', dest='token_file', default=None,
+                        help='token file of the service listening on --port')
+    parser.add_argument('--convert', dest='convert', action='store_true',
+                        help='convert the packages instead of building specs')
+    parser.add_argument('--dest_dir', dest='dest_dir', default=None,
+                        help='destination directory of the converted packages')
+    parser.add_argument('--wait', dest='wait', action='store_true',
+                        help='wait for the jobs and exit with 1 if any failed')
+    options = parser.parse_args(argv)
+    token = None
+    if options.port is not None:
+        if not options.token_file:
+            parser.error('--port requires --token_file')
+        try:
+            token = read_service_token(options.token_file)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+    client = ServiceClient(options.socket_path, options.port, token=token)
+    jobs = []
+    try:
+        for path in options.files:
+            if options.convert:
+                request = {'type': 'convert', 'package': os.path.abspath(path), 'dest_dir': options.dest_dir}
+            else:
+                request = {'type': 'build', 'spec': os.path.abspath(path)}
+            jobs.append(client.submit(request))
+        if options.wait:
+            jobs = [client.wait(job['id']) for job in jobs]
+    except IOError as e:
+        # socket.error too: the service isn't running or refused the job
+        print(json.dumps(jobs, indent=2))
+        sys.exit('nfvpt.py submit: %s' % e)
+    print(json.dumps(jobs, indent=2))
+    if any(job['status'] == 'failed' for job in jobs):
+        sys.exit(1)
 
 def string_to_option(val, options, file_path):
     switcher = {
@@ -1547,18 +4484,272 @@ def string_to_option(val, options, file_path):
 
 
 def main():
+    try:
+        _main()
+    except PackagingError as e:
+        # errors found in the input are reported as JSON, the others as text
+        if e.errorCode is None:
+            print(e.errorMessage)
+            sys.exit()
+        sys.exit(e.to_json())
+
+def add_root_disk_argument(parser, required=False):
+    parser.add_argument("-i", "--root_disk_image",
+                        type=csv_arg_parse_case, required=required,
+                        help="[REQUIRED] List of root disk images to be bundled \
+                        example: --root_disk_image isrv.qcow2; --root_disk_image isrv1.qcow2,isrv2.qcow2")
+
+def add_batch_arguments(parser):
+    parser.add_argument('--batch_workers', '--batch-workers',
+                        help="Number of packages built or converted in parallel with --batch or a bulk convert; default is the number of cpus",
+                        type=int,
+                        default=argparse.SUPPRESS,
+                        dest="batch_workers")
+    parser.add_argument('--batch_report', '--batch-report',
+                        help="Where --batch or a bulk convert writes its JSON summary; default is batch_report.json or convert_report.json",
+                        default=argparse.SUPPRESS,
+                        dest="batch_report")
+
+def add_output_arguments(parser):
+    '''
+        add_output_arguments : verbosity, archive and cleanup options, shared
+                               by the main command line and the convert and
+                               repackage subcommands.
+    '''
+    parser.add_argument("-v", "--verbose",
+                      action="store_true", dest="verbose",
+                      help="verbose")
+    parser.add_argument("-q", "--quiet",
+                      action="store_false", dest="verbose",
+                      help="quiet")
+
+    add_archive_arguments(parser)
+    parser.add_argument("--cleanup",
+                       dest="cleanup",
+                       action="store_true",
+                       help="deletes all the input and configuration files upon tar file created ")
+
+def modify_command(command, argv):
+    '''
+        modify_command : nfvpt.py convert|repackage <package> - the
+                         --modify_package operations with a parser of
+                         their own options only.
+    '''
     print("\nCisco NFV-IS Packaging Tool \n")
     check_pythonversion()
+    parser = argparse.ArgumentParser(prog='nfvpt.py ' + command)
+    if command == 'convert':
+        parser.description = 'convert non-vmanaged packages to vmanaged packages'
+        parser.add_argument('file_path', metavar='PACKAGE',
+                            help='package to convert, or a directory or glob of packages')
+        add_batch_arguments(parser)
+    else:
+        parser.description = 'modify the vm_package using a predefined metadata file package'
+        parser.add_argument('file_path', metavar='PACKAGE', help='metadata package to repackage')
+        add_root_disk_argument(parser, required=True)
+    parser.add_argument('--dest_dir', default=argparse.SUPPRESS,
+                        help="specify the destination directory: --dest_dir /usr/share/")
+    add_output_arguments(parser)
+    options = vars(parser.parse_args(argv))
+    options['modify_package'] = command
+    string_to_option(command, options, options['file_path'])
+
+def add_archive_arguments(parser):
+    '''
+        add_archive_arguments : the options of how packages are written
+                                (ARCHIVE_OPTIONS), shared by the command
+                                line and the serve subcommand.
+    '''
+    parser.add_argument("--no_compress",
+                       dest="no_compress",
+                       action="store_true",
+                       help="creates tar file without compressing the input files (same as --compress none)")
+    parser.add_argument("--compress",
+                       choices=list(ARCHIVE_CODECS.keys()),
+                       type=str.lower,
+                       default="gzip",
+                       dest="compress",
+                       help="package codec: none (plain .tar), gzip (.tar.gz, default) or \
+                             zstd (.tar.zst, needs the zstandard module; for internal staging only)")
+    parser.add_argument("--compress_level",
+                       type=int,
+                       dest="compress_level",
+                       help="compression level of the codec; default is 6 for gzip and 3 for zstd")
+    parser.add_argument("--compress_report",
+                       dest="compress_report",
+                       action="store_true",
+                       help="print the size and time spent per package member")
+    parser.add_argument("--compress_threads", "--compress-threads",
+                       dest="compress_threads", type=int, default=1,
+                       help="number of threads compressing the package; the output is cut in \
+                             independently compressed blocks (pigz style) and stays a standard \
+                             .tar.gz; default is 1")
+    parser.add_argument("--digests",
+                       type=digests_arg_parse,
+                       dest="digests", default=argparse.SUPPRESS,
+                       help="comma separated checksums written to package.mf for every file, \
+                             computed in a single read: sha1, sha256 or sha1,sha256; default is sha256 \
+                             (repackage keeps the checksums of the original package.mf)")
+    parser.add_argument("--hash_workers", "--hash-workers",
+                       dest="hash_workers", type=int, default=1,
+                       help="hash the package members on up to N threads, one per checksum type, \
+                             while they are compressed and written; every file is still read once. \
+                             default is 1, hashing on the thread that writes the package")
+    parser.add_argument("--block_size", "--block-size",
+                       dest="block_size", type=size_arg_parse, default=argparse.SUPPRESS,
+                       help="read size used to hash and archive the files, e.g. 256K or 4M; default is 1M")
+    parser.add_argument("--keep_page_cache",
+                       dest="keep_page_cache",
+                       action="store_true",
+                       help="don't drop the images from the page cache once they are packaged")
+    parser.add_argument("--no_cache", "--no-cache",
+                       dest="no_cache",
+                       action="store_true",
+                       help="don't use the persistent checksum cache (~/.cache/nfvpt/checksums.db). \
+                             It keeps the checksums of images of 1M or more by file identity \
+                             (device, inode, size, mtime, ctime) and rehashes a sample of the \
+                             file before using one, so unchanged images aren't hashed again")
+    parser.add_argument("--index",
+                       dest="index",
+                       action="store_true",
+                       help="also write <package>%s, an index of where every member starts, \
+                             for 'nfvpt.py cat' to read single members without inflating the \
+                             whole package (gzip and uncompressed packages)" % PACKAGE_INDEX_SUFFIX)
+    parser.add_argument("--progress",
+                       dest="progress",
+                       choices=PROGRESS_MODES,
+                       default='auto',
+                       help="report the bytes hashed and archived, the current member, the throughput \
+                             and the ETA on stderr: a bar (auto: when stderr is a terminal) or JSON \
+                             lines; --batch builds report json only, serve keeps the progress \
+                             of every job in its status and reports json only")
+
+def validate_command(argv):
+    '''
+        validate_command : nfvpt.py validate - check --newjson specs against
+                           the schema, without reading any image, and report
+                           every violation of every spec.
+    '''
+    parser = argparse.ArgumentParser(prog='nfvpt.py validate',
+                                     description='validate --newjson specs, reporting all their errors')
+    parser.add_argument('specs', nargs='+', metavar='SPEC',
+                        help='spec files, directories of *.json specs or globs')
+    parser.add_argument('--report', dest='report', default=None,
+                        help='write the errors of every spec to this JSON file')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true',
+                        help='only print the specs with errors')
+    options = parser.parse_args(argv)
+    specs = []
+    for pattern in options.specs:
+        if os.path.isdir(pattern) or glob.has_magic(pattern):
+            specs.extend(batch_specs(pattern))
+        else:
+            specs.append(pattern)
+    start = time.time()
+    report = OrderedDict()
+    for spec in specs:
+        violations = validate_spec(spec)
+        report[spec] = [violation.to_dict() for violation in violations]
+        if violations:
+            print('%s: %d error(s)' % (spec, len(violations)))
+            for violation in violations:
+                print('    ' + violation.to_json())
+        elif not options.quiet:
+            print('%s: ok' % spec)
+    invalid = sum(1 for errors in report.values() if errors)
+    print('%d specs validated, %d with errors in %.3fs' % (len(specs), invalid, time.time() - start))
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if invalid else 0)
+
+def verify_command(argv):
+    '''
+        verify_command : nfvpt.py verify - check packages against their
+                         package.mf on --workers processes and print the
+                         JSON summary.
+    '''
+    parser = argparse.ArgumentParser(prog='nfvpt.py verify',
+                                     description='check that packages match their package.mf')
+    parser.add_argument('packages', nargs='+', metavar='PACKAGE',
+                        help='packages, directories of packages (*.tar.gz, *.tar) or globs')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='number of packages verified in parallel; default is the number of cpus')
+    parser.add_argument('--block_size', '--block-size', dest='block_size', type=size_arg_parse,
+                        default=None, help='read size used to hash the members, e.g. 256K or 4M; default is 1M')
+    parser.add_argument('--report', dest='report', default=None,
+                        help='also write the JSON summary to this file')
+    options = parser.parse_args(argv)
+    packages = []
+    for pattern in options.packages:
+        if os.path.isdir(pattern):
+            packages.extend(sorted(glob.glob(os.path.join(pattern, '*.tar.gz')) +
+                                   glob.glob(os.path.join(pattern, '*.tar'))))
+        elif glob.has_magic(pattern):
+            packages.extend(sorted(pkg for pkg in glob.glob(pattern) if os.path.isfile(pkg)))
+        else:
+            packages.append(pattern)
+    if not packages:
+        sys.exit('No package found for %s' % ' '.join(options.packages))
+    workers = options.workers or multiprocessing.cpu_count()
+    start = time.time()
+    results = run_batch_jobs(_verify_one, [(pkg, options.block_size) for pkg in packages], workers)
+    failed = [result for result in results if result['status'] != 'ok']
+    report = OrderedDict([('packages', len(results)), ('ok', len(results) - len(failed)),
+                          ('failed', len(failed)), ('seconds', time.time() - start),
+                          ('results', results)])
+    print(json.dumps(report, indent=2))
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+def cat_command(argv):
+    '''
+        cat_command : nfvpt.py cat - write members of a package to stdout,
+                      e.g. its image_properties.xml, reading only them when
+                      the package has an --index.
+    '''
+    parser = argparse.ArgumentParser(prog='nfvpt.py cat',
+                                     description='print members of a package, read through its '
+                                                 'index (<package>%s) when it has one' % PACKAGE_INDEX_SUFFIX)
+    parser.add_argument('package', metavar='PACKAGE')
+    parser.add_argument('members', nargs='+', metavar='MEMBER', help='e.g. image_properties.xml')
+    options = parser.parse_args(argv)
+    for name in options.members:
+        try:
+            for block in iter_package_member(options.package, name):
+                sys.stdout.write(block)
+        except KeyError:
+            sys.exit('%s has no member %s' % (options.package, name))
+        except (IOError, OSError, tarfile.TarError, zlib.error) as e:
+            sys.exit('Failed to read %s from %s: %s' % (name, options.package, e))
+    sys.stdout.flush()
+
+# subcommands given as the first argument, with their own options
+SUBCOMMANDS = {
+    'cat': cat_command,
+    'convert': lambda argv: modify_command('convert', argv),
+    'repackage': lambda argv: modify_command('repackage', argv),
+    'serve': serve,
+    'submit': submit,
+    'validate': validate_command,
+    'verify': verify_command,
+}
+
+def build_parser():
+    '''
+        build_parser : the parser of the main command line.
+    '''
     desc = 'Version: '+ VERSION + ' Cisco NFVIS: VNF image packaging utility'
-    parser = argparse.ArgumentParser(description=desc)
+    parser = argparse.ArgumentParser(description=desc,
+                                     epilog='subcommands, each with its own --help: '
+                                            'nfvpt.py {%s} ...' % ','.join(sorted(SUBCOMMANDS)))
     required = parser.add_argument_group('Required')
     required.add_argument("-o", "--package_filename",
                         help="[REQUIRED] file name for the target VNF package name- \
                         default is root disk image name with extension .tar.gz ")
-    required.add_argument("-i", "--root_disk_image",
-                        type=csv_arg_parse_case,
-                        help="[REQUIRED] List of root disk images to be bundled \
-                        example: --root_disk_image isrv.qcow2; --root_disk_image isrv1.qcow2,isrv2.qcow2")
+    add_root_disk_argument(required)
     required.add_argument("--prop_template",
                         dest="prop_template",
                         default="image_properties_template.xml",
@@ -1613,6 +4804,21 @@ def main():
     parser.add_argument('--log_dir',
                         help='Log Directory to for logfiles',
                         default=argparse.SUPPRESS)
+    parser.add_argument('--profile_report', '--profile-report',
+                        help="Write where the time of the build went (parse, validate, render, hash, archive, "
+                             "cleanup; bytes/s per hashed file; archive bytes in/out and ratio) as JSON to this file",
+                        default=argparse.SUPPRESS,
+                        dest="profile_report")
+    parser.add_argument('--profile_metrics', '--profile-metrics',
+                        help="Also write these timings as Prometheus metrics to this file, "
+                             "e.g. in the node_exporter textfile collector directory (*.prom)",
+                        default=argparse.SUPPRESS,
+                        dest="profile_metrics")
+    parser.add_argument('--batch',
+                        help="Build a package from every --newjson spec in a directory (*.json) or matching a glob",
+                        default=argparse.SUPPRESS,
+                        dest="batch")
+    add_batch_arguments(parser)
     parser.add_argument('--multi_use',
                         help='Add options for use in multiple use-cases',
                         action='store_true')
@@ -1683,21 +4889,10 @@ def main():
                       help="VM supports interface delete without power off.\
                             Default is set to false;\
                             --interface_hot_delete=true/false")
-    parser.add_argument("-v", "--verbose",
-                      action="store_true", dest="verbose",
-                      help="verbose")
-    parser.add_argument("-q", "--quiet",
-                      action="store_false", dest="verbose",
-                      help="quiet")
-
-    parser.add_argument("--no_compress",
-                       dest="no_compress",
-                       action="store_true",
-                       help="creates tar file without compressing the input files")
-    parser.add_argument("--cleanup",
-                       dest="cleanup",
-                       action="store_true",
-                       help="deletes all the input and configuration files upon tar file created ")
+    add_output_arguments(parser)
+    parser.add_argument("--verify_cache", "--verify-cache",
+                       dest="verify_cache", type=int, default=argparse.SUPPRESS, metavar="N",
+                       help="rehash a random sample of N files of the checksum cache, drop stale entries and exit")
 
     parser.add_argument("--tablet",
                       choices=['true','false'],
@@ -1798,6 +4993,19 @@ def main():
     modify_prop.add_argument('--dest_dir', default=argparse.SUPPRESS,
                             help="""specify the destination directory:\
                                     --dest_dir /usr/share/ """)
+    return parser
+
+def _main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    print("\nCisco NFV-IS Packaging Tool \n")
+    check_pythonversion()
+    parser = build_parser()
+
+    if '--verify_cache' in sys.argv or '--verify-cache' in sys.argv:
+        options = vars(parser.parse_args())
+        verify_checksum_cache(options['verify_cache'])
+        sys.exit()
 
     # if this tag is present conversion function get invokes 
     if '--modify_package' in sys.argv:
@@ -1814,6 +5022,12 @@ def main():
     else:
         options = vars(parser.parse_args())
 
+    if 'batch' in options:
+        if 'log_dir' in options:
+            initialize_logger(options)
+        results = batch_build(options)
+        sys.exit(1 if any(result['status'] != 'ok' for result in results) else 0)
+
     if 'pack' not in options:
         mandateappvendor = 'app_vendor' in options if options['ha_package'] else True
         mandatory_opts_present = ('vnf_type' in options and 'name' in options and
@@ -1829,22 +5043,27 @@ def main():
         if not os.path.exists(options['pack']):
             print ("Pack directory does not exist")
 
+    profile = None
+    if 'profile_report' in options or 'profile_metrics' in options:
+        profile = BuildProfile()
     if 'pack' in options:
         options['scratch_dir'] = options['pack']
         options['package_output_dir'] = options['pack']
+        build_context(options).profile = profile
         pack_files(options)
     elif 'newjson' in options:
-        template_dict = xmltodict.parse(image_properties_template_contents)
         initialize_logger(options)
         logger.info("************Cisco Cloud OnRamp for Colocation - VNF packaging************")
-        options = build_from_json(template_dict, options['newjson'])
-        make_image_prop_xml(template_dict,options)
-        if options['verbose']:
-            print("Creating the target file %s " % options['package_filename'])
+        package_from_json(options['newjson'], options, profile=profile)
+        if profile is not None:
+            write_profile_report(options, [profile.to_dict()])
+        return
     else:
+        build_context(options).profile = profile
         if options['verbose']:
             print("validating the input arguments")
-        validateArguments(options)
+        with profile_stage(options, 'validate'):
+            validateArguments(options)
         cur_dir = os.getcwd()
         options['scratch_dir'] = cur_dir
         options['package_output_dir'] = cur_dir
@@ -1852,13 +5071,16 @@ def main():
             print("compiling image properties in mode ")
         if options['prop_template'] == None:
             options['prop_template'] = "image_properties_template.xml"
-        with open(options['prop_template'],"r") as fd:
-            template_dict = xmltodict.parse(fd.read())
-        make_image_prop_xml(template_dict,options)
+        with profile_stage(options, 'parse'):
+            template_dict = image_properties_template(options['prop_template'])
+        with profile_stage(options, 'render'):
+            make_image_prop_xml(template_dict,options)
         if options['verbose']:
             print("Creating the target file %s " % options['package_filename'])
 
     buildTargetFile(options)
+    if profile is not None:
+        write_profile_report(options, [profile.to_dict()])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+# Fixtures shared by the nfvpt tests.
+#
+# The tests import nfvpt.py from the repository root and build small
+# packages from synthetic images in a temporary directory:
+#
+#   python -m pytest -q tests
+
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import nfvpt
+
+MB = 1024 * 1024
+
+nfvpt.logger.addHandler(logging.NullHandler())
+
+
+def payload(size, seed=1):
+    '''
+        payload : size bytes of half random, half repetitive data, so gzip
+                  has something to do and every block differs.
+    '''
+    rnd = random.Random(seed)
+    text = b'interface GigabitEthernet0\n ip address dhcp\n no shutdown\n' * 64
+    parts = []
+    total = 0
+    while total < size:
+        chunk = bytearray(rnd.getrandbits(8) for _ in range(256)) + text
+        parts.append(bytes(chunk))
+        total += len(chunk)
+    return b''.join(parts)[:size]
+
+
+def write_file(path, data):
+    path = str(path)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def write_sparse_file(path, size, extents, seed=1):
+    '''
+        write_sparse_file : file of size bytes holding data only at the
+                            (offset, length) extents, holes elsewhere.
+    '''
+    path = str(path)
+    with open(path, 'wb') as f:
+        for n, (offset, length) in enumerate(extents):
+            f.seek(offset)
+            f.write(payload(length, seed + n))
+        f.truncate(size)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def sha256(data):
+    # images are compared by digest, pytest's diff of two large strings is slow
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def spec(tmpdir):
+    '''
+        spec : a --newjson spec of a ROUTER package with a dense root disk,
+               a sparse ephemeral disk and two bootstrap files, all in
+               tmpdir; the package is written to tmpdir/out.
+    '''
+    directory = str(tmpdir)
+    out_dir = os.path.join(directory, 'out')
+    os.mkdir(out_dir)
+    write_file(os.path.join(directory, 'root.qcow2'), b'QFI\xfb' + payload(3 * MB))
+    write_sparse_file(os.path.join(directory, 'eph1.qcow2'), 8 * MB, [(0, 4096), (5 * MB, MB)], seed=7)
+    write_file(os.path.join(directory, 'day0.cfg'), b'hostname ${HOSTNAME}\n')
+    write_file(os.path.join(directory, 'meta.json'), b'{"role": "edge"}\n')
+    document = {
+        'vnf_type': 'ROUTER', 'package_filename': 'isrv-test', 'vnf_version': '17.3', 'vnf_name': 'isrv',
+        'app_vendor': 'cisco', 'package_output_dir': out_dir,
+        'image_properties': {'monitored': True, 'bootup_time': 600, 'privilege': False},
+        'resource_properties': {'vnic_max': 8, 'mgmt_vnic': 0, 'ha_capable': False},
+        'image_list': [{'image_name': 'root.qcow2', 'path': directory, 'disk': 'root'},
+                       {'image_name': 'eph1.qcow2', 'path': directory, 'disk': 'ephemeral1'}],
+        'bootstrap': {'file_list': [
+            {'name': 'day0.cfg', 'path': directory, 'mnt_point': '/', 'parse': True,
+             'ha_mode': 'standalone',
+             'userInput': [{'name': 'HOSTNAME', 'type': 'string', 'display_str': 'Hostname'}]},
+            {'name': 'meta.json', 'path': directory, 'mnt_point': '/', 'parse': False,
+             'ha_mode': 'standalone'}]},
+    }
+    spec_file = os.path.join(directory, 'spec.json')
+    with open(spec_file, 'w') as f:
+        json.dump(document, f)
+    return spec_file
+
+
+@pytest.fixture
+def build(spec):
+    '''
+        build : build(**options) builds the spec fixture with the archive
+                options given and returns the package file name.
+    '''
+    def build(**options):
+        options.setdefault('no_cache', True)
+        return nfvpt.Packager(**options).build(spec)
+    return build
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+import nfvpt
+from conftest import MB, payload, write_file, write_sparse_file, read_file, sha256
+
+
+def manifest_records(pkg_file):
+    return dict((record['name'], record) for record in
+                nfvpt.manifest_file_info(nfvpt.read_package_manifest(pkg_file)))
+
+
+def test_build_hashes_what_it_archives(build):
+    package = build(digests=['sha1', 'sha256'])
+    records = manifest_records(package)
+    with tarfile.open(package) as tar:
+        names = tar.getnames()
+        assert sorted(names) == sorted(['root.qcow2', 'eph1.qcow2', 'day0.cfg', 'meta.json',
+                                        'image_properties.xml', 'system_generated_properties.xml',
+                                        nfvpt.pkgmf_file])
+        for name in names:
+            if name == nfvpt.pkgmf_file:
+                continue
+            data = tar.extractfile(name).read()
+            assert records[name]['sha1_checksum'] == hashlib.sha1(data).hexdigest()
+            assert records[name]['sha256_checksum'] == sha256(data)
+
+
+def test_build_reads_every_file_once(build, spec, monkeypatch):
+    opened = []
+
+    class CountingReader(nfvpt.FileReader):
+        def __init__(self, path, *args, **kwargs):
+            opened.append(os.path.basename(path))
+            super(CountingReader, self).__init__(path, *args, **kwargs)
+
+    monkeypatch.setattr(nfvpt, 'FileReader', CountingReader)
+    build(digests=['sha1', 'sha256'])
+    assert sorted(opened) == sorted(['root.qcow2', 'eph1.qcow2', 'day0.cfg', 'meta.json',
+                                     'image_properties.xml', 'system_generated_properties.xml',
+                                     nfvpt.pkgmf_file])
+
+
+def test_package_extracts_with_tar(build, tmpdir):
+    package = build()
+    extracted = tmpdir.mkdir('x')
+    subprocess.check_call(['tar', '-xzf', package, '-C', str(extracted)])
+    for name in ('root.qcow2', 'meta.json'):
+        assert sha256(read_file(str(extracted.join(name)))) == sha256(read_file(str(tmpdir.join(name))))
+    with tarfile.open(package) as tar:
+        member = tar.getmember('root.qcow2')
+        assert member.mode == os.stat(str(tmpdir.join('root.qcow2'))).st_mode & 0o7777
+        assert member.mtime == int(os.path.getmtime(str(tmpdir.join('root.qcow2'))))
+
+
+def test_member_changing_size_aborts(tmpdir, monkeypatch):
+    image = write_file(tmpdir.join('root.qcow2'), payload(MB))
+    package = str(tmpdir.join('p.tar.gz'))
+    archive = nfvpt.PackageArchive(package)
+    # the header says 1 MiB, the file grows before it is copied
+    tarinfo_for = nfvpt._tarinfo_for
+
+    def grow(path, arcname):
+        tarinfo = tarinfo_for(path, arcname)
+        with open(path, 'ab') as f:
+            f.write(b'more')
+        return tarinfo
+
+    monkeypatch.setattr(nfvpt, '_tarinfo_for', grow)
+    with pytest.raises(IOError):
+        archive.add(image)
+    archive.abort()
+    assert not os.path.exists(package)
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'none'])
+def test_sparse_image_round_trip(tmpdir, codec):
+    image = write_sparse_file(tmpdir.join('eph.qcow2'), 16 * MB, [(0, 4096), (3 * MB, MB), (9 * MB, 8192)])
+    package = str(tmpdir.join('sparse.tar'))
+    archive = nfvpt.PackageArchive(package, codec=codec)
+    checksums = archive.add(image)
+    archive.close()
+    data = read_file(image)
+    assert checksums['sha256'] == sha256(data)
+    # only the extents are stored
+    assert os.path.getsize(package) < 4 * MB
+    with tarfile.open(package) as tar:
+        member = tar.getmember('eph.qcow2')
+        assert member.issparse()
+        assert sha256(tar.extractfile(member).read()) == sha256(data)
+    extracted = tmpdir.mkdir('x')
+    subprocess.check_call(['tar', '-xSf', package, '-C', str(extracted)])
+    assert sha256(read_file(str(extracted.join('eph.qcow2')))) == sha256(data)
+
+
+def test_sparse_image_hashes_holes_unread(tmpdir, monkeypatch):
+    image = write_sparse_file(tmpdir.join('eph.qcow2'), 8 * MB, [(MB, 4096)])
+    read = []
+    chunks = nfvpt.FileReader.chunks
+
+    def counting_chunks(self, offset=0, length=None):
+        for buf in chunks(self, offset, length):
+            read.append(len(buf))
+            yield buf
+
+    monkeypatch.setattr(nfvpt.FileReader, 'chunks', counting_chunks)
+    archive = nfvpt.PackageArchive(str(tmpdir.join('sparse.tar')), codec='none')
+    checksums = archive.add(image)
+    archive.close()
+    assert sum(read) == 4096
+    assert checksums['sha256'] == sha256(read_file(image))
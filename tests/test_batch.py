@@ -0,0 +1,68 @@
+import json
+import os
+import tarfile
+
+import pytest
+
+import nfvpt
+from conftest import read_file, sha256
+
+
+def write_spec(spec, path, **changes):
+    with open(spec) as f:
+        document = json.load(f)
+    document.update(changes)
+    with open(path, 'w') as f:
+        json.dump(document, f)
+    return path
+
+
+@pytest.fixture
+def batch_dir(spec, tmpdir):
+    '''
+        batch_dir : three specs, two packages sharing the images of the spec
+                    fixture and one whose root image is missing.
+    '''
+    specs = tmpdir.mkdir('specs')
+    write_spec(spec, str(specs.join('a.json')), package_filename='isrv-a')
+    write_spec(spec, str(specs.join('b.json')), package_filename='isrv-b')
+    with open(spec) as f:
+        images = json.load(f)['image_list']
+    images[0] = dict(images[0], image_name='missing.qcow2')
+    write_spec(spec, str(specs.join('bad.json')), package_filename='isrv-bad', image_list=images)
+    return specs
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_batch_isolates_failures(batch_dir, tmpdir, capsys, workers):
+    report_file = str(tmpdir.join('report.json'))
+    results = nfvpt.batch_build({'batch': str(batch_dir), 'batch_workers': workers,
+                                 'batch_report': report_file, 'no_cache': True})
+    status = dict((os.path.basename(result['source']), result['status']) for result in results)
+    assert status == {'a.json': 'ok', 'b.json': 'ok', 'bad.json': 'failed'}
+    bad = [result for result in results if result['status'] == 'failed'][0]
+    assert 'missing.qcow2' in json.dumps(bad['error'])
+    assert bad['output'] is None
+
+    with open(report_file) as f:
+        report = json.load(f)
+    assert (report['packages'], report['ok'], report['failed']) == (3, 2, 1)
+    # root.qcow2 and eph1.qcow2 are used by both good specs
+    assert sorted(os.path.basename(item['image']) for item in report['shared_images']) == \
+        ['eph1.qcow2', 'root.qcow2']
+
+    root = sha256(read_file(str(tmpdir.join('root.qcow2'))))
+    for result in results:
+        if result['status'] != 'ok':
+            continue
+        with tarfile.open(result['output']) as tar:
+            assert sha256(tar.extractfile('root.qcow2').read()) == root
+        verified = nfvpt.verify_package(result['output'])
+        assert not (verified['mismatched'] or verified['missing'] or verified['extra'])
+    assert '2 packages done, 1 failed' in capsys.readouterr().out
+
+
+def test_batch_without_specs_exits(tmpdir):
+    with pytest.raises(SystemExit) as e:
+        nfvpt.batch_build({'batch': str(tmpdir.mkdir('empty'))})
+    assert e.value.code == 1
@@ -0,0 +1,104 @@
+import os
+import sqlite3
+
+import pytest
+
+import nfvpt
+from conftest import MB, payload, write_file, read_file, sha256
+
+# the cache only serves files this big
+SIZE = nfvpt.CHECKSUM_CACHE_MIN_SIZE + 4096
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return nfvpt.ChecksumCache(str(tmpdir.join('checksums.db')))
+
+
+def archive_checksums(tmpdir, cache, image, name='p.tar'):
+    archive = nfvpt.PackageArchive(str(tmpdir.join(name)), codec='none', cache=cache)
+    checksums = archive.add(image, digests=['sha1', 'sha256'])
+    archive.close()
+    return checksums
+
+
+def test_store_and_lookup(tmpdir, cache):
+    image = write_file(tmpdir.join('root.qcow2'), payload(SIZE))
+    st = os.stat(image)
+    cache.store(image, {'sha1': 'a' * 40, 'sha256': 'b' * 64}, st)
+    assert cache.lookup(image, ['sha256']) == {'sha256': 'b' * 64}
+    assert cache.lookup(image, ['sha1', 'sha256'], st) == {'sha1': 'a' * 40, 'sha256': 'b' * 64}
+    other = write_file(tmpdir.join('other.qcow2'), payload(SIZE))
+    assert cache.lookup(other, ['sha256']) == {}
+
+
+def test_archive_uses_cache_hits(tmpdir, cache):
+    image = write_file(tmpdir.join('root.qcow2'), payload(SIZE))
+    checksums = archive_checksums(tmpdir, cache, image)
+    assert checksums['sha256'] == sha256(read_file(image))
+    assert cache.lookup(image, ['sha1', 'sha256']) == checksums
+    # a hit is returned without hashing the file again
+    cache.store(image, {'sha256': 'c' * 64}, os.stat(image))
+    assert archive_checksums(tmpdir, cache, image, 'second.tar')['sha256'] == 'c' * 64
+
+
+def test_archive_rehashes_file_changed_in_place(tmpdir, cache):
+    image = write_file(tmpdir.join('root.qcow2'), payload(SIZE, seed=1))
+    os.utime(image, (1500000000, 1500000000))
+    archive_checksums(tmpdir, cache, image)
+    # same inode, size and mtime, other contents (rsync --inplace, touch -r)
+    with open(image, 'r+b') as f:
+        f.write(b'changed')
+    os.utime(image, (1500000000, 1500000000))
+    checksums = archive_checksums(tmpdir, cache, image, 'second.tar')
+    assert checksums['sha256'] == sha256(read_file(image))
+    assert cache.lookup(image, ['sha256']) == {'sha256': checksums['sha256']}
+
+
+@pytest.mark.parametrize('offset', [0, SIZE // 2, SIZE - 1])
+def test_sample_mismatch_drops_the_entry(tmpdir, cache, offset):
+    image = write_file(tmpdir.join('root.qcow2'), payload(SIZE))
+    st = os.stat(image)
+    cache.store(image, {'sha256': sha256(read_file(image))}, st)
+    with open(image, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'!')
+    # as if the identity had survived the change
+    assert cache.lookup(image, ['sha256'], st) == {}
+    assert cache.db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0] == 0
+
+
+def test_eviction(tmpdir):
+    cache = nfvpt.ChecksumCache(str(tmpdir.join('checksums.db')), max_entries=2)
+    images = [write_file(tmpdir.join('%d.qcow2' % n), payload(4096, seed=n)) for n in range(3)]
+    for image in images:
+        cache.store(image, {'sha256': sha256(read_file(image))}, os.stat(image))
+    assert cache.lookup(images[0], ['sha256']) == {}
+    assert cache.lookup(images[2], ['sha256']) == {'sha256': sha256(read_file(images[2]))}
+
+
+def test_older_database_is_replaced(tmpdir):
+    path = str(tmpdir.join('checksums.db'))
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE checksums (dev INTEGER, ino INTEGER, size INTEGER, mtime TEXT, '
+               'algo TEXT, digest TEXT, path TEXT, last_used REAL, '
+               'PRIMARY KEY (dev, ino, size, mtime, algo))')
+    db.commit()
+    db.close()
+    cache = nfvpt.ChecksumCache(path)
+    image = write_file(tmpdir.join('root.qcow2'), payload(4096))
+    cache.store(image, {'sha256': sha256(read_file(image))}, os.stat(image))
+    assert cache.lookup(image, ['sha256']) == {'sha256': sha256(read_file(image))}
+
+
+def test_verify_drops_stale_entries(tmpdir, cache):
+    kept = write_file(tmpdir.join('kept.qcow2'), payload(4096, seed=1))
+    changed = write_file(tmpdir.join('changed.qcow2'), payload(4096, seed=2))
+    removed = write_file(tmpdir.join('removed.qcow2'), payload(4096, seed=3))
+    for image in (kept, changed, removed):
+        cache.store(image, {'sha256': sha256(read_file(image))}, os.stat(image))
+    write_file(changed, payload(MB))
+    os.remove(removed)
+    results = sorted((os.path.basename(path), status) for path, algo, status in cache.verify(10))
+    assert results == [('changed.qcow2', 'stale'), ('kept.qcow2', 'ok'), ('removed.qcow2', 'missing')]
+    assert cache.db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0] == 1
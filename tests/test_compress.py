@@ -0,0 +1,85 @@
+import gzip
+import io
+import os
+import subprocess
+import tarfile
+import zlib
+
+import pytest
+
+import nfvpt
+from conftest import payload, read_file, sha256
+
+
+def gzip_stream(data, level=6, threads=1, write_size=300007):
+    out = io.BytesIO()
+    writer = nfvpt.ParallelGzipWriter(out, level=level, threads=threads)
+    # odd write sizes, so blocks are cut across writes
+    for offset in range(0, len(data), write_size):
+        writer.write(data[offset:offset + write_size])
+    writer.close()
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('threads', [1, 2, 4])
+def test_parallel_gzip_inflates_to_input(threads):
+    data = payload(3 * nfvpt.GZIP_BLOCK_SIZE + 12345)
+    stream = gzip_stream(data, threads=threads)
+    assert sha256(gzip.GzipFile(fileobj=io.BytesIO(stream)).read()) == sha256(data)
+    # a single gzip member: nothing follows the trailer
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    inflater.decompress(stream)
+    assert inflater.unused_data == b''
+
+
+def test_parallel_gzip_empty_and_tiny_inputs():
+    for data in (b'', b'x', payload(nfvpt.GZIP_BLOCK_SIZE)):
+        assert gzip.GzipFile(fileobj=io.BytesIO(gzip_stream(data, threads=3))).read() == data
+
+
+def test_parallel_gzip_package(build, tmpdir):
+    package = build(compress_threads=3)
+    subprocess.check_call(['gzip', '-t', package])
+    with tarfile.open(package) as tar:
+        root = tar.extractfile('root.qcow2').read()
+    assert sha256(root) == sha256(read_file(str(tmpdir.join('root.qcow2'))))
+
+
+@pytest.mark.parametrize('filename,options,expected', [
+    ('isrv.tar.gz', {}, 'isrv.tar.gz'),
+    ('isrv.tar.gz', {'no_compress': True}, 'isrv.tar'),
+    ('isrv.tar.gz', {'compress': 'zstd'}, 'isrv.tar.zst'),
+    ('isrv.tar', {'compress': 'gzip'}, 'isrv.tar.gz'),
+    ('isrv', {'compress': 'none'}, 'isrv.tar'),
+    # --no_compress wins over --compress
+    ('isrv.tar.zst', {'compress': 'zstd', 'no_compress': True}, 'isrv.tar'),
+])
+def test_package_target(filename, options, expected):
+    assert nfvpt.package_target(filename, options) == expected
+
+
+def test_no_compress_writes_a_plain_tar(build, tmpdir):
+    package = build(no_compress=True)
+    assert package.endswith('.tar')
+    with open(package, 'rb') as f:
+        assert f.read(2) != b'\x1f\x8b'
+    with tarfile.open(package, 'r:') as tar:
+        assert sha256(tar.extractfile('root.qcow2').read()) == sha256(read_file(str(tmpdir.join('root.qcow2'))))
+
+
+def test_zstd_package(build, tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    package = build(compress='zstd', compress_level=1)
+    assert package.endswith('.tar.zst')
+    with open(package, 'rb') as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert sha256(tar.extractfile('root.qcow2').read()) == sha256(read_file(str(tmpdir.join('root.qcow2'))))
+
+
+def test_compress_level(build):
+    fast = build(compress_level=1)
+    fast_size = os.path.getsize(fast)
+    best = build(compress_level=9)
+    assert best == fast
+    assert os.path.getsize(best) < fast_size
@@ -0,0 +1,157 @@
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+
+import pytest
+import xmltodict
+
+import nfvpt
+from conftest import payload, write_file, sha256
+
+
+def package_members(path):
+    members = {}
+    with tarfile.open(path) as tar:
+        for member in tar:
+            members[member.name] = tar.extractfile(member).read()
+    return members
+
+
+def run_cli(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['nfvpt.py'] + list(argv))
+    with pytest.raises(SystemExit) as e:
+        nfvpt.main()
+        sys.exit(0)
+    return e.value.code
+
+
+@pytest.fixture
+def source(build):
+    return build()
+
+
+def test_convert_round_trip(source, tmpdir):
+    old = package_members(source)
+    src_dir, pkg_name = os.path.split(source)
+    target = nfvpt.convert_package({'no_cache': True}, src_dir, pkg_name, str(tmpdir))
+    assert os.path.basename(target) == 'vmanage_' + pkg_name
+    new = package_members(target)
+    assert sorted(new) == sorted(old)
+    for name in ('root.qcow2', 'eph1.qcow2', 'day0.cfg', 'meta.json', 'system_generated_properties.xml'):
+        assert sha256(new[name]) == sha256(old[name])
+    properties = xmltodict.parse(new['image_properties.xml'])['image_properties']
+    assert properties['imageType'] == 'virtualmachine'
+    entries = list(nfvpt.iter_manifest(io.BytesIO(new[nfvpt.pkgmf_file])))
+    assert entries[0] == (nfvpt.PACKAGING_VERSION_TAG, '1.0')
+    result = nfvpt.verify_package(target)
+    assert not (result['mismatched'] or result['missing'] or result['extra'])
+
+
+def test_convert_image_properties():
+    template_dict = xmltodict.parse(
+        '<image_properties><version>1_2</version><profiles><profile>small</profile></profiles>'
+        '<custom_property><UUID>abc</UUID></custom_property>'
+        '<custom_property><mode>routed</mode><mode>transparent</mode></custom_property>'
+        '</image_properties>')
+    properties = nfvpt.convert_image_properties(template_dict)['image_properties']
+    assert properties['version'] == '1-2'
+    assert 'profiles' not in properties
+    assert properties['imageType'] == 'virtualmachine'
+    uuid, mode = properties['custom_property']
+    assert (uuid['type'], uuid['name']['#text'], uuid['val']) == ('string', 'UUID', 'abc')
+    assert (mode['type'], mode['name']['@display']) == ('selection', 'mode')
+    assert [val['#text'] for val in mode['val']] == ['routed', 'transparent']
+
+
+def test_convert_cli(source, tmpdir, monkeypatch, capsys):
+    capsys.readouterr()
+    dest = tmpdir.mkdir('dest')
+    assert run_cli(monkeypatch, 'convert', source, '--dest_dir', str(dest), '--no_cache') in (0, None)
+    out = capsys.readouterr().out
+    assert out.count('Conversion Started') == 1 and 'Conversion started' not in out
+    assert 'Conversion Finished' in out
+    assert os.path.isfile(str(dest.join('vmanage_' + os.path.basename(source))))
+
+
+def test_convert_corrupt_package_exits_non_zero(tmpdir, monkeypatch, capsys):
+    corrupt = write_file(tmpdir.join('corrupt.tar.gz'), b'\x1f\x8b' + payload(4096))
+    code = run_cli(monkeypatch, 'convert', corrupt, '--no_cache')
+    assert code not in (0, None)
+    error = json.loads(code)
+    assert error['errorType'] == nfvpt.INTERNAL_ERROR
+    assert error['key'] == 'corrupt.tar.gz'
+    assert 'Conversion Finished' not in capsys.readouterr().out
+    assert not os.path.exists(str(tmpdir.join('vmanage_corrupt.tar.gz')))
+
+
+def test_convert_missing_destination_exits_non_zero(source, tmpdir, monkeypatch):
+    code = run_cli(monkeypatch, 'convert', source, '--dest_dir', str(tmpdir.join('missing')))
+    assert json.loads(code)['key'] == 'dest_dir'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_bulk_convert_isolates_failures(source, tmpdir, monkeypatch, capsys, workers):
+    packages = tmpdir.mkdir('packages')
+    for name in ('a.tar.gz', 'b.tar.gz'):
+        shutil.copy(source, str(packages.join(name)))
+    write_file(packages.join('corrupt.tar.gz'), b'\x1f\x8b' + payload(4096))
+    report_file = str(tmpdir.join('convert_report.json'))
+    code = run_cli(monkeypatch, 'convert', str(packages), '--batch_workers', str(workers),
+                   '--batch_report', report_file, '--no_cache')
+    assert code == 1
+    with open(report_file) as f:
+        report = json.load(f)
+    assert (report['packages'], report['ok'], report['failed']) == (3, 2, 1)
+    status = dict((os.path.basename(result['source']), result['status']) for result in report['results'])
+    assert status == {'a.tar.gz': 'ok', 'b.tar.gz': 'ok', 'corrupt.tar.gz': 'failed'}
+    for name in ('a.tar.gz', 'b.tar.gz'):
+        result = nfvpt.verify_package(str(packages.join('vmanage_' + name)))
+        assert not (result['mismatched'] or result['missing'] or result['extra'])
+
+    # the vmanage_ outputs of the first run are not converted again
+    os.remove(str(packages.join('corrupt.tar.gz')))
+    assert run_cli(monkeypatch, 'convert', str(packages), '--batch_report', report_file, '--no_cache') == 0
+    with open(report_file) as f:
+        assert json.load(f)['packages'] == 2
+
+
+def test_bulk_convert_glob(source, tmpdir):
+    shutil.copy(source, str(tmpdir.join('x.tar.gz')))
+    results = nfvpt.bulk_convert({'batch_workers': 1, 'batch_report': str(tmpdir.join('r.json')),
+                                  'no_cache': True}, str(tmpdir.join('*.tar.gz')))
+    assert [(os.path.basename(result['source']), result['status']) for result in results] == \
+        [('x.tar.gz', 'ok')]
+
+
+@pytest.mark.parametrize('vnf_type', ['ROUTER', 'FIREWALL'])
+def test_convert_built_package(spec, tmpdir, vnf_type):
+    # the properties of a built package are in the vmanage format already:
+    # a single one (userInput HOSTNAME) or a list (with firewallMode)
+    with open(spec) as f:
+        document = json.load(f)
+    document['vnf_type'] = vnf_type
+    with open(spec, 'w') as f:
+        json.dump(document, f)
+    package = nfvpt.Packager(no_cache=True).build(spec)
+    target = nfvpt.Packager(no_cache=True).convert(package, str(tmpdir))
+    old = xmltodict.parse(package_members(package)['image_properties.xml'])['image_properties']
+    new = xmltodict.parse(package_members(target)['image_properties.xml'])['image_properties']
+    assert new['custom_property'] == old['custom_property']
+    names = [prop['name']['#text'] for prop in
+             (new['custom_property'] if vnf_type == 'FIREWALL' else [new['custom_property']])]
+    assert names == (['HOSTNAME', 'firewallMode'] if vnf_type == 'FIREWALL' else ['HOSTNAME'])
+    result = nfvpt.verify_package(target)
+    assert not (result['mismatched'] or result['missing'] or result['extra'])
+
+
+def test_convert_single_legacy_property():
+    template_dict = xmltodict.parse('<image_properties><custom_property><UUID>abc</UUID></custom_property>'
+                                    '</image_properties>')
+    properties = nfvpt.convert_image_properties(template_dict)['image_properties']
+    [uuid] = properties['custom_property']
+    assert (uuid['type'], uuid['name']['#text'], uuid['val']) == ('string', 'UUID', 'abc')
+    template_dict = xmltodict.parse('<image_properties><custom_property/></image_properties>')
+    assert nfvpt.convert_image_properties(template_dict)['image_properties']['custom_property'] is None
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import tarfile
+
+import pytest
+
+import nfvpt
+from conftest import MB, payload, write_file, read_file, sha256
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4])
+def test_threaded_hasher_matches_multi_hasher(workers):
+    data = payload(3 * MB + 17)
+    blocks = [data[offset:offset + 100003] for offset in range(0, len(data), 100003)]
+    inline = nfvpt.MultiHasher(['sha1', 'sha256'])
+    threaded = nfvpt.ThreadedHasher(['sha1', 'sha256'], workers)
+    for hasher in (inline, threaded):
+        for block in blocks:
+            hasher.update(block)
+        hasher.update_zeros(5000)
+    expected = {'sha1': hashlib.sha1(data + b'\0' * 5000).hexdigest(),
+                'sha256': sha256(data + b'\0' * 5000)}
+    assert inline.hexdigests() == expected
+    assert threaded.hexdigests() == expected
+    assert not threaded.threads
+
+
+def test_hash_workers_read_every_file_once(build, monkeypatch, tmpdir):
+    opened = []
+
+    class CountingReader(nfvpt.FileReader):
+        def __init__(self, path, *args, **kwargs):
+            opened.append(os.path.basename(path))
+            super(CountingReader, self).__init__(path, *args, **kwargs)
+
+    monkeypatch.setattr(nfvpt, 'FileReader', CountingReader)
+    package = build(digests=['sha1', 'sha256'], hash_workers=2)
+    assert opened.count('root.qcow2') == 1
+    assert opened.count('eph1.qcow2') == 1
+    records = dict((record['name'], record) for record in
+                   nfvpt.manifest_file_info(nfvpt.read_package_manifest(package)))
+    with tarfile.open(package) as tar:
+        for name in ('root.qcow2', 'eph1.qcow2'):
+            data = tar.extractfile(name).read()
+            assert records[name]['sha1_checksum'] == hashlib.sha1(data).hexdigest()
+            assert records[name]['sha256_checksum'] == sha256(data)
+
+
+def test_hash_threads_stop_when_the_copy_fails(tmpdir, monkeypatch):
+    image = write_file(tmpdir.join('root.qcow2'), payload(4 * MB))
+    archive = nfvpt.PackageArchive(str(tmpdir.join('p.tar')), codec='none', hash_workers=2)
+    hashers = []
+    make_hasher = archive._hasher
+
+    def hasher(algos, size):
+        hashers.append(make_hasher(algos, size))
+        return hashers[-1]
+
+    def fail(path, tarinfo, hasher):
+        hasher.update(b'x' * MB)
+        raise IOError('disk full')
+
+    monkeypatch.setattr(archive, '_hasher', hasher)
+    monkeypatch.setattr(archive, '_copy_member', fail)
+    with pytest.raises(IOError):
+        archive.add(image, digests=['sha1', 'sha256'])
+    archive.abort()
+    assert isinstance(hashers[0], nfvpt.ThreadedHasher)
+    assert not hashers[0].threads
+
+
+def test_precompute_needs_the_cache(tmpdir):
+    image = write_file(tmpdir.join('root.qcow2'), payload(2 * MB))
+    assert nfvpt.precompute_checksums([(image, ['sha256'])], {'no_cache': True}) == [None]
+
+
+def test_cached_build_writes_the_manifest_first(build, monkeypatch, tmpdir):
+    monkeypatch.setattr(nfvpt, '_checksum_cache', nfvpt.ChecksumCache(str(tmpdir.join('checksums.db'))))
+    first = build(no_cache=False, hash_workers=2)
+    with tarfile.open(first) as tar:
+        names = tar.getnames()
+    assert names[-1] == nfvpt.pkgmf_file
+    manifest = nfvpt.read_package_manifest(first)
+
+    # every image is cached now, package.mf goes ahead of them
+    second = build(no_cache=False, hash_workers=2)
+    with tarfile.open(second) as tar:
+        names = tar.getnames()
+        root = tar.extractfile('root.qcow2').read()
+    assert names.index(nfvpt.pkgmf_file) < names.index('root.qcow2')
+    assert nfvpt.read_package_manifest(second) == manifest
+    assert sha256(root) == sha256(read_file(str(tmpdir.join('root.qcow2'))))
@@ -0,0 +1,52 @@
+import os
+import tarfile
+
+import pytest
+
+import nfvpt
+from conftest import sha256
+
+
+def test_metadata_ahead_of_the_images(build):
+    with tarfile.open(build()) as tar:
+        names = tar.getnames()
+    # without cached checksums package.mf is written last, after the images
+    assert names == ['image_properties.xml', 'system_generated_properties.xml', 'day0.cfg', 'meta.json',
+                     'root.qcow2', 'eph1.qcow2', nfvpt.pkgmf_file]
+
+
+@pytest.mark.parametrize('options', [{}, {'compress_threads': 2}, {'no_compress': True}],
+                         ids=['gzip', 'threads', 'none'])
+def test_indexed_member_matches_extract(build, options):
+    package = build(index=True, **options)
+    index = nfvpt.load_package_index(package)
+    assert index is not None
+    with tarfile.open(package) as tar:
+        names = tar.getnames()
+        # python 2 tarfile can't extract a sparse member twice, read each once
+        extracted = dict((name, sha256(tar.extractfile(name).read())) for name in names)
+    assert [entry['name'] for entry in index['members']] == names
+    for name in names:
+        for block_size in (None, 4096):
+            assert sha256(b''.join(nfvpt.iter_package_member(package, name, block_size))) == \
+                extracted[name], name
+
+
+def test_cat_command(build, capsys):
+    package = build(index=True)
+    with tarfile.open(package) as tar:
+        expected = tar.extractfile('image_properties.xml').read()
+    capsys.readouterr()
+    nfvpt.cat_command([package, 'image_properties.xml'])
+    assert capsys.readouterr()[0] == expected
+    with pytest.raises(SystemExit) as exit_info:
+        nfvpt.cat_command([package, 'missing.cfg'])
+    assert 'has no member missing.cfg' in str(exit_info.value.code)
+
+
+def test_stale_index_is_ignored(build):
+    package = build(index=True)
+    with open(package, 'ab') as f:
+        f.write(b'\0' * 512)
+    assert nfvpt.load_package_index(package) is None
+    assert os.path.isfile(package + nfvpt.PACKAGE_INDEX_SUFFIX)
@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import nfvpt
+from conftest import ROOT_DIR
+
+LAZY_MODULES = ['argparse', 'multiprocessing', 'tarfile', 'gzip', 'tempfile', 'Queue',
+                'xmltodict', 'sqlite3', 'zstandard', 'socket', 'httplib', 'BaseHTTPServer']
+
+
+def imported_after(code):
+    script = ('import json, sys\n%s\nprint(json.dumps([name for name in %r if name in sys.modules]))'
+              % (code, LAZY_MODULES))
+    return json.loads(subprocess.check_output([sys.executable, '-c', script], cwd=ROOT_DIR))
+
+
+def test_import_loads_no_lazy_module():
+    assert imported_after('import nfvpt') == []
+
+
+def test_modules_load_on_first_use():
+    assert imported_after('import nfvpt\nnfvpt.package_target("x.tar.gz", {})') == []
+    assert imported_after('import nfvpt\nnfvpt.tarfile.TarInfo') == ['tarfile']
+    assert 'socket' in imported_after('import nfvpt\nnfvpt.service_http()')
+
+
+def test_lazy_module_replaces_itself(monkeypatch):
+    monkeypatch.setattr(nfvpt, 'gzip', nfvpt.LazyModule('gzip'))
+    assert nfvpt.gzip.GzipFile is not None
+    assert nfvpt.gzip is sys.modules['gzip']
+
+
+def test_missing_modules(monkeypatch, capsys):
+    monkeypatch.setattr(nfvpt, 'nfvpt_missing_module', nfvpt.LazyModule('nfvpt_missing_module', optional=True),
+                        raising=False)
+    assert not nfvpt.nfvpt_missing_module
+    assert nfvpt.nfvpt_missing_module is None
+    required = nfvpt.LazyModule('nfvpt_missing_module', hint='run pip install nfvpt_missing_module')
+    with pytest.raises(ImportError):
+        required.parse
+    assert 'run pip install nfvpt_missing_module' in capsys.readouterr().out
@@ -0,0 +1,86 @@
+import io
+import tarfile
+from collections import OrderedDict
+
+import pytest
+
+import nfvpt
+
+
+def records():
+    return [OrderedDict([('name', u'day0 & <edge>.cfg'), ('type', 'bootstrap_file_0'),
+                         ('sha256_checksum', 'a' * 64)]),
+            OrderedDict([('name', u'root.qcow2'), ('type', 'root_image'),
+                         ('sha256_checksum', 'b' * 64)])]
+
+
+def test_writer_escapes_names():
+    writer = nfvpt.ManifestWriter(['sha256'])
+    writer.element('Packaging_Version', '1.0')
+    for record in records():
+        writer.file_info(record)
+    data = writer.getvalue()
+    assert b'<name>day0 &amp; &lt;edge&gt;.cfg</name>' in data
+    assert b'day0 & <edge>' not in data
+    entries = list(nfvpt.iter_manifest(io.BytesIO(data)))
+    assert entries[0] == ('Packaging_Version', '1.0')
+    assert [dict(record) for record in nfvpt.manifest_file_info(entries)] == \
+        [dict(record) for record in records()]
+
+
+def test_update_package_mf_escapes_names(tmpdir):
+    ctx = nfvpt.BuildContext()
+    path = str(tmpdir.join(nfvpt.pkgmf_file))
+    with open(path, 'w') as f:
+        f.write(nfvpt.manifest_comment(['sha256']))
+        f.write('<PackageContents>\n')
+        nfvpt.updatePackageMF(ctx, f, 'a&b<c>.cfg', 'bootstrap_file', 'c' * 64, False)
+        f.write('</PackageContents>\n')
+    with open(path, 'rb') as f:
+        file_info = nfvpt.manifest_file_info(nfvpt.iter_manifest(f))
+    assert file_info[0]['name'] == 'a&b<c>.cfg'
+    assert file_info[0]['sha256_checksum'] == 'c' * 64
+
+
+def test_manifest_bytes_replaces_file_info():
+    writer = nfvpt.ManifestWriter(['sha256'])
+    writer.element('Packaging_Version', '1.0')
+    writer.file_info(records()[1])
+    writer.element('Trailer', 'x < y')
+    entries = nfvpt.iter_manifest(io.BytesIO(writer.getvalue()))
+    data = nfvpt.manifest_bytes(entries, records(), ['sha256'])
+    entries = list(nfvpt.iter_manifest(io.BytesIO(data)))
+    assert [tag for tag, value in entries] == ['Packaging_Version', nfvpt.FILE_INFO_TAG,
+                                               nfvpt.FILE_INFO_TAG, 'Trailer']
+    assert entries[1][1]['name'] == u'day0 & <edge>.cfg'
+    assert entries[3][1] == 'x < y'
+
+
+def test_iter_manifest_drops_yielded_elements():
+    writer = nfvpt.ManifestWriter(['sha256'])
+    for n in range(1000):
+        writer.file_info(OrderedDict([('name', 'f%d' % n), ('type', 'unknown'), ('sha256_checksum', 'd' * 64)]))
+    seen, held = [], []
+    entries = nfvpt.iter_manifest(io.BytesIO(writer.getvalue()))
+    for tag, record in entries:
+        seen.append(record['name'])
+        held.append(len(entries.gi_frame.f_locals['root']))
+    assert seen == ['f%d' % n for n in range(1000)]
+    # only the elements parsed ahead of the one yielded stay in the tree
+    assert max(held) < 200
+
+
+def test_iter_manifest_rejects_other_documents():
+    with pytest.raises(ValueError):
+        list(nfvpt.iter_manifest(io.BytesIO(b'<Package><File_Info/></Package>')))
+
+
+def test_read_package_manifest(build, tmpdir):
+    entries = nfvpt.read_package_manifest(build())
+    assert entries[0] == (nfvpt.PACKAGING_VERSION_TAG, '1.0')
+    names = [record['name'] for record in nfvpt.manifest_file_info(entries)]
+    assert 'root.qcow2' in names and 'image_properties.xml' in names
+    plain = str(tmpdir.join('plain.tar.gz'))
+    with tarfile.open(plain, 'w:gz') as tar:
+        tar.add(str(tmpdir.join('day0.cfg')), 'day0.cfg')
+    assert nfvpt.read_package_manifest(plain) is None
@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+
+import pytest
+
+import nfvpt
+
+
+def edit_spec(spec, **changes):
+    with open(spec) as f:
+        document = json.load(f)
+    document.update(changes)
+    with open(spec, 'w') as f:
+        json.dump(document, f)
+    return document
+
+
+def test_unknown_option():
+    with pytest.raises(ValueError):
+        nfvpt.Packager(compression_level=9)
+
+
+def test_invalid_spec_raises_validation_error(spec):
+    document = edit_spec(spec)
+    document['image_properties']['bootup_time'] = 10
+    edit_spec(spec, image_properties=document['image_properties'])
+    with pytest.raises(nfvpt.PackageValidationError) as e:
+        nfvpt.Packager(no_cache=True).build(spec)
+    assert e.value.errorType == nfvpt.VALIDATION_ERROR
+    assert e.value.key == 'bootup_time'
+    assert e.value.errorCode
+    assert json.loads(e.value.to_json())['key'] == 'bootup_time'
+
+
+def test_missing_image_raises_internal_error(spec, tmpdir):
+    document = edit_spec(spec)
+    document['image_list'][0]['image_name'] = 'missing.qcow2'
+    edit_spec(spec, image_list=document['image_list'])
+    with pytest.raises(nfvpt.PackageInternalError) as e:
+        nfvpt.Packager(no_cache=True).build(spec)
+    assert e.value.to_dict()['key'] == 'image_list'
+    assert 'missing.qcow2' in e.value.errorMessage
+    assert not tmpdir.join('out', 'isrv-test.tar.gz').check()
+
+
+def test_missing_output_dir_and_spec(spec, tmpdir):
+    edit_spec(spec, package_output_dir=str(tmpdir.join('missing')))
+    with pytest.raises(nfvpt.PackageInternalError) as e:
+        nfvpt.Packager(no_cache=True).build(spec)
+    assert e.value.key == 'package_output_dir'
+    with pytest.raises(nfvpt.PackagingError):
+        nfvpt.Packager(no_cache=True).build(str(tmpdir.join('missing.json')))
+
+
+def test_repackage_and_convert_errors(build, tmpdir):
+    package = build()
+    packager = nfvpt.Packager(no_cache=True)
+    with pytest.raises(nfvpt.PackageValidationError) as e:
+        packager.repackage(package, [])
+    assert e.value.key == 'root_disk_image'
+    with pytest.raises(nfvpt.PackageInternalError):
+        packager.convert(package, str(tmpdir.join('missing')))
+    with pytest.raises(nfvpt.PackageInternalError):
+        packager.convert(str(tmpdir.join('missing.tar.gz')))
+
+
+def test_packager_is_reusable_across_threads(spec, tmpdir):
+    specs = []
+    for n in range(4):
+        path = str(tmpdir.join('spec%d.json' % n))
+        with open(spec) as f:
+            document = json.load(f)
+        document['package_filename'] = 'isrv-%d' % n
+        with open(path, 'w') as f:
+            json.dump(document, f)
+        specs.append(path)
+    options = {'no_cache': True, 'digests': ['sha1', 'sha256']}
+    packager = nfvpt.Packager(**options)
+    results, errors = {}, []
+
+    def run(path):
+        try:
+            results[path] = packager.build(path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(path,)) for path in specs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert sorted(os.path.basename(results[path]) for path in specs) == \
+        ['isrv-%d.tar.gz' % n for n in range(4)]
+    assert packager.options == options
+    for path in results.values():
+        result = nfvpt.verify_package(path)
+        assert not (result['mismatched'] or result['missing'] or result['extra'])
@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+
+import pytest
+
+import nfvpt
+
+
+@pytest.fixture
+def cli(monkeypatch, tmpdir):
+    '''
+        cli : run nfvpt.py with the arguments given, logging to tmpdir and
+              dropping the log handler it adds afterwards.
+    '''
+    handlers = list(nfvpt.logger.handlers)
+
+    def run(*argv):
+        monkeypatch.setattr(sys, 'argv', ['nfvpt.py'] + list(argv) + ['--log_dir', str(tmpdir.join('log.txt'))])
+        return nfvpt.main()
+    yield run
+    for handler in nfvpt.logger.handlers[:]:
+        if handler not in handlers:
+            nfvpt.logger.removeHandler(handler)
+            handler.close()
+
+
+def test_build_profile(spec):
+    profile = nfvpt.BuildProfile()
+    nfvpt.Packager(no_cache=True).build(spec, profile=profile)
+    report = profile.to_dict()
+    json.dumps(report)
+    assert report['version'] == nfvpt.VERSION
+    assert report['package'] == 'isrv-test.tar.gz'
+    assert list(report['stages']) == list(nfvpt.PROFILE_STAGES)
+    assert all(seconds >= 0 for seconds in report['stages'].values())
+    assert report['stages']['archive'] > 0
+    archive = report['archive']
+    assert [member['name'] for member in archive['members']][-1] == nfvpt.pkgmf_file
+    assert archive['bytes_in'] == sum(member['bytes'] for member in archive['members'])
+    assert archive['bytes_out'] == os.path.getsize(os.path.join(os.path.dirname(spec), 'out', 'isrv-test.tar.gz'))
+    # without the checksum cache every member is hashed while it is archived
+    hashed = dict((item['name'], item['bytes']) for item in report['hash']['files'])
+    assert hashed['root.qcow2'] == os.path.getsize(os.path.join(os.path.dirname(spec), 'root.qcow2'))
+    assert report['hash']['bytes'] == sum(hashed.values())
+
+
+def test_profile_report_and_metrics(spec, tmpdir, cli):
+    report_file, metrics_file = str(tmpdir.join('profile.json')), str(tmpdir.join('nfvpt.prom'))
+    cli('--newjson', spec, '--no_cache', '--profile_report', report_file, '--profile_metrics', metrics_file)
+    with open(report_file) as f:
+        report = json.load(f)
+    assert report['version'] == nfvpt.VERSION
+    assert [package['package'] for package in report['packages']] == ['isrv-test.tar.gz']
+    with open(metrics_file) as f:
+        metrics = f.read().splitlines()
+    assert '# TYPE nfvpt_stage_seconds gauge' in metrics
+    labels = 'package="isrv-test.tar.gz",stage="hash",version="%s"' % nfvpt.VERSION
+    assert any(line.startswith('nfvpt_stage_seconds{%s} ' % labels) for line in metrics)
+    assert not os.path.exists(metrics_file + '.tmp')
+
+
+def test_metric_labels_are_escaped():
+    profile = {'package': 'a"b\\c\nd', 'version': '1', 'seconds': 2, 'stages': {}, 'hash': {'files': []},
+               'archive': None}
+    metrics = nfvpt.profile_metrics([profile])
+    assert 'nfvpt_build_seconds{package="a\\"b\\\\c\\nd",version="1"} 2.0\n' in metrics
+    assert 'nfvpt_archive' not in metrics
+
+
+def test_error_handler_cleans_up(tmpdir, monkeypatch):
+    tmpdir.join('spec.json').write('{}')
+    scratch = tmpdir.mkdir('out').mkdir('scratch')
+    opts = {'newjson': str(tmpdir.join('spec.json')), 'scratch_dir': str(scratch)}
+    ctx = nfvpt.build_context(opts)
+    ctx.image_prop_file = str(scratch.join('image_properties.xml'))
+    scratch.join('image_properties.xml').write('<image_properties/>')
+    # no 'cleanup' option: the generated files go, the input files stay
+    with pytest.raises(nfvpt.PackageValidationError):
+        nfvpt.error_handler('bad', opts, 1, nfvpt.VALIDATION_ERROR, 'key')
+    assert not scratch.check()
+
+    # nothing to clean up before the build has options
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('image_properties.xml').write('<image_properties/>')
+    opts = {}
+    nfvpt.build_context(opts)
+    with pytest.raises(nfvpt.PackageInternalError):
+        nfvpt.error_handler('bad', opts, 1, nfvpt.INTERNAL_ERROR, 'key')
+    assert tmpdir.join('image_properties.xml').check()
+
+
+def test_cli_error_leaves_no_scratch_dir(spec, tmpdir, cli):
+    with open(spec) as f:
+        document = json.load(f)
+    document['bootstrap']['file_list'][1]['name'] = 'missing.cfg'
+    with open(spec, 'w') as f:
+        json.dump(document, f)
+    with pytest.raises(SystemExit) as e:
+        cli('--newjson', spec, '--no_cache')
+    assert json.loads(e.value.code)['key'] == 'missing.cfg'
+    out = tmpdir.join('out')
+    assert not out.check() or out.listdir() == []
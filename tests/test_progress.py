@@ -0,0 +1,88 @@
+import io
+import json
+import os
+
+import pytest
+
+import nfvpt
+
+
+def test_progress_events(monkeypatch):
+    monkeypatch.setattr(nfvpt, 'PROGRESS_STEP', 100)
+    events = []
+    progress = nfvpt.Progress(events.append, 'pkg.tar.gz', interval=0)
+    progress.start('archive', 200)
+    assert [(event['phase'], event['bytes'], event['total'], event['eta'], event['status'])
+            for event in events] == [('archive', 0, 200, None, 'running')]
+    progress.start_member('root.qcow2', 300)
+    progress.advance(50)
+    # only every PROGRESS_STEP bytes the clock is read and an event sent
+    assert len(events) == 1
+    progress.advance(50)
+    assert len(events) == 2
+    assert (events[-1]['member'], events[-1]['bytes'], events[-1]['total']) == ('root.qcow2', 100, 300)
+    assert events[-1]['eta'] >= 0
+    progress.advance(200)
+    progress.finish()
+    assert (events[-1]['bytes'], events[-1]['status'], events[-1]['eta']) == (300, 'done', 0)
+    assert all(event['package'] == 'pkg.tar.gz' for event in events)
+
+
+def test_progress_interval_limits_events(monkeypatch):
+    monkeypatch.setattr(nfvpt, 'PROGRESS_STEP', 1)
+    events = []
+    progress = nfvpt.Progress(events.append, interval=3600)
+    progress.start('hash', 1000)
+    for n in range(1000):
+        progress.advance(1)
+    progress.finish('failed')
+    assert [event['status'] for event in events] == ['running', 'failed']
+
+
+def test_build_reports_the_archive(build):
+    events = []
+    package = build(progress=events.append)
+    archive = [event for event in events if event['phase'] == 'archive']
+    assert archive[0]['status'] == 'running' and archive[0]['bytes'] == 0
+    assert archive[-1]['status'] == 'done'
+    assert archive[-1]['bytes'] == archive[-1]['total'] > 0
+    assert archive[-1]['package'] == os.path.basename(package)
+    done = [event['bytes'] for event in archive]
+    assert done == sorted(done)
+
+
+def test_progress_bar():
+    stream = io.BytesIO()
+    bar = nfvpt.ProgressBar(stream)
+    event = {'phase': 'archive', 'member': 'root.qcow2', 'bytes': 512, 'total': 1024,
+             'bytes_per_second': 2048.0, 'eta': 3725, 'status': 'running'}
+    bar(event)
+    running = stream.getvalue()
+    assert running.startswith(b'\rarchive ') and running.endswith(b'root.qcow2')
+    assert b' 50.0%' in running and b'512.0 B/1.0 KiB' in running and b'ETA 1:02:05' in running
+    bar(dict(event, bytes=1024, eta=0, member=None, status='done'))
+    done = stream.getvalue()[len(running):]
+    assert done.startswith(b'\r') and done.endswith(b'\n') and b'100.0%' in done
+    # the line is padded to overwrite all of the longer one before it
+    assert len(done) - 2 == len(running) - 1
+
+
+def test_json_progress():
+    stream = io.BytesIO()
+    nfvpt.JsonProgress(stream)({'phase': 'hash', 'bytes': 1, 'total': 2})
+    assert json.loads(stream.getvalue().decode()) == {'phase': 'hash', 'bytes': 1, 'total': 2}
+
+
+@pytest.mark.parametrize('mode,expected', [('json', nfvpt.JsonProgress), ('bar', nfvpt.ProgressBar),
+                                           ('none', type(None)), ('auto', type(None))])
+def test_progress_callback(mode, expected):
+    # stderr is no terminal under pytest
+    assert isinstance(nfvpt.progress_callback(mode), expected)
+    assert nfvpt.progress_callback(len) is len
+
+
+def test_batch_keeps_json_progress_only():
+    for mode, kept in (('bar', None), ('auto', None), ('json', 'json')):
+        options = {'progress': mode}
+        nfvpt.batch_progress(options)
+        assert options.get('progress') == kept
@@ -0,0 +1,89 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import nfvpt
+from conftest import MB, payload, write_file, read_file, sha256
+
+
+def package_members(path):
+    members = {}
+    with tarfile.open(path) as tar:
+        for member in tar:
+            members[member.name] = tar.extractfile(member).read()
+    return members
+
+
+def verified(path):
+    result = nfvpt.verify_package(path)
+    return not (result['mismatched'] or result['missing'] or result['extra'])
+
+
+@pytest.fixture
+def images(tmpdir):
+    disks = tmpdir.mkdir('disks')
+    return [write_file(disks.join('new-root.qcow2'), payload(2 * MB, seed=11)),
+            write_file(disks.join('new-eph.qcow2'), payload(MB, seed=12))]
+
+
+def test_repackage_replaces_the_images(build, images, tmpdir):
+    source = build()
+    old = package_members(source)
+    target = nfvpt.repackage_package({'no_cache': True}, source, images, str(tmpdir))
+    assert os.path.basename(target) == 'repackaged_' + os.path.basename(source)
+    new = package_members(target)
+    assert sorted(new) == sorted(['day0.cfg', 'meta.json', 'image_properties.xml',
+                                  'system_generated_properties.xml', 'new-root.qcow2',
+                                  'new-eph.qcow2', nfvpt.pkgmf_file])
+    for name in ('day0.cfg', 'meta.json', 'image_properties.xml'):
+        assert new[name] == old[name]
+    assert sha256(new['new-root.qcow2']) == sha256(read_file(images[0]))
+    records = dict((record['name'], record) for record in
+                   nfvpt.manifest_file_info(nfvpt.read_package_manifest(target)))
+    assert records['new-root.qcow2']['type'] == 'root_image'
+    assert records['new-eph.qcow2']['type'] == 'ephemeral_disk1_image'
+    assert new[nfvpt.pkgmf_file].startswith(b'<!-- sha256sum - for calculating checksum -->\n')
+    assert verified(target)
+
+
+@pytest.mark.parametrize('digests', [['sha1'], ['sha1', 'sha256']])
+def test_repackage_keeps_sha1_manifests(build, images, tmpdir, digests):
+    source = build(digests=digests)
+    target = nfvpt.repackage_package({'no_cache': True}, source, images[:1], str(tmpdir))
+    manifest = package_members(target)[nfvpt.pkgmf_file]
+    # the comment repackage always wrote for packages with sha1 checksums
+    assert manifest.startswith(b'<!-- sha1sum - for calculating checksum -->\n')
+    for record in nfvpt.manifest_file_info(nfvpt.read_package_manifest(target)):
+        assert sorted(algo for algo in ('sha1', 'sha256') if algo + '_checksum' in record) == digests
+    assert verified(target)
+
+
+def metadata_package(path, members, manifest):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in members + [(nfvpt.pkgmf_file, manifest)]:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+    return path
+
+
+def test_repackage_updates_stale_checksums(images, tmpdir, capsys):
+    manifest = (b'<!-- sha256sum - for calculating checksum -->\n<PackageContents>\n'
+                b'<File_Info><name>day0.cfg</name><type>bootstrap_file_1</type>'
+                b'<sha256_checksum>' + b'0' * 64 + b'</sha256_checksum></File_Info>\n'
+                b'</PackageContents>')
+    source = metadata_package(str(tmpdir.join('meta.tar.gz')), [('day0.cfg', b'hostname a\n')], manifest)
+    target = nfvpt.repackage_package({'no_cache': True}, source, images[:1], str(tmpdir))
+    assert "checksum of day0.cfg doesn't match package.mf" in capsys.readouterr().out
+    assert verified(target)
+
+
+def test_repackage_member_missing_from_the_package(images, tmpdir):
+    manifest = (b'<PackageContents>\n<File_Info><name>day0.cfg</name><type>bootstrap_file_1</type>'
+                b'<sha256_checksum>' + b'0' * 64 + b'</sha256_checksum></File_Info>\n</PackageContents>')
+    source = metadata_package(str(tmpdir.join('meta.tar.gz')), [], manifest)
+    with pytest.raises(IOError):
+        nfvpt.repackage_package({'no_cache': True}, source, images[:1], str(tmpdir))
+    assert not os.path.exists(str(tmpdir.join('repackaged_meta.tar.gz')))
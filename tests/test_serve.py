@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import nfvpt
+
+
+def wait(service, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = service.job(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError('job %s did not finish' % job_id)
+
+
+@pytest.fixture
+def service(tmpdir):
+    service = nfvpt.PackagingService({'no_cache': True, 'progress': 'bar'}, workers=2,
+                                     spool_dir=str(tmpdir.mkdir('spool')))
+    yield service
+    service.shutdown()
+
+
+def test_job_lifecycle(service, spec, capsys):
+    queued = service.submit({'type': 'build', 'spec': spec})
+    assert queued['status'] in ('queued', 'running')
+    job = wait(service, queued['id'])
+    assert job['status'] == 'ok' and job['error'] is None
+    assert os.path.basename(job['output']) == 'isrv-test.tar.gz'
+    assert job['started'] >= job['submitted'] and job['finished'] >= job['started']
+    assert sorted(job['timings']) == sorted(nfvpt.PACKAGE_STAGES)
+    # the progress of the job is in its record, not drawn on stderr
+    progress = job['progress']
+    assert progress['bytes'] == progress['total'] > 0
+    assert progress['phase'] == 'archive'
+    assert capsys.readouterr().err == ''
+    assert [listed['id'] for listed in service.list_jobs()] == [queued['id']]
+
+
+def test_spec_objects_and_failures(service, spec, tmpdir):
+    with open(spec) as f:
+        document = json.load(f)
+    document['package_filename'] = 'isrv-object'
+    ok = service.submit({'spec': document})
+    document = dict(document, package_filename='isrv-bad', image_list=[
+        dict(document['image_list'][0], image_name='missing.qcow2')])
+    bad = service.submit({'spec': document})
+    assert wait(service, ok['id'])['output'].endswith('isrv-object.tar.gz')
+    failed = wait(service, bad['id'])
+    assert failed['status'] == 'failed' and failed['output'] is None
+    assert json.loads(failed['error'])['key'] == 'image_list'
+    converted = service.submit({'type': 'convert', 'package': str(tmpdir.join('missing.tar.gz'))})
+    assert wait(service, converted['id'])['status'] == 'failed'
+    assert service.job('no-such-job') is None
+
+
+@pytest.mark.parametrize('request_', [{'type': 'build'}, {'type': 'convert', 'package': 1},
+                                      {'type': 'delete', 'spec': 'x.json'}])
+def test_malformed_requests(service, request_):
+    with pytest.raises(ValueError):
+        service.submit(request_)
+
+
+def test_full_queue_and_shutdown(spec, tmpdir):
+    service = nfvpt.PackagingService({'no_cache': True}, workers=1, queue_size=1,
+                                     spool_dir=str(tmpdir.mkdir('spool')))
+    release = threading.Event()
+    build = service.packager.build
+
+    def blocked_build(*args):
+        release.wait(60)
+        return build(*args)
+
+    service.packager.build = blocked_build
+    running = service.submit({'spec': spec})
+    while service.job(running['id'])['status'] != 'running':
+        time.sleep(0.01)
+    queued = service.submit({'spec': spec})
+    with pytest.raises(nfvpt.ServiceBusy):
+        service.submit({'spec': spec})
+    threading.Timer(0.2, release.set).start()
+    service.shutdown()
+    assert service.job(running['id'])['status'] == 'ok'
+    assert service.job(queued['id'])['status'] == 'cancelled'
+
+
+def serve_in_thread(server, service, token=None):
+    server.service = service
+    server.token = token
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_unix_socket_client(service, spec, tmpdir):
+    http = nfvpt.service_http()
+    path = str(tmpdir.join('nfvpt.sock'))
+    server = http.unix_server(path, http.handler)
+    serve_in_thread(server, service)
+    try:
+        client = nfvpt.ServiceClient(socket_path=path)
+        job = client.wait(client.submit({'type': 'build', 'spec': spec})['id'], interval=0.02)
+        assert job['status'] == 'ok'
+        assert job['progress']['bytes'] == job['progress']['total']
+        assert [listed['id'] for listed in client.jobs()] == [job['id']]
+        with pytest.raises(IOError) as e:
+            client.submit({'type': 'delete'})
+        assert '400' in str(e.value)
+        with pytest.raises(IOError) as e:
+            client.job('42')
+        assert '404' in str(e.value)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_tcp_port_requires_the_token(service, tmpdir):
+    token_file = str(tmpdir.join('token'))
+    token = nfvpt.read_service_token(token_file, create=True)
+    assert os.stat(token_file).st_mode & 0o777 == 0o600
+    http = nfvpt.service_http()
+    server = http.tcp_server(('127.0.0.1', 0), http.handler)
+    serve_in_thread(server, service, token)
+    port = server.server_address[1]
+    try:
+        assert nfvpt.ServiceClient(port=port, token=token).jobs() == []
+        for wrong in (None, 'x' + token):
+            with pytest.raises(IOError) as e:
+                nfvpt.ServiceClient(port=port, token=wrong).jobs()
+            assert '401' in str(e.value)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_token_file_must_be_private(tmpdir):
+    token_file = tmpdir.join('token')
+    token_file.write('secret\n')
+    os.chmod(str(token_file), 0o644)
+    with pytest.raises(IOError):
+        nfvpt.read_service_token(str(token_file))
@@ -0,0 +1,53 @@
+import gzip
+import os
+import tarfile
+import zlib
+
+import nfvpt
+from conftest import MB, payload, write_file, read_file, sha256
+
+
+def test_crc32_combine():
+    first, second = payload(100000, seed=1), payload(70001, seed=2)
+    combined = nfvpt.crc32_combine(zlib.crc32(first) & 0xffffffff, zlib.crc32(second) & 0xffffffff,
+                                   len(second))
+    assert combined == zlib.crc32(first + second) & 0xffffffff
+    assert nfvpt.crc32_combine(zlib.crc32(first) & 0xffffffff, zlib.crc32(b'') & 0xffffffff, 0) == \
+        zlib.crc32(first) & 0xffffffff
+
+
+def test_spliced_shared_member(tmpdir, monkeypatch):
+    image = write_file(tmpdir.join('root.qcow2'), payload(2 * MB + 777))
+    spool_dir = tmpdir.mkdir('spool')
+    shared = {os.path.abspath(image): nfvpt.prepare_shared_member(image, str(spool_dir), {})}
+    # the spliced member is copied from the spool, the image is not read again
+    monkeypatch.setattr(nfvpt, 'FileReader', None)
+    package = str(tmpdir.join('shared.tar.gz'))
+    archive = nfvpt.PackageArchive(package, shared=shared)
+    archive.addbytes('day0.cfg', b'hostname edge\n')
+    checksums = archive.add(image)
+    archive.addbytes('meta.json', b'{}\n')
+    archive.close()
+    data = read_file(image)
+    assert checksums['sha256'] == sha256(data)
+    with tarfile.open(package) as tar:
+        assert tar.getnames() == ['day0.cfg', 'root.qcow2', 'meta.json']
+        assert sha256(tar.extractfile('root.qcow2').read()) == sha256(data)
+        assert tar.extractfile('meta.json').read() == b'{}\n'
+    # the gzip trailer carries the crc32 combined over the spliced spool,
+    # gzip raises on a mismatch
+    assert len(gzip.open(package).read()) % tarfile.RECORDSIZE == 0
+
+
+def test_changed_shared_image_is_archived_again(tmpdir):
+    image = write_file(tmpdir.join('root.qcow2'), payload(2 * MB, seed=1))
+    shared = {os.path.abspath(image): nfvpt.prepare_shared_member(image, str(tmpdir.mkdir('spool')), {})}
+    write_file(image, payload(2 * MB + 512, seed=2))
+    package = str(tmpdir.join('shared.tar.gz'))
+    archive = nfvpt.PackageArchive(package, shared=shared)
+    checksums = archive.add(image)
+    archive.close()
+    data = read_file(image)
+    assert checksums['sha256'] == sha256(data)
+    with tarfile.open(package) as tar:
+        assert sha256(tar.extractfile('root.qcow2').read()) == sha256(data)
@@ -0,0 +1,107 @@
+import json
+import os
+import tarfile
+import threading
+
+import pytest
+import xmltodict
+
+import nfvpt
+
+
+class CountingParser(object):
+    '''
+        CountingParser : xmltodict counting the documents it parses.
+    '''
+    def __init__(self):
+        self.parsed = 0
+
+    def parse(self, data):
+        self.parsed += 1
+        return xmltodict.parse(data)
+
+
+@pytest.fixture
+def parser(monkeypatch):
+    parser = CountingParser()
+    monkeypatch.setattr(nfvpt, 'xmltodict', parser)
+    return parser
+
+
+def test_builtin_template_is_parsed_once(parser):
+    cache = nfvpt.TemplateCache()
+    first, second = cache.get(), cache.get()
+    assert parser.parsed == 1
+    assert first == second == xmltodict.parse(nfvpt.image_properties_template_contents)
+
+
+def test_copies_are_independent(parser):
+    cache = nfvpt.TemplateCache()
+    first = cache.get()
+    properties = first['image_properties']
+    # make_image_prop_xml sets, pops and appends to image_properties
+    properties['vnf_type'] = 'FIREWALL'
+    properties.pop(list(properties)[0])
+    properties['custom_property'] = [{'name': 'x'}]
+    for key, value in properties.items():
+        if isinstance(value, list):
+            value.append('added')
+    assert cache.get() == xmltodict.parse(nfvpt.image_properties_template_contents)
+
+
+def test_changed_template_file_is_parsed_again(parser, tmpdir):
+    path = tmpdir.join('template.xml')
+    path.write('<image_properties><vnf_type>ROUTER</vnf_type></image_properties>')
+    cache = nfvpt.TemplateCache()
+    assert cache.get(str(path))['image_properties']['vnf_type'] == 'ROUTER'
+    assert cache.get(str(path))['image_properties']['vnf_type'] == 'ROUTER'
+    assert parser.parsed == 1
+    path.write('<image_properties><vnf_type>FIREWALL</vnf_type></image_properties>')
+    assert cache.get(str(path))['image_properties']['vnf_type'] == 'FIREWALL'
+    assert parser.parsed == 2
+    # the older parse is dropped, the built-in template is kept apart
+    cache.get()
+    assert len(cache.templates) == 2
+    with pytest.raises(OSError):
+        cache.get(str(tmpdir.join('missing.xml')))
+
+
+def test_template_cache_across_threads(parser):
+    cache = nfvpt.TemplateCache()
+    results, errors = [], []
+
+    def run():
+        try:
+            for n in range(20):
+                template = cache.get()
+                template['image_properties']['vnf_name'] = threading.current_thread().name
+                results.append(template)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, name='t%d' % n) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors and len(results) == 80
+    assert parser.parsed <= 4
+    assert cache.get() == xmltodict.parse(nfvpt.image_properties_template_contents)
+
+
+def test_builds_share_the_template_not_their_changes(spec, tmpdir):
+    with open(spec) as f:
+        document = json.load(f)
+    properties = []
+    for name in ('isrv-a', 'isrv-b'):
+        document['package_filename'] = name
+        with open(spec, 'w') as f:
+            json.dump(document, f)
+        package = nfvpt.Packager(no_cache=True).build(spec)
+        with tarfile.open(package) as tar:
+            properties.append(tar.extractfile('image_properties.xml').read())
+    # the second build renders exactly what the first did, the userInput
+    # property the first added to its copy isn't carried over
+    assert properties[0] == properties[1]
+    assert properties[1].count(b'HOSTNAME') == 1
+    assert os.path.basename(package) == 'isrv-b.tar.gz'
@@ -0,0 +1,89 @@
+import json
+import sys
+
+import pytest
+
+import nfvpt
+
+
+@pytest.fixture
+def document(spec):
+    with open(spec) as f:
+        return json.load(f)
+
+
+def errors(spec):
+    return [(violation.errorCode, violation.key) for violation in nfvpt.validate_spec(spec)]
+
+
+def test_valid_spec(spec, document):
+    assert nfvpt.validate_spec(spec) == []
+    assert nfvpt.validate_spec(document) == []
+
+
+def test_every_error_in_the_order_of_the_rules(document):
+    del document['vnf_name']
+    document['vnf_version'] = '17.3.'
+    document['image_properties']['bootup_time'] = 10
+    document['image_list'].append({'image_name': 'eph2.img', 'path': '/tmp', 'disk': 'data'})
+    document['volumes'] = [{'size': 300, 'sizeunit': 'GiB', 'deviceType': 'floppy'},
+                           {'size': 2, 'sizeunit': 'TiB', 'format': 'vhd'}]
+    assert errors(document) == [('777', 'vnf_name'), ('784', 'image_name'), ('888', 'image_list'),
+                                ('718', 'vnf_version'), ('757', 'bootup_time'), ('832', 'size'),
+                                ('836', 'size'), ('840', 'deviceType'), ('844', 'format')]
+    violations = nfvpt.validate_spec(document)
+    assert all(violation.errorType == nfvpt.VALIDATION_ERROR for violation in violations)
+    assert violations[2].errorMessage.endswith('/tmp/eph2.img')
+
+
+def test_missing_sections_are_reported_not_raised(document):
+    for key in ('image_properties', 'image_list', 'bootstrap', 'resource_properties'):
+        del document[key]
+    assert errors(document) == [('774', 'monitored'), ('1901', 'image_list')]
+    # values of the wrong type fail their own rules, not the ones below them
+    assert errors({'vnf_type': 'ROUTER', 'image_list': {}, 'volumes': ['x'], 'resource_properties': 'x'}) == \
+        [('768', 'package_filename'), ('771', 'vnf_version'), ('774', 'monitored'), ('777', 'vnf_name'),
+         ('780', 'app_vendor'), ('1902', 'image_list')]
+
+
+@pytest.mark.parametrize('ha_capable,file_count,code', [(True, 1, '789'), (False, 0, '792')])
+def test_bootstrap_file_count(document, ha_capable, file_count, code):
+    document['resource_properties']['ha_capable'] = ha_capable
+    document['resource_properties']['vnic_max'] = 8
+    document['bootstrap']['file_list'] = document['bootstrap']['file_list'][:file_count]
+    assert errors(document) == [(code, 'file_list')]
+
+
+# the sizes in MiB and TiB are converted to GiB in integers, as the tool
+# always did: 256999 MiB is still 256 GiB
+@pytest.mark.parametrize('size,unit,code', [
+    (256999, 'MiB', None), (257000, 'MiB', '828'), ('256', 'GiB', None), ('257', 'GiB', '832'),
+    (0, 'TiB', None), (1, 'TiB', '836'), ('big', 'GiB', '832')])
+def test_volume_size(document, size, unit, code):
+    document['volumes'] = [{'size': size, 'sizeunit': unit}]
+    assert errors(document) == ([(code, 'size')] if code else [])
+
+
+def test_unreadable_specs(tmpdir):
+    assert errors(str(tmpdir.join('missing.json'))) == [('539', str(tmpdir.join('missing.json')))]
+    assert nfvpt.validate_spec(str(tmpdir.join('missing.json')))[0].errorType == nfvpt.INTERNAL_ERROR
+    broken = tmpdir.join('broken.json')
+    broken.write('{"vnf_type": ')
+    assert errors(str(broken)) == [('1905', str(broken))]
+    assert errors([]) == [('1904', 'spec')]
+
+
+def test_validate_command(spec, document, tmpdir, monkeypatch, capsys):
+    del document['app_vendor']
+    invalid = tmpdir.join('invalid.json')
+    invalid.write(json.dumps(document))
+    report = str(tmpdir.join('report.json'))
+    monkeypatch.setattr(sys, 'argv', ['nfvpt.py', 'validate', spec, str(invalid), '--report', report])
+    with pytest.raises(SystemExit) as e:
+        nfvpt.main()
+    assert e.value.code == 1
+    assert '2 specs validated, 1 with errors' in capsys.readouterr().out
+    with open(report) as f:
+        result = json.load(f)
+    assert result[spec] == []
+    assert [(error['errorCode'], error['key']) for error in result[str(invalid)]] == [('780', 'app_vendor')]
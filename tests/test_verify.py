@@ -0,0 +1,79 @@
+import json
+import os
+from collections import OrderedDict
+
+import pytest
+
+import nfvpt
+from conftest import sha256
+
+
+def record(name, data):
+    return OrderedDict([('name', name), ('type', 'bootstrap_file'), ('sha256_checksum', sha256(data))])
+
+
+def tampered_package(path):
+    '''
+        tampered_package : a package whose package.mf has a wrong checksum
+                           for b.cfg, lists c.cfg it doesn't hold and
+                           misses d.cfg it holds.
+    '''
+    writer = nfvpt.ManifestWriter(['sha256'])
+    writer.file_info(record('a.cfg', b'a\n'))
+    writer.file_info(record('b.cfg', b'not b\n'))
+    writer.file_info(record('c.cfg', b'c\n'))
+    archive = nfvpt.PackageArchive(path)
+    archive.addbytes('a.cfg', b'a\n')
+    archive.addbytes('b.cfg', b'b\n')
+    archive.addbytes('d.cfg', b'd\n')
+    archive.addbytes(nfvpt.pkgmf_file, writer.getvalue())
+    archive.close()
+    return path
+
+
+def test_verify_built_package(build):
+    result = nfvpt.verify_package(build(digests=['sha1', 'sha256']))
+    assert result['members'] == 6
+    assert result['digests'] == ['sha1', 'sha256']
+    assert not (result['mismatched'] or result['missing'] or result['extra'])
+
+
+def test_verify_reports_differences(tmpdir):
+    result = nfvpt.verify_package(tampered_package(str(tmpdir.join('bad.tar.gz'))))
+    assert [(item['name'], item['algo'], item['actual']) for item in result['mismatched']] == \
+        [('b.cfg', 'sha256', sha256(b'b\n'))]
+    assert [item['name'] for item in result['missing']] == ['c.cfg']
+    assert result['extra'] == ['d.cfg']
+
+
+def test_verify_command_exit_status(tmpdir, build, capsys):
+    good = build()
+    bad = tampered_package(str(tmpdir.join('bad.tar.gz')))
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as exit_info:
+        nfvpt.verify_command([good, bad, '--workers', '1'])
+    assert exit_info.value.code == 1
+    report = json.loads(capsys.readouterr()[0])
+    assert (report['ok'], report['failed']) == (1, 1)
+    assert [result['status'] for result in report['results']] == ['ok', 'failed']
+
+
+def test_verify_directory_with_unreadable_package(tmpdir, build, capsys):
+    packages = tmpdir.mkdir('packages')
+    os.rename(build(), str(packages.join('good.tar.gz')))
+    packages.join('broken.tar.gz').write_binary(b'\x1f\x8b not a package')
+    report_file = str(tmpdir.join('report.json'))
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as exit_info:
+        nfvpt.verify_command([str(packages), '--workers', '2', '--block_size', '4K',
+                              '--report', report_file])
+    assert exit_info.value.code == 1
+    with open(report_file) as f:
+        report = json.load(f)
+    status = dict((os.path.basename(result['source']), (result['status'], result['error']))
+                  for result in report['results'])
+    assert status['good.tar.gz'] == ('ok', None)
+    assert status['broken.tar.gz'][0] == 'failed' and status['broken.tar.gz'][1]
+    with pytest.raises(SystemExit) as exit_info:
+        nfvpt.verify_command([str(tmpdir.join('*.tar.gz'))])
+    assert 'No package found' in str(exit_info.value.code)